@@ -1,6 +1,7 @@
 from django.contrib import admin
 from .models import *
 from socapp_auth.models import *
+from socapp import tasks
 
 # Register your models here.
 #admin.site.register(Group)
@@ -9,4 +10,23 @@ admin.site.register(Leaderboard)
 
 admin.site.register(Team)
 admin.site.register(Fixture)
-admin.site.register(Answer)
\ No newline at end of file
+admin.site.register(Answer)
+
+@admin.register(ScoringRules)
+class ScoringRulesAdmin(admin.ModelAdmin):
+    list_display = ('name', 'exact_score', 'correct_outcome', 'goals_bonus', 'extra_time_correct', 'extra_time_wrong',
+                    'penalties_correct', 'penalties_wrong')
+
+# Shows admins which results are still waiting to be applied, and which have failed.
+@admin.register(ResultJob)
+class ResultJobAdmin(admin.ModelAdmin):
+    list_display = ('fixture', 'status', 'attempts', 'created', 'processed_at', 'error')
+    list_filter = ('status',)
+    list_select_related = ('fixture', 'fixture__team1', 'fixture__team2')
+    readonly_fields = ('fixture', 'prev_result', 'result', 'attempts', 'error', 'created', 'processed_at')
+    actions = ['retry_jobs']
+
+    def retry_jobs(self, request, queryset):
+        retried = tasks.retry_failed_jobs(queryset)
+        self.message_user(request, "{} failed job(s) put back in the queue".format(retried))
+    retry_jobs.short_description = "Retry selected failed jobs"
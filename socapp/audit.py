@@ -0,0 +1,167 @@
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import Max, Min, Sum
+
+from collections import defaultdict, namedtuple
+from multiprocessing import Pool
+
+import socapp.utils as utils
+
+"""
+Auditing (and repairing) users' points against their predictions.
+The scored predictions are streamed from the database ordered by user, and each user's expected overall and per-tournament
+totals are worked out in a single pass, so memory use depends on the chunk size rather than the number of predictions.
+Users can be split into ranges of user ids and audited by a pool of worker processes.
+Used by the sync_user_points management command.
+"""
+
+# Number of rows fetched from the database at a time while streaming predictions
+AUDIT_CHUNK_SIZE = 2000
+
+# A stored value which doesn't match the value worked out from the predictions.
+# kind is one of the constants below; tournament_id is only set for TOURNAMENT, answer_id only for ANSWER.
+PointsDiscrepancy = namedtuple('PointsDiscrepancy', ['kind', 'user_id', 'tournament_id', 'answer_id', 'stored', 'expected'])
+
+ANSWER = 'answer' # The points stored on a prediction (Answer.points)
+USER = 'user' # A user's overall points (UserProfile.points)
+TOURNAMENT = 'tournament' # A user's points for a tournament (TournamentPoints.points)
+
+def user_id_ranges(workers):
+    """ Splits the range of user ids into (at most) the given number of (first, last) ranges of roughly equal width """
+    bounds = get_user_model().objects.aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return []
+    first, last = bounds['first'], bounds['last']
+    width = max(1, -(-(last - first + 1) // workers))
+    return [(start, min(start + width - 1, last)) for start in range(first, last + 1, width)]
+
+def expected_points(fixture, prediction, scores):
+    """ Returns the points for a prediction of the fixture, scoring each distinct prediction only once """
+    key = (fixture.pk,) + tuple(prediction)
+    points = scores.get(key)
+    if points is None:
+        points = scores[key] = utils.calculate_points(fixture, prediction)
+    return points
+
+def audit_user_points(user_range=None, chunk_size=AUDIT_CHUNK_SIZE):
+    """
+    Compares the points stored for each user (in the given (first, last) range of user ids, or all users) with the points their
+    predictions of the played fixtures are worth. Returns a list of PointsDiscrepancy.
+    Takes a query for the played fixtures, one for the users' profiles and one for their tournament points, and streams the predictions.
+    """
+    from socapp.models import Fixture, Answer
+    from socapp_auth.models import UserProfile, TournamentPoints
+
+    def in_range(queryset, user_field):
+        if user_range is None:
+            return queryset
+        return queryset.filter(**{user_field + '__range': user_range})
+
+    fixtures = Fixture.objects.filter(status=Fixture.MATCH_STATUS_PLAYED).in_bulk()
+    answers = in_range(Answer.objects.filter(fixture__status=Fixture.MATCH_STATUS_PLAYED), 'user__id') \
+        .order_by('user_id') \
+        .values_list('user_id', 'pk', 'fixture_id', 'points', 'points_added', *utils.Prediction._fields) \
+        .iterator(chunk_size=chunk_size)
+
+    discrepancies = []
+    expected_totals = defaultdict(int) # user pk -> points
+    expected_tournament_totals = defaultdict(int) # (user pk, tournament pk) -> points
+    scores = {}
+    for user_id, answer_id, fixture_id, points, points_added, *prediction in answers:
+        fixture = fixtures[fixture_id]
+        expected = expected_points(fixture, utils.Prediction(*prediction), scores)
+        if not points_added or points != expected:
+            discrepancies.append(PointsDiscrepancy(ANSWER, user_id, None, answer_id, points, expected))
+        expected_totals[user_id] += expected
+        expected_tournament_totals[(user_id, fixture.tournament_id)] += expected
+
+    for user_id, points in in_range(UserProfile.objects.all(), 'user__id').values_list('user_id', 'points').iterator(chunk_size=chunk_size):
+        expected = expected_totals.get(user_id, 0)
+        if points != expected:
+            discrepancies.append(PointsDiscrepancy(USER, user_id, None, None, points, expected))
+
+    stored_tournament_totals = in_range(TournamentPoints.objects.all(), 'user__user__id') \
+        .values_list('user__user_id', 'tournament_id', 'points').iterator(chunk_size=chunk_size)
+    for user_id, tournament_id, points in stored_tournament_totals:
+        expected = expected_tournament_totals.pop((user_id, tournament_id), 0)
+        if points != expected:
+            discrepancies.append(PointsDiscrepancy(TOURNAMENT, user_id, tournament_id, None, points, expected))
+    # Tournaments a user has scored points in, but which have no TournamentPoints row
+    for (user_id, tournament_id), expected in expected_tournament_totals.items():
+        if expected != 0:
+            discrepancies.append(PointsDiscrepancy(TOURNAMENT, user_id, tournament_id, None, None, expected))
+
+    return discrepancies
+
+def audit_range(args):
+    # Runs in a worker process, with its own database connection
+    user_range, chunk_size = args
+    try:
+        return audit_user_points(user_range, chunk_size)
+    finally:
+        connections.close_all()
+
+def audit_all_users(workers=1, chunk_size=AUDIT_CHUNK_SIZE):
+    """ Audits every user's points, splitting the users by id across a pool of worker processes if workers > 1 """
+    if workers <= 1:
+        return audit_user_points(chunk_size=chunk_size)
+
+    ranges = user_id_ranges(workers)
+    # The workers are forked from this process, so they mustn't share its database connections
+    connections.close_all()
+    with Pool(len(ranges) or 1) as pool:
+        results = pool.map(audit_range, [(user_range, chunk_size) for user_range in ranges])
+    return [discrepancy for result in results for discrepancy in result]
+
+def repair_points(discrepancies):
+    """
+    Sets the stored points to the expected values for each of the discrepancies, with a handful of bulk statements,
+    then updates the stored ranks (which also invalidates the cached pages).
+    The tournament totals are repaired first. The overall points of the users involved are then set to the sum of their
+    (repaired) tournament totals, so the two always agree afterwards.
+    Repair entries are then recorded in the points ledger for the difference between each involved user's ledger totals and their
+    repaired tournament totals, so that the ledger agrees with both (and rebuilding the totals from it keeps the repair).
+    """
+    from socapp.models import Answer, PointsLedgerEntry
+    from socapp import ledger
+    from socapp_auth.models import UserProfile, TournamentPoints
+    import socapp.ranking as ranking
+
+    by_kind = defaultdict(list)
+    for discrepancy in discrepancies:
+        by_kind[discrepancy.kind].append(discrepancy)
+    if not by_kind:
+        return
+
+    with transaction.atomic():
+        utils.bulk_update(Answer, [Answer(pk=d.answer_id, points=d.expected, points_added=Answer.POINTS_ADDED) for d in by_kind[ANSWER]],
+                          ['points', 'points_added'])
+
+        # UserProfile and TournamentPoints are keyed by the user's profile, so map the user pks onto profile pks
+        user_ids = {d.user_id for d in by_kind[USER] + by_kind[TOURNAMENT]}
+        profile_pks = {}
+        for chunk in utils.chunked(list(user_ids)):
+            profile_pks.update(UserProfile.objects.filter(user_id__in=chunk).values_list('user_id', 'pk'))
+
+        missing = [d for d in by_kind[TOURNAMENT] if d.stored is None]
+        TournamentPoints.objects.bulk_create([TournamentPoints(user_id=profile_pks[d.user_id], tournament_id=d.tournament_id, points=d.expected) for d in missing],
+                                             batch_size=utils.BULK_BATCH_SIZE)
+        points_by_row = defaultdict(list) # (tournament pk, points) -> profile pks
+        for d in by_kind[TOURNAMENT]:
+            if d.stored is not None:
+                points_by_row[(d.tournament_id, d.expected)].append(profile_pks[d.user_id])
+        for (tournament_id, points), pks in points_by_row.items():
+            for chunk in utils.chunked(pks):
+                TournamentPoints.objects.filter(tournament_id=tournament_id, user_id__in=chunk).update(points=points)
+
+        # Every fixture belongs to a tournament, so a user's overall points are the sum of their tournament points
+        profiles = []
+        for chunk in utils.chunked(list(profile_pks.values())):
+            totals = dict(TournamentPoints.objects.filter(user_id__in=chunk).order_by().values_list('user_id').annotate(total=Sum('points')))
+            profiles.extend(UserProfile(pk=pk, points=totals.get(pk, 0))
+                            for pk, points in UserProfile.objects.filter(pk__in=chunk).values_list('pk', 'points')
+                            if points != totals.get(pk, 0))
+        utils.bulk_update(UserProfile, profiles, ['points'])
+        ledger.open_balances(users=list(profile_pks), reason=PointsLedgerEntry.REASON_REPAIR)
+
+    ranking.refresh_rank_snapshots()
@@ -0,0 +1,70 @@
+"""
+Caching of the data and template fragments behind the read-heavy pages (index, tournaments, leaderboards).
+Between results, that data doesn't change, so it is cached under keys which include the "results version": a number
+stored in the database, which is bumped whenever a fixture is saved, a scoring pass runs or a board's members change.
+Bumping the version makes every key built from the old version unused, so nothing has to be deleted from the cache.
+The cache itself is Django's default cache (see CACHES in settings.py), which is in-process memory unless configured otherwise.
+"""
+
+from django.core.cache import cache
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+import time
+
+# Entries made under an old version are never read again, so they only need to live long enough to be useful
+RESULTS_CACHE_TIMEOUT = 60 * 60 * 24
+
+def now_version():
+    return int(time.time() * 1000000)
+
+def results_version():
+    """ Returns the current results version, creating it on first use """
+    from socapp.models import ResultsVersion
+    version = ResultsVersion.objects.filter(pk=1).values_list('version', flat=True).first()
+    if version is None:
+        version = ResultsVersion.objects.get_or_create(pk=1, defaults={'version': now_version()})[0].version
+    return version
+
+def bump_results_version(field='version'):
+    """
+    Moves the results version on. The new version is the current time in microseconds, or one more than the old version
+    if that is later, so versions only ever go up (even if the database is restored) and are never reused.
+    """
+    from socapp.models import ResultsVersion
+    updated = ResultsVersion.objects.filter(pk=1).update(**{field: Greatest(F(field) + 1, Value(now_version()))})
+    if not updated:
+        results_version()
+        ResultsVersion.objects.filter(pk=1).update(**{field: Greatest(F(field) + 1, Value(now_version()))})
+
+def global_board_version():
+    """
+    Returns the version the global board's cached data is keyed by: the results version plus the board members version,
+    which is bumped when users sign up or are deleted. One query.
+    """
+    from socapp.models import ResultsVersion
+    versions = ResultsVersion.objects.filter(pk=1).values_list('version', 'board_members_version').first()
+    if versions is None:
+        return '{}-0'.format(results_version())
+    return '{}-{}'.format(*versions)
+
+def bump_board_members_version():
+    """ Invalidates the global board's cached data only, e.g. when a user signs up """
+    bump_results_version('board_members_version')
+
+def versioned_key(name, version=None):
+    if version is None:
+        version = results_version()
+    return 'soccerates:{}:{}'.format(version, name)
+
+def cached(name, func, version=None, timeout=RESULTS_CACHE_TIMEOUT):
+    """
+    Returns the value cached under the given name for the current results version, calling func() to work it out
+    (and caching it) if it isn't cached yet. Pass the version if it has already been read for this request.
+    """
+    key = versioned_key(name, version)
+    value = cache.get(key)
+    if value is None:
+        value = func()
+        cache.set(key, value, timeout)
+    return value
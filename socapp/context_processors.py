@@ -0,0 +1,11 @@
+from django.utils.functional import SimpleLazyObject
+import socapp.cache as results_cache
+
+# Adds the results version to every template's context, so template fragments can be cached with it:
+# {% cache cache_timeout "name" results_version %}
+# It is only read from the database if a template uses it (views which have already read it pass it in their context instead).
+def results_version(request):
+    return {
+        'results_version': SimpleLazyObject(results_cache.results_version),
+        'cache_timeout': results_cache.RESULTS_CACHE_TIMEOUT,
+    }
@@ -0,0 +1,109 @@
+from django.db.models import Count
+from django.utils import timezone
+
+import socapp.cache as results_cache
+
+"""
+The data behind the home page, for the current tournament.
+All of the tournament's fixtures are loaded in one query and split up in memory into the group stage (by group),
+the knockout rounds, and the next/last few matches, so the page takes the same few queries however big the tournament is.
+"""
+
+# Number of upcoming and past fixtures shown on the home page
+RECENT_FIXTURES = 5
+
+# The context names of the knockout rounds, as used by the index template
+KNOCKOUT_STAGES = (
+    ('ro16_fixtures', 'ROUND_OF_16'),
+    ('qf_fixtures', 'QUARTER_FINALS'),
+    ('sf_fixtures', 'SEMI_FINALS'),
+    ('tpp_fixture', 'TPP'),
+    ('final_fixture', 'FINAL'),
+)
+
+def current_tournament(tournaments, now=None):
+    """
+    Picks the current tournament from a list of tournaments annotated with their fixture_count: the last one to have
+    started, or if none have started yet, the next one to start. Tournaments whose fixtures haven't been added yet are
+    only picked if none have fixtures. Returns None if there are no tournaments.
+    """
+    if now is None:
+        now = timezone.now()
+    tournaments = [t for t in tournaments if t.fixture_count] or tournaments
+    started = [t for t in tournaments if t.start_date <= now]
+    if started:
+        return max(started, key=lambda t: t.start_date)
+    return min(tournaments, key=lambda t: t.start_date, default=None)
+
+def get_current_tournament(now=None):
+    """ Returns the current tournament (see current_tournament), in one query """
+    from socapp.models import Tournament
+    return current_tournament(list(Tournament.objects.annotate(fixture_count=Count('fixture'))), now)
+
+def partition_by_group(fixtures):
+    """
+    Splits group stage fixtures by group, keeping their order. Returns a dictionary of group name -> list of the group's
+    fixtures, with every group present (in order) even if it has no fixtures.
+    """
+    from socapp.models import Team
+    groups = {group: [] for group in Team.group_names}
+    for fixture in fixtures:
+        groups.setdefault(fixture.team1.group, []).append(fixture)
+    return groups
+
+def partition_fixtures(fixtures):
+    """
+    Splits a list of fixtures (in date order) by stage. Returns a dictionary with 'groups' (see partition_by_group)
+    and each of the KNOCKOUT_STAGES context names -> that round's fixtures.
+    """
+    from socapp.models import Fixture
+    stages = {getattr(Fixture, stage): [] for _, stage in KNOCKOUT_STAGES}
+    for fixture in fixtures:
+        if fixture.stage != Fixture.GROUP:
+            stages.setdefault(fixture.stage, []).append(fixture)
+
+    partition = {name: stages[getattr(Fixture, stage)] for name, stage in KNOCKOUT_STAGES}
+    partition['groups'] = partition_by_group(f for f in fixtures if f.stage == Fixture.GROUP)
+    return partition
+
+def tournament_dashboard(tournament):
+    """
+    Returns the home page's fixture data for the tournament: the partition_fixtures() of its fixtures, plus
+    'group_fixtures_exist', 'group_standings', 'upcoming_fixtures', 'past_fixtures' and 'is_international'.
+    Takes one query for the fixtures, and one for the group tables if there are any group matches.
+    """
+    from socapp.models import Fixture
+    fixtures = list(tournament.get_fixtures().order_by('match_date', 'pk'))
+
+    dashboard = partition_fixtures(fixtures)
+    dashboard['group_fixtures_exist'] = any(dashboard['groups'].values())
+    dashboard['group_standings'] = tournament.group_standings() if dashboard['group_fixtures_exist'] else {}
+    dashboard['upcoming_fixtures'] = [f for f in fixtures if f.status == Fixture.MATCH_STATUS_NOT_PLAYED][:RECENT_FIXTURES]
+    dashboard['past_fixtures'] = [f for f in reversed(fixtures) if f.status == Fixture.MATCH_STATUS_PLAYED][:RECENT_FIXTURES]
+    dashboard['is_international'] = tournament.is_international
+    return dashboard
+
+def empty_dashboard():
+    dashboard = partition_fixtures([])
+    dashboard.update({'group_fixtures_exist': False, 'group_standings': {}, 'upcoming_fixtures': [], 'past_fixtures': [], 'is_international': False})
+    return dashboard
+
+def index_dashboard(version=None, now=None):
+    """
+    Returns the context for the home page: the tournaments (one query), and the current tournament's dashboard,
+    cached until the results version changes.
+    """
+    from socapp.models import Tournament
+    if now is None:
+        now = timezone.now()
+    tournaments = list(Tournament.objects.annotate(fixture_count=Count('fixture')))
+    tournament = current_tournament(tournaments, now)
+
+    if tournament is None:
+        context = empty_dashboard()
+    else:
+        context = dict(results_cache.cached('dashboard_{}'.format(tournament.pk), lambda: tournament_dashboard(tournament), version))
+    context['tournament'] = tournament
+    context['upcoming_tournaments'] = sorted((t for t in tournaments if t.start_date > now), key=lambda t: t.start_date)
+    context['past_tournaments'] = [t for t in tournaments if t.start_date <= now]
+    return context
@@ -11,9 +11,23 @@ class UserProfileForm(forms.ModelForm):
         fields = ('picture',)
 
 
+# A ModelChoiceField for fixtures which, if given a dictionary of pk -> Fixture, looks the fixture up there rather than querying for it.
+# This lets a formset with a form per fixture be validated without a query per form.
+class FixtureChoiceField(forms.ModelChoiceField):
+    fixtures_by_pk = None
+
+    def to_python(self, value):
+        if self.fixtures_by_pk is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            return self.fixtures_by_pk[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+
+
 class AnswerForm(forms.ModelForm):
     # fixture - hidden field that ties the answer to a fixture
-    fixture = forms.ModelChoiceField(queryset=Fixture.objects.all(), widget=forms.HiddenInput())
+    fixture = FixtureChoiceField(queryset=Fixture.objects.all(), widget=forms.HiddenInput())
     team1_goals = forms.IntegerField(min_value=0, max_value=10, widget=forms.NumberInput(
         attrs = {'class': 'form-control form-control-sm goal-input-widget'}), 
         required=False)
@@ -26,6 +40,11 @@ class AnswerForm(forms.ModelForm):
     has_penalties = forms.BooleanField(widget=forms.CheckboxInput(), initial=False, required=False, \
                                     label="Penalties?")
 
+    # fixtures_by_pk: optional dictionary of the fixtures the form can be for, to save looking the fixture up in the database
+    def __init__(self, *args, fixtures_by_pk=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['fixture'].fixtures_by_pk = fixtures_by_pk
+
     class Meta:
         model = Answer
         fields = ('fixture', 'team1_goals', 'team2_goals', 'has_extra_time', 'has_penalties')
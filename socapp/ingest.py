@@ -0,0 +1,355 @@
+from django.core.exceptions import ValidationError
+
+from collections import namedtuple
+import json
+import logging
+import random
+import time
+import urllib.request
+
+import socapp.utils as utils
+
+"""
+Live score ingestion: reading score changes from a feed and recording them as fixture results.
+A feed adapter (a FeedAdapter subclass) yields ScoreEvents. Feeds send many updates in quick succession (repeats of the same
+score, goals which are disallowed a minute later...), so a Debouncer holds each fixture's latest score until the fixture has
+been quiet for a while. The scores it releases are recorded in batches with Fixture.objects.record_result, and their result
+jobs processed together, so the ranks are refreshed once per batch rather than once per goal.
+Used by the ingest_scores management command. simulate_matchday generates a feed for testing, which write_feed can save for
+FileFeed to replay.
+"""
+
+logger = logging.getLogger(__name__)
+
+# Seconds (on the feed's clock) a fixture's score has to stay the same before it is recorded
+DEBOUNCE_WINDOW = 30.0
+# The most seconds a fixture's score is held back for, however often it changes
+DEBOUNCE_MAX_WAIT = 120.0
+# The most results recorded in one batch
+INGEST_BATCH_SIZE = 100
+
+# A score change for a fixture. time is in seconds, on the feed's clock (e.g. a Unix timestamp, or seconds since the first kickoff).
+ScoreEvent = namedtuple('ScoreEvent', ['fixture_id', 'team1_goals', 'team2_goals', 'has_extra_time', 'has_penalties', 'time'])
+
+def event_from_dict(data, default_time=None):
+    """
+    Builds a ScoreEvent from a feed's JSON object, e.g. {"fixture": 1, "team1_goals": 2, "team2_goals": 1, "time": 5400}.
+    has_extra_time and has_penalties default to false, and time to default_time. Raises ValueError if the object isn't valid.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected an object, got {!r}".format(data))
+    try:
+        goals = [data['team1_goals'], data['team2_goals']]
+        if any(g is not None and (isinstance(g, bool) or not isinstance(g, int)) for g in goals):
+            raise ValueError("Goals must be whole numbers or null")
+        event_time = data.get('time', default_time)
+        if event_time is None:
+            raise ValueError("The event has no time")
+        return ScoreEvent(int(data['fixture']), goals[0], goals[1], bool(data.get('has_extra_time', False)),
+                          bool(data.get('has_penalties', False)), float(event_time))
+    except KeyError as e:
+        raise ValueError("Missing {}".format(e))
+    except TypeError as e:
+        raise ValueError(str(e))
+
+def event_to_dict(event):
+    return {
+        'fixture': event.fixture_id, 'team1_goals': event.team1_goals, 'team2_goals': event.team2_goals,
+        'has_extra_time': event.has_extra_time, 'has_penalties': event.has_penalties, 'time': event.time,
+    }
+
+def event_score(event):
+    return (event.team1_goals, event.team2_goals, event.has_extra_time, event.has_penalties)
+
+
+######
+# Feed adapters
+
+class FeedAdapter:
+    """
+    The interface for score feeds. events() yields ScoreEvents in the order they happened, and may also yield None when time has
+    passed without any news (so that held scores can still be released). now() returns the current time on the feed's clock.
+    """
+
+    def events(self):
+        raise NotImplementedError
+
+    def now(self):
+        raise NotImplementedError
+
+class MemoryFeed(FeedAdapter):
+    """ A feed of a list of events, e.g. from simulate_matchday """
+
+    def __init__(self, events):
+        self.event_list = list(events)
+        self.last_time = None
+
+    def events(self):
+        for event in self.event_list:
+            self.last_time = event.time
+            yield event
+
+    def now(self):
+        return self.last_time
+
+class FileFeed(FeedAdapter):
+    """
+    Replays a feed saved as JSON lines, one event per line (see write_feed). With a speed, the events are replayed in real time
+    (speed 2 replays them twice as fast); otherwise as fast as possible. Lines which aren't valid events are logged and skipped.
+    """
+
+    def __init__(self, path, speed=0, sleep=time.sleep):
+        self.path = path
+        self.speed = speed
+        self.sleep = sleep
+        self.last_time = None
+
+    def events(self):
+        with open(self.path) as feed:
+            for line_number, line in enumerate(feed, 1):
+                if not line.strip():
+                    continue
+                try:
+                    event = event_from_dict(json.loads(line))
+                except ValueError as e:
+                    logger.warning("Skipping line {} of {}: {}".format(line_number, self.path, e))
+                    continue
+                if self.speed and self.last_time is not None and event.time > self.last_time:
+                    self.sleep((event.time - self.last_time) / self.speed)
+                self.last_time = event.time
+                yield event
+
+    def now(self):
+        return self.last_time
+
+class HttpFeed(FeedAdapter):
+    """
+    Polls a URL which returns a JSON list of events (typically the current score of every live fixture) every 'poll' seconds,
+    for 'polls' polls (or forever). Only changed scores are yielded, and events without a time are given the time they arrived.
+    fetch is the function used to get the response body for the URL; a stub can be passed in to simulate a feed.
+    """
+
+    def __init__(self, url, poll=30.0, polls=None, timeout=10.0, fetch=None, sleep=time.sleep, clock=time.time):
+        self.url = url
+        self.poll = poll
+        self.polls = polls
+        self.timeout = timeout
+        self.fetch = fetch or self.fetch_url
+        self.sleep = sleep
+        self.clock = clock
+
+    def fetch_url(self, url):
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return response.read().decode('utf-8')
+
+    def events(self):
+        scores = {} # fixture pk -> the last score yielded
+        polled = 0
+        while self.polls is None or polled < self.polls:
+            if polled:
+                self.sleep(self.poll)
+            polled += 1
+            try:
+                items = json.loads(self.fetch(self.url))
+                if not isinstance(items, list):
+                    raise ValueError("Expected a list of events")
+            except (OSError, ValueError) as e:
+                logger.warning("Couldn't read the score feed at {}: {}".format(self.url, e))
+                yield None
+                continue
+
+            arrived = self.clock()
+            for item in items:
+                try:
+                    event = event_from_dict(item, default_time=arrived)
+                except ValueError as e:
+                    logger.warning("Skipping event from {}: {}".format(self.url, e))
+                    continue
+                if scores.get(event.fixture_id) != event_score(event):
+                    scores[event.fixture_id] = event_score(event)
+                    yield event
+            yield None
+
+    def now(self):
+        return self.clock()
+
+
+######
+# Debouncing and applying the scores
+
+class Debouncer:
+    """
+    Collapses rapid successive score updates for each fixture. Only a fixture's latest score is kept, and it is released once the
+    fixture has had no updates for 'window' seconds, or 'max_wait' seconds after the first update held back, whichever is sooner.
+    A score which is the same as the last one released for the fixture (e.g. a goal which was disallowed) is dropped.
+    All times are on the feed's clock.
+    """
+
+    def __init__(self, window=DEBOUNCE_WINDOW, max_wait=DEBOUNCE_MAX_WAIT):
+        self.window = window
+        self.max_wait = max_wait
+        self.pending = {} # fixture pk -> (latest event, time of the first event held back)
+        self.released = {} # fixture pk -> the last score released
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, event):
+        held = self.pending.get(event.fixture_id)
+        self.pending[event.fixture_id] = (event, held[1] if held is not None else event.time)
+
+    def due(self, now):
+        """ Removes and returns the events which are ready to be recorded at the given time, oldest first """
+        ready = [
+            fixture_id for fixture_id, (event, first_time) in self.pending.items()
+            if now - event.time >= self.window or now - first_time >= self.max_wait
+        ]
+        return self.release(ready)
+
+    def flush(self):
+        """ Removes and returns all of the held events, e.g. when the feed ends """
+        return self.release(list(self.pending))
+
+    def release(self, fixture_ids):
+        events = []
+        for fixture_id in fixture_ids:
+            event, _ = self.pending.pop(fixture_id)
+            if self.released.get(fixture_id) != event_score(event):
+                self.released[fixture_id] = event_score(event)
+                events.append(event)
+        return sorted(events, key=lambda event: event.time)
+
+def apply_events(events):
+    """
+    Records the scores of a batch of events (at most one per fixture) with Fixture.objects.record_result, then processes the jobs
+    of the fixtures recorded (unless the process_results worker is doing so), refreshing the ranks once for the whole batch.
+    Fixtures blocked by an earlier failed job are left for the worker once the failure is retried (see tasks.retry_failed_jobs).
+    Events for unknown fixtures or with invalid scores are logged and skipped. Returns the number of results recorded and skipped.
+    """
+    from socapp.models import Fixture
+    from socapp import tasks
+    import socapp.ranking as ranking
+    recorded = rejected = 0
+    recorded_fixtures = []
+    for event in events:
+        try:
+            job = Fixture.objects.record_result(event.fixture_id, event.team1_goals, event.team2_goals,
+                                                has_extra_time=event.has_extra_time, has_penalties=event.has_penalties, process_jobs=False)
+        except (Fixture.DoesNotExist, ValidationError) as e:
+            logger.warning("Skipping score for fixture {}: {}".format(event.fixture_id, e))
+            rejected += 1
+            continue
+        if job is not None:
+            recorded += 1
+            recorded_fixtures.append(event.fixture_id)
+
+    if recorded_fixtures and not tasks.results_are_async():
+        # Loaded with their teams and tournaments in one query, which the jobs need
+        fixtures = Fixture.objects.in_bulk(recorded_fixtures)
+        processed = sum(tasks.process_fixture_jobs(fixtures[pk], refresh_ranks=False) for pk in recorded_fixtures)
+        if processed:
+            ranking.refresh_fixture_ranks(recorded_fixtures, tournaments=list({fixtures[pk].tournament_id for pk in recorded_fixtures}))
+    return recorded, rejected
+
+# Counts for a run of an Ingester
+IngestStats = namedtuple('IngestStats', ['events', 'recorded', 'rejected', 'batches'])
+
+class Ingester:
+    """
+    Reads a feed, debounces its events, and records the released scores in batches of up to batch_size.
+    Held scores are checked for release every check_interval seconds of the feed's clock (a third of the debounce window by default),
+    so scores which settle at about the same time are recorded together. All remaining scores are recorded when the feed ends.
+    """
+
+    def __init__(self, feed, window=DEBOUNCE_WINDOW, max_wait=DEBOUNCE_MAX_WAIT, batch_size=INGEST_BATCH_SIZE, check_interval=None):
+        self.feed = feed
+        self.debouncer = Debouncer(window, max_wait)
+        self.batch_size = batch_size
+        self.check_interval = window / 3 if check_interval is None else check_interval
+        self.events = self.recorded = self.rejected = self.batches = 0
+
+    def run(self):
+        """ Ingests the feed until it ends (or the process is interrupted). Returns the IngestStats. """
+        last_check = None
+        for event in self.feed.events():
+            if event is not None:
+                self.events += 1
+                self.debouncer.add(event)
+            now = self.feed.now()
+            if now is not None and (last_check is None or now - last_check >= self.check_interval):
+                last_check = now
+                self.apply(self.debouncer.due(now))
+        self.apply(self.debouncer.flush())
+        return self.stats()
+
+    def apply(self, events):
+        for batch in utils.chunked(events, self.batch_size):
+            recorded, rejected = apply_events(batch)
+            self.recorded += recorded
+            self.rejected += rejected
+            self.batches += 1
+
+    def stats(self):
+        return IngestStats(self.events, self.recorded, self.rejected, self.batches)
+
+
+######
+# Simulating a feed
+
+def simulate_matchday(fixtures, seed=None, repeat_rate=0.5, disallowed_rate=0.1):
+    """
+    Generates the score changes for a matchday's fixtures, as a live feed might send them: a 0-0 at kickoff, the goals at random
+    minutes, repeats of the same score a few seconds apart, the odd goal which is disallowed a minute later, and the final score.
+    Fixtures which can go beyond 90 minutes are sometimes drawn after 90 minutes, then go to extra time and maybe penalties.
+    Times are in seconds from the first kickoff. Returns the events in time order.
+    """
+    rng = random.Random(seed)
+    fixtures = list(fixtures)
+    first_kickoff = min((f.match_date for f in fixtures if f.match_date is not None), default=None)
+    events = []
+
+    def send(fixture, seconds, team1_goals, team2_goals, has_extra_time=False, has_penalties=False):
+        events.append(ScoreEvent(fixture.pk, team1_goals, team2_goals, has_extra_time, has_penalties, seconds))
+        if rng.random() < repeat_rate:
+            events.append(ScoreEvent(fixture.pk, team1_goals, team2_goals, has_extra_time, has_penalties, seconds + rng.randint(1, 10)))
+
+    for fixture in fixtures:
+        kickoff = (fixture.match_date - first_kickoff).total_seconds() if fixture.match_date is not None else 0.0
+        send(fixture, kickoff, 0, 0)
+
+        minutes = 90
+        goals = [0, 0]
+        goal_times = sorted((rng.randint(1, 90), rng.randint(0, 1)) for _ in range(rng.choice([0, 1, 1, 2, 2, 3, 3, 4, 5])))
+        extra_time = fixture.can_be_over_90 and (len(goal_times) % 2 == 0) and rng.random() < 0.5
+        if extra_time:
+            # Level after 90 minutes, then maybe a goal in extra time
+            goal_times = [(minute, i % 2) for i, (minute, _) in enumerate(goal_times)]
+            if rng.random() < 0.5:
+                goal_times.append((rng.randint(91, 120), rng.randint(0, 1)))
+            minutes = 120
+
+        for minute, team in goal_times:
+            seconds = kickoff + minute * 60
+            if rng.random() < disallowed_rate:
+                # The goal is given, then taken away a minute later
+                disallowed = list(goals)
+                disallowed[team] += 1
+                send(fixture, seconds, *disallowed, has_extra_time=minute > 90)
+                seconds += 60
+            goals[team] += 1
+            send(fixture, seconds, *goals, has_extra_time=minute > 90)
+
+        penalties = extra_time and goals[0] == goals[1]
+        send(fixture, kickoff + (minutes + 5) * 60, goals[0], goals[1], has_extra_time=extra_time, has_penalties=penalties)
+
+    return sorted(events, key=lambda event: event.time)
+
+def final_scores(events):
+    """ Returns a dictionary of fixture pk -> the last score sent for it, as (team1_goals, team2_goals, has_extra_time, has_penalties) """
+    return {event.fixture_id: event_score(event) for event in sorted(events, key=lambda event: event.time)}
+
+def write_feed(events, path):
+    """ Saves events as JSON lines, to be replayed by a FileFeed """
+    with open(path, 'w') as feed:
+        for event in events:
+            feed.write(json.dumps(event_to_dict(event)) + "\n")
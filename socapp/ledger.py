@@ -0,0 +1,111 @@
+from django.db import transaction
+from django.db.models import Sum
+
+from collections import defaultdict
+
+import socapp.utils as utils
+
+"""
+The points ledger: an append-only list of the points each scoring pass gives or takes away (PointsLedgerEntry).
+A user's TournamentPoints are the sum of their entries for the tournament, and their UserProfile.points the sum of all their
+entries. Scoring passes record their entries and apply the same deltas to the totals in one transaction, and the totals can be
+rebuilt from the ledger at any time with a GROUP BY, whatever order the passes ran in.
+"""
+
+def record(deltas, reason):
+    """
+    Appends entries to the ledger, in one bulk insert. deltas is a dictionary of (user pk, tournament pk, fixture pk) -> points,
+    where the fixture pk may be None. Entries for zero points aren't recorded.
+    """
+    from socapp.models import PointsLedgerEntry
+    entries = [
+        PointsLedgerEntry(user_id=user_pk, tournament_id=tournament_pk, fixture_id=fixture_pk, delta=delta, reason=reason)
+        for (user_pk, tournament_pk, fixture_pk), delta in deltas.items() if delta != 0
+    ]
+    PointsLedgerEntry.objects.bulk_create(entries, batch_size=utils.BULK_BATCH_SIZE)
+
+def tournament_totals(tournament=None, users=None):
+    """
+    Returns a dictionary of (user pk, tournament pk) -> the user's points in the tournament according to the ledger,
+    for the given tournament (or all tournaments) and users (a list of user pks, or all users). One GROUP BY query.
+    """
+    from socapp.models import PointsLedgerEntry
+    entries = PointsLedgerEntry.objects.all()
+    if tournament is not None:
+        entries = entries.filter(tournament=tournament)
+    if users is not None:
+        entries = entries.filter(user__in=users)
+    totals = entries.order_by().values_list('user', 'tournament').annotate(total=Sum('delta'))
+    return {(user_pk, tournament_pk): total for user_pk, tournament_pk, total in totals}
+
+def user_totals(users=None):
+    """ Returns a dictionary of user pk -> the user's overall points according to the ledger. One GROUP BY query. """
+    from socapp.models import PointsLedgerEntry
+    entries = PointsLedgerEntry.objects.all()
+    if users is not None:
+        entries = entries.filter(user__in=users)
+    return dict(entries.order_by().values_list('user').annotate(total=Sum('delta')))
+
+def rebuild_totals(tournament=None):
+    """
+    Rebuilds the users' TournamentPoints for the tournament (or every tournament) from the ledger, and the overall points of the
+    users involved. Rows are written grouped by value, missing rows are created and rows without any entries are set to zero.
+    Returns the number of TournamentPoints rows which were changed or created.
+    """
+    from socapp.models import Tournament
+    from socapp_auth.models import UserProfile, TournamentPoints
+    import socapp.ranking as ranking
+
+    with transaction.atomic():
+        totals = tournament_totals(tournament)
+        tournaments = [tournament.pk] if tournament is not None else list(Tournament.objects.values_list('pk', flat=True))
+        profiles = dict(UserProfile.objects.values_list('user_id', 'pk')) # user pk -> profile pk
+        users_by_profile = {profile_pk: user_pk for user_pk, profile_pk in profiles.items()}
+
+        changed = []
+        existing = TournamentPoints.objects.filter(tournament__in=tournaments).values_list('pk', 'user_id', 'tournament_id', 'points')
+        for pk, profile_pk, tournament_pk, points in existing:
+            total = totals.pop((users_by_profile[profile_pk], tournament_pk), 0)
+            if points != total:
+                changed.append(TournamentPoints(pk=pk, points=total))
+        utils.bulk_update(TournamentPoints, changed, ['points'])
+
+        missing = [
+            TournamentPoints(user_id=profiles[user_pk], tournament_id=tournament_pk, points=total)
+            for (user_pk, tournament_pk), total in totals.items() if user_pk in profiles
+        ]
+        TournamentPoints.objects.bulk_create(missing, batch_size=utils.BULK_BATCH_SIZE)
+
+        # Each user's overall points are the sum of all their entries, in every tournament
+        overall = user_totals()
+        profiles_to_update = [
+            UserProfile(pk=profile_pk, points=overall.get(user_pk, 0))
+            for user_pk, profile_pk, points in UserProfile.objects.values_list('user_id', 'pk', 'points')
+            if points != overall.get(user_pk, 0)
+        ]
+        utils.bulk_update(UserProfile, profiles_to_update, ['points'])
+
+    ranking.refresh_rank_snapshots()
+    return len(changed) + len(missing)
+
+def open_balances(users=None, reason=None):
+    """
+    Records an opening balance for every user (of the given list of user pks, or all users) and tournament whose TournamentPoints
+    don't match their ledger entries (e.g. points given before the ledger was kept), so that the ledger agrees with the stored totals.
+    The entries are recorded with the given reason (an opening balance by default). Returns the number of entries.
+    """
+    from socapp.models import PointsLedgerEntry
+    from socapp_auth.models import TournamentPoints
+    totals = tournament_totals(users=users)
+    tournament_pts = TournamentPoints.objects.all()
+    if users is not None:
+        tournament_pts = tournament_pts.filter(user__user__in=users)
+    deltas = {}
+    for user_pk, tournament_pk, points in tournament_pts.values_list('user__user_id', 'tournament_id', 'points'):
+        deltas[(user_pk, tournament_pk, None)] = points - totals.pop((user_pk, tournament_pk), 0)
+    # Entries for tournaments the user has no TournamentPoints row for
+    for (user_pk, tournament_pk), total in totals.items():
+        deltas[(user_pk, tournament_pk, None)] = -total
+
+    record(deltas, PointsLedgerEntry.REASON_OPENING if reason is None else reason)
+    return sum(1 for delta in deltas.values() if delta != 0)
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import datetime
+import time
+
+from socapp.models import Fixture
+from socapp import ingest
+
+class Command(BaseCommand):
+    help = 'Records fixture results from a live score feed: a JSON lines file, a URL to poll, or a simulated matchday'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--file', help="Replay a feed saved as JSON lines, one event per line")
+        source.add_argument('--url', help="Poll a URL returning a JSON list of events")
+        source.add_argument('--simulate', metavar='YYYY-MM-DD', help="Simulate a feed of the fixtures on the given day")
+
+        parser.add_argument('--speed', type=float, default=0, help="Replay the file in real time, this many times faster (0 replays it as fast as possible)")
+        parser.add_argument('--poll', type=float, default=30.0, help="Seconds between polls of the URL")
+        parser.add_argument('--polls', type=int, default=None, help="Stop after this many polls of the URL (by default, keep polling)")
+        parser.add_argument('--seed', type=int, default=None, help="Random seed for the simulated feed")
+        parser.add_argument('--save', help="Save the simulated feed to this file instead of recording it")
+        parser.add_argument('--window', type=float, default=ingest.DEBOUNCE_WINDOW, help="Seconds a fixture's score has to stay the same before it is recorded")
+        parser.add_argument('--max-wait', type=float, default=ingest.DEBOUNCE_MAX_WAIT, help="The most seconds a fixture's score is held back for")
+        parser.add_argument('--batch-size', type=int, default=ingest.INGEST_BATCH_SIZE, help="The most results recorded in one batch")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **options):
+        if options['file']:
+            feed = ingest.FileFeed(options['file'], speed=options['speed'])
+        elif options['url']:
+            feed = ingest.HttpFeed(options['url'], poll=options['poll'], polls=options['polls'])
+        else:
+            try:
+                day = datetime.datetime.strptime(options['simulate'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("Invalid date: {}".format(options['simulate']))
+            fixtures = list(Fixture.objects.on_day(day))
+            if not fixtures:
+                raise CommandError("No fixtures on {}".format(day))
+            events = ingest.simulate_matchday(fixtures, seed=options['seed'])
+            if options['save']:
+                ingest.write_feed(events, options['save'])
+                self.stdout.write("Saved {} event(s) for {} fixture(s) to {}".format(len(events), len(fixtures), options['save']))
+                return
+            feed = ingest.MemoryFeed(events)
+
+        ingester = ingest.Ingester(feed, window=options['window'], max_wait=options['max_wait'], batch_size=options['batch_size'])
+        started = time.time()
+        try:
+            ingester.run()
+        except KeyboardInterrupt:
+            ingester.apply(ingester.debouncer.flush())
+        stats = ingester.stats()
+        self.stdout.write("Ingested {} event(s) in {:.1f}s: {} result(s) recorded in {} batch(es), {} skipped".format(
+            stats.events, time.time() - started, stats.recorded, stats.batches, stats.rejected))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+import time
+
+from socapp import predictions
+
+class Command(BaseCommand):
+    help = 'Marks fixtures as locked once their prediction cutoff has passed. Run it periodically (e.g. from cron), or with --watch'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true', help="Keep running, sweeping every --sleep seconds")
+        parser.add_argument('--sleep', type=float, default=60.0, help="Seconds between sweeps when watching")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **options):
+        try:
+            while True:
+                locked = predictions.lock_due_fixtures()
+                if locked or not options['watch']:
+                    self.stdout.write("Locked {} fixture(s)".format(locked))
+                if not options['watch']:
+                    break
+                time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
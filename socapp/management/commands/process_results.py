@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+import time
+
+from socapp.models import ResultJob
+from socapp import tasks
+
+class Command(BaseCommand):
+    help = 'Worker which applies queued fixture results to the Team models and the users\' points'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Process the jobs currently in the queue, then exit")
+        parser.add_argument('--batch-size', type=int, default=100, help="Maximum number of jobs to process per batch")
+        parser.add_argument('--sleep', type=float, default=2.0, help="Seconds to wait before polling an empty queue again")
+        parser.add_argument('--retry-failed', action='store_true', help="Put failed jobs back in the queue before starting")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            retried = tasks.retry_failed_jobs()
+            self.stdout.write("{} failed job(s) put back in the queue".format(retried))
+
+        try:
+            while True:
+                processed = tasks.process_pending_jobs(limit=options['batch_size'])
+                if processed:
+                    self.stdout.write("Processed {} job(s)".format(processed))
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            pass
+
+        pending = ResultJob.objects.filter(status=ResultJob.STATUS_PENDING).count()
+        failed = ResultJob.objects.filter(status=ResultJob.STATUS_FAILED).count()
+        self.stdout.write("{} job(s) pending, {} failed".format(pending, failed))
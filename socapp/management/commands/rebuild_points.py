@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from socapp.models import Tournament
+from socapp import ledger
+
+class Command(BaseCommand):
+    help = 'Rebuilds users\' tournament and overall points from the points ledger'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tournament', type=int, help="Only rebuild the points for the tournament with this id")
+        parser.add_argument('--open-balances', action='store_true',
+                            help="First record opening balances, so the ledger agrees with the current totals (e.g. for points given before the ledger was kept)")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **options):
+        tournament = None
+        if options['tournament'] is not None:
+            try:
+                tournament = Tournament.objects.get(pk=options['tournament'])
+            except Tournament.DoesNotExist:
+                raise CommandError("No tournament with id {}".format(options['tournament']))
+
+        if options['open_balances']:
+            self.stdout.write("Recorded {} opening balance(s)".format(ledger.open_balances()))
+
+        changed = ledger.rebuild_totals(tournament)
+        self.stdout.write("Rebuilt points for {}: {} tournament total(s) changed".format(tournament or "all tournaments", changed))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth import get_user_model
+
+from socapp.models import Tournament
+from socapp import rescore
+from socapp.audit import AUDIT_CHUNK_SIZE
+
+class Command(BaseCommand):
+    help = 'Rescores every prediction in a tournament from scratch, and updates the users\' tournament and overall points to match'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tournament', type=int, help="The id of the tournament to rescore")
+        parser.add_argument('--dry-run', action='store_true', help="Report the changes without making them")
+        parser.add_argument('--workers', type=int, default=1, help="Number of processes to rescore the fixtures with")
+        parser.add_argument('--chunk-size', type=int, default=AUDIT_CHUNK_SIZE, help="Number of predictions to fetch from the database at a time")
+        parser.add_argument('--limit', type=int, default=50, help="Maximum number of users' changes to list")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **options):
+        try:
+            tournament = Tournament.objects.get(pk=options['tournament'])
+        except Tournament.DoesNotExist:
+            raise CommandError("No tournament with id {}".format(options['tournament']))
+
+        # The changes are only reported once they've been made
+        if options['dry_run']:
+            result = rescore.rescore_tournament(tournament, workers=options['workers'], chunk_size=options['chunk_size'])
+        else:
+            result = rescore.rescore_and_apply(tournament, workers=options['workers'], chunk_size=options['chunk_size'])
+
+        # The users whose points change the most are listed first
+        changed = sorted(result.totals.items(), key=lambda item: -abs(item[1][1] - (item[1][0] or 0)))
+        usernames = get_user_model().objects.in_bulk([user_id for user_id, _ in changed[:options['limit']]])
+        for user_id, (stored, new) in changed[:options['limit']]:
+            self.stdout.write("{}: {} -> {} ({:+d})".format(usernames[user_id], stored or 0, new, new - (stored or 0)))
+        if len(changed) > options['limit']:
+            self.stdout.write("... and {} more".format(len(changed) - options['limit']))
+
+        self.stdout.write("{}: {} of {} prediction(s) and {} user total(s) {}".format(
+            tournament, len(result.answer_changes), result.answers_checked, len(result.totals),
+            "would change (dry run)" if options['dry_run'] else "changed"))
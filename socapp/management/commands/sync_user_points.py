@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+from socapp import audit
+
+class Command(BaseCommand):
+    help = 'Checks users\' points (overall, per tournament and per prediction) against their predictions of the played fixtures, and optionally repairs them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help="Set any points which don't match to the expected values")
+        parser.add_argument('--workers', type=int, default=1, help="Number of processes to audit the users with, each taking a range of user ids")
+        parser.add_argument('--chunk-size', type=int, default=audit.AUDIT_CHUNK_SIZE, help="Number of rows to fetch from the database at a time")
+        parser.add_argument('--limit', type=int, default=50, help="Maximum number of discrepancies to list (all are counted and repaired)")
+
+    # This method is executed when the management command is run.
+    def handle(self, *args, **options):
+        discrepancies = audit.audit_all_users(workers=options['workers'], chunk_size=options['chunk_size'])
+
+        for discrepancy in discrepancies[:options['limit']]:
+            self.stdout.write(self.describe(discrepancy))
+        if len(discrepancies) > options['limit']:
+            self.stdout.write("... and {} more".format(len(discrepancies) - options['limit']))
+
+        counts = {kind: sum(1 for d in discrepancies if d.kind == kind) for kind in (audit.ANSWER, audit.USER, audit.TOURNAMENT)}
+        self.stdout.write("{} discrepancies: {} prediction(s), {} user total(s), {} tournament total(s)".format(
+            len(discrepancies), counts[audit.ANSWER], counts[audit.USER], counts[audit.TOURNAMENT]))
+
+        if discrepancies and options['repair']:
+            audit.repair_points(discrepancies)
+            self.stdout.write("Repaired {} discrepancies".format(len(discrepancies)))
+
+    def describe(self, discrepancy):
+        if discrepancy.kind == audit.ANSWER:
+            where = "prediction {}".format(discrepancy.answer_id)
+        elif discrepancy.kind == audit.TOURNAMENT:
+            where = "points in tournament {}".format(discrepancy.tournament_id)
+        else:
+            where = "total points"
+        return "User {}: {} is {}, but should be {}".format(discrepancy.user_id, where, discrepancy.stored, discrepancy.expected)
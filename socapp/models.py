@@ -2,11 +2,16 @@ from django.conf import settings
 from django.template.defaultfilters import slugify
 
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q, F, When, Case, Value, Sum
 from django.utils import timezone
 
 import socapp.utils as utils
+import socapp.ranking as ranking
+import socapp.cache as results_cache
+from socapp import scoring
+
+import copy, json
 
 class Team(models.Model):
     group_names = ["A","B","C","D","E","F","G","H"]
@@ -73,6 +78,27 @@ class Team(models.Model):
 
 ################################################################################
 
+# The points given for predictions in a tournament. Tournaments without a set of rules use scoring.DEFAULT_RULES.
+# The points for every scoreline are compiled into a lookup table when a set of rules is first used (see socapp/scoring.py).
+class ScoringRules(models.Model):
+    name = models.CharField(max_length=128, unique=True)
+    exact_score = models.IntegerField(default=scoring.DEFAULT_RULES.exact_score)
+    correct_outcome = models.IntegerField(default=scoring.DEFAULT_RULES.correct_outcome)
+    goals_bonus = models.IntegerField(default=scoring.DEFAULT_RULES.goals_bonus)
+    extra_time_correct = models.IntegerField(default=scoring.DEFAULT_RULES.extra_time_correct)
+    extra_time_wrong = models.IntegerField(default=scoring.DEFAULT_RULES.extra_time_wrong)
+    penalties_correct = models.IntegerField(default=scoring.DEFAULT_RULES.penalties_correct)
+    penalties_wrong = models.IntegerField(default=scoring.DEFAULT_RULES.penalties_wrong)
+
+    class Meta:
+        verbose_name_plural = "scoring rules"
+
+    def __str__(self):
+        return self.name
+
+    def as_rules(self):
+        return scoring.Rules(*(getattr(self, field) for field in scoring.Rules._fields))
+
 # Tournament container model
 class Tournament(models.Model):
     # LEAGUE = 1
@@ -89,6 +115,10 @@ class Tournament(models.Model):
     start_date = models.DateTimeField()
     winner = models.OneToOneField(Team, on_delete=models.SET_DEFAULT, default=None, null=True, blank=True)
     is_international = models.BooleanField(default=False)
+    # The time zone the tournament's days are counted in (e.g. for today's fixtures)
+    time_zone = models.CharField(max_length=64, default=settings.TIME_ZONE)
+    # The points system for the tournament's predictions (the default rules if not set)
+    scoring_rules = models.ForeignKey(ScoringRules, related_name="tournaments", null=True, blank=True, on_delete=models.SET_NULL)
     # best_user = models.OneToOneField(User)
 
     def __str__(self):
@@ -106,9 +136,9 @@ class Tournament(models.Model):
             raise ValidationError("Invalid group name supplied")
         return self.get_fixtures().filter((Q(team1__group=group) | Q(team2__group=group)) & Q(stage=Fixture.GROUP))
     
-    def todays_fixtures(self):
-        year, month, day = timezone.now().year, timezone.now().month, timezone.now().day   
-        fixtures = self.get_fixtures().filter(match_date__year=year, match_date__month=month, match_date__day=day)
+    # Gets the tournament's fixtures for the current day in its time zone, or None if there are none
+    def todays_fixtures(self, now=None):
+        fixtures = self.get_fixtures().on_day(utils.local_today(self.time_zone, now), self.time_zone)
         return fixtures or None
     
     def completed_fixtures(self):
@@ -120,9 +150,26 @@ class Tournament(models.Model):
     def get_next_games(self, number=5):
         return self.unplayed_fixtures()[:number]
 
+    # Fixtures in this tournament which can still be predicted
+    def open_fixtures(self, now=None):
+        return self.get_fixtures().open(now)
+
     def get_last_results(self, number=5):
         return self.completed_fixtures().reverse()[:number]
 
+    # Returns a dictionary whose keys are the groups and whose values are the group's standings, in position order
+    def group_standings(self):
+        standings = list(GroupStanding.objects.filter(tournament=self).select_related('team'))
+        if not standings:
+            # The standings have never been built for this tournament (e.g. the results were loaded before they existed)
+            utils.rebuild_group_standings(self)
+            standings = list(GroupStanding.objects.filter(tournament=self).select_related('team'))
+
+        tables = {}
+        for standing in standings:
+            tables.setdefault(standing.group, []).append(standing)
+        return tables
+
     # Returns users ordered by the points they've gained in this tournament
     def get_ranked_users(self):
         return self.userprofile_set.select_related('user').order_by('-tournament_pts__points')
@@ -132,15 +179,89 @@ class Tournament(models.Model):
 
 ################################################################################
 
+class FixtureQuerySet(models.QuerySet):
+    # Fixtures which can still be predicted (their locks_at time is still to come)
+    def open(self, now=None):
+        return self.filter(locks_at__gt=now or timezone.now())
+
+    # Fixtures which can no longer be predicted, including any without a match date
+    def locked(self, now=None):
+        return self.filter(Q(locks_at__lte=now or timezone.now()) | Q(locks_at__isnull=True))
+
+    # Annotates each fixture with predictions_open, so templates don't need to work out the cutoff for every row
+    def with_open_flag(self, now=None):
+        return self.annotate(predictions_open=Case(When(locks_at__gt=now or timezone.now(), then=Value(True)), default=Value(False), output_field=models.BooleanField()))
+
+    # Fixtures kicking off from start up to (but not including) end. A plain range on match_date, so it can use its indexes.
+    def between(self, start, end):
+        return self.filter(match_date__gte=start, match_date__lt=end)
+
+    # Fixtures kicking off on the given date in the given time zone (a tzinfo or a name, e.g. 'Europe/London').
+    # Defaults to the current time zone (settings.TIME_ZONE unless another has been activated).
+    def on_day(self, day, tz=None):
+        start, end = utils.day_bounds(day, tz)
+        return self.between(start, end)
+
+    # Keeps locks_at and is_locked in step with match_date when fixtures are rescheduled in bulk
+    # (so fixtures moved later are unlocked again, since the sweeper only ever locks them)
+    def update(self, **kwargs):
+        from socapp import predictions
+        if 'match_date' in kwargs and 'locks_at' not in kwargs:
+            kwargs['locks_at'] = predictions.lock_time(kwargs['match_date'])
+        if 'locks_at' in kwargs and 'is_locked' not in kwargs:
+            kwargs['is_locked'] = kwargs['locks_at'] is None or kwargs['locks_at'] <= timezone.now()
+        return super().update(**kwargs)
+
+    # The columns needed to record a result without loading the whole fixture (see record_result)
+    RESULT_COLUMNS = ('tournament_id', 'team1_id', 'team2_id', 'stage', 'team1_goals', 'team2_goals', 'can_be_over_90',
+                      'has_extra_time', 'has_penalties', 'team1_penalties', 'team2_penalties')
+
+    # A lighter alternative to Fixture.save for recording a result (e.g. from a live scores feed): locks the fixture's row with
+    # SELECT ... FOR UPDATE of only its result columns, writes the new result with an UPDATE, and queues the change to the teams and
+    # points (none -> result, result -> result or result -> none) in the same transaction, so results recorded at the same time are
+    # applied in order. Skips full_clean and the Fixture.save reload. Passing None for both teams' goals removes the result.
+    # Returns the ResultJob, or None if the result hasn't changed. Raises ValidationError for an incomplete or negative score.
+    # Pass process_jobs=False to leave the job in the queue, e.g. to process a batch of results together (see socapp/ingest.py).
+    def record_result(self, pk, team1_goals, team2_goals, has_extra_time=False, has_penalties=False, team1_penalties=None, team2_penalties=None,
+                      process_jobs=True):
+        from socapp import tasks
+        if (team1_goals is None) != (team2_goals is None):
+            raise ValidationError("Goals must be added for both teams in the fixture")
+        if team1_goals is None:
+            has_extra_time = has_penalties = False
+            team1_penalties = team2_penalties = None
+        elif team1_goals < 0 or team2_goals < 0:
+            raise ValidationError("Goals cannot be negative")
+
+        result = {
+            'team1_goals': team1_goals, 'team2_goals': team2_goals, 'has_extra_time': bool(has_extra_time),
+            'has_penalties': bool(has_penalties), 'team1_penalties': team1_penalties, 'team2_penalties': team2_penalties,
+        }
+        with transaction.atomic():
+            prev_fixture = Fixture(pk=pk, **self.select_related(None).select_for_update().filter(pk=pk).values(*self.RESULT_COLUMNS).get())
+            fixture = copy.copy(prev_fixture)
+            for field, value in result.items():
+                setattr(fixture, field, value)
+            fixture.status = Fixture.MATCH_STATUS_PLAYED if fixture.has_result() else Fixture.MATCH_STATUS_NOT_PLAYED
+
+            job = tasks.create_result_job(prev_fixture, fixture)
+            if job is None:
+                return None
+            self.filter(pk=pk).update(status=fixture.status, **result)
+
+        if process_jobs and not tasks.results_are_async():
+            # The jobs update the teams and score the predictions, so need the fixture's teams and tournament (loaded in one query)
+            tasks.process_fixture_jobs(self.model.objects.get(pk=pk))
+        results_cache.bump_results_version()
+        return job
+
 # Override Fixture's normal 'objects' Manager to automatically query for tournament and team info when a Fixture is loaded from the DB
-class FixtureManager(models.Manager):
+class FixtureManager(models.Manager.from_queryset(FixtureQuerySet)):
     def get_queryset(self):
-        return super().get_queryset().select_related('tournament', 'team1', 'team2')
+        return super().get_queryset().select_related('tournament__scoring_rules', 'team1', 'team2')
 
 class Fixture(models.Model):
 
-    """ TO DO: figure out best indexes for Fixture model. Tournament? """
-
     objects = FixtureManager() # Set objects to the above manager
 
     # Constants to determine if the match has been played, or not.
@@ -177,6 +298,11 @@ class Fixture(models.Model):
     match_date = models.DateTimeField(null=True, blank=True)
     status = models.BooleanField(choices=MATCH_STATUS_CHOICES, default=MATCH_STATUS_NOT_PLAYED)
 
+    # When predictions for the fixture close (see predictions.PREDICTION_CUTOFF). Set from match_date whenever the fixture is saved.
+    locks_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # Set by the lock_fixtures sweeper once locks_at has passed. locks_at itself is what decides whether predictions are accepted.
+    is_locked = models.BooleanField(default=False, editable=False)
+
     # Could compare current-date to the match-date to determine whether or not the stage = PLAYED, or NOT PLAYED
     stage = models.IntegerField(choices=STAGE_CHOICES, default=GROUP)
     team1_goals = models.PositiveIntegerField(null=True, blank=True)
@@ -231,6 +357,9 @@ class Fixture(models.Model):
     def is_international(self):
         return self.tournament.is_international
 
+    def is_open(self, now=None):
+        return self.locks_at is not None and (now or timezone.now()) < self.locks_at
+
     #################################
     ### STATIC METHODS
     #################################
@@ -245,11 +374,10 @@ class Fixture(models.Model):
     def all_completed_fixtures():
         return Fixture.objects.filter(status=Fixture.MATCH_STATUS_PLAYED)
     
-    # Gets all fixtures for the current day, or None if there are none
+    # Gets all fixtures for the current day in the given time zone (the current time zone by default), or None if there are none
     @staticmethod
-    def todays_fixtures():
-        current_year, current_month, current_day = timezone.now().year, timezone.now().month, timezone.now().day   
-        fixtures = Fixture.objects.filter(match_date__month=current_month, match_date__day=current_day)
+    def todays_fixtures(tz=None, now=None):
+        fixtures = Fixture.objects.on_day(utils.local_today(tz, now), tz)
         return fixtures or None
 
 
@@ -258,6 +386,7 @@ class Fixture(models.Model):
     #################################
 
     def save(self, *args, **kwargs):
+        from socapp import tasks
         self.full_clean()
         # Update status field based on whether or not there are goals for each team in the fixture
         if self.has_result():
@@ -265,34 +394,14 @@ class Fixture(models.Model):
         if not self.has_result():
             self.status = Fixture.MATCH_STATUS_NOT_PLAYED
 
-        # Update Team, User and Answer models based on the contents of the save.
-        if self.pk is not None:
-            prev_fixture = Fixture.objects.get(pk=self.pk)
-            if not prev_fixture.has_result() and not self.has_result():
-                pass
-            else:
-                if prev_fixture.has_result() and not self.has_result():
-                    # Previously there was a result, now there's none: so remove the team/user data for the previous result
-                    utils.remove_team_data(prev_fixture, self.team1)
-                    utils.remove_team_data(prev_fixture, self.team2)
-                    utils.update_user_pts(prev_fixture=prev_fixture, remove=True)
-                elif not prev_fixture.has_result():
-                    # Simply add the team data, since previously there was no result.
-                    utils.add_team_data(self, self.team1)
-                    utils.add_team_data(self, self.team2)
-                    utils.update_user_pts(saved_fixture=self, add=True)
-                else:
-                    # Result already exists, so this save represents an update. Gather previous fixture data, and find differences
-                    utils.update_team_data(prev_fixture, self, self.team1)
-                    utils.update_team_data(prev_fixture, self, self.team2)
-                    utils.update_user_pts(prev_fixture=prev_fixture, saved_fixture=self, update=True)
-        else:
-            if self.has_result():
-                    utils.add_team_data(self, self.team1)
-                    utils.add_team_data(self, self.team2)
-                    utils.update_user_pts(saved_fixture=self, add=True)
+        prev_fixture = Fixture.objects.get(pk=self.pk) if self.pk is not None else None
         super().save(*args, **kwargs)
 
+        # Queue up the changes to the Team, User and Answer models based on the contents of the save.
+        # Depending on the RESULT_JOBS_ASYNC setting, the job is either processed right away, or by the process_results worker.
+        tasks.enqueue_result_change(prev_fixture, self)
+        results_cache.bump_results_version() # Fixture lists, tables etc. may have changed
+
     def clean(self):
         # Prevent the same team being assigned to team1 and team2 (example: Brazil vs Brazil)
         if self.team1 == self.team2:
@@ -323,7 +432,155 @@ class Fixture(models.Model):
     
     class Meta:
         ordering = ['match_date']
+        indexes = [
+            models.Index(fields=['tournament', 'stage', 'match_date']), # A tournament's fixtures for a stage, in date order
+            models.Index(fields=['status', 'match_date']), # The next/last fixtures to be played
+            models.Index(fields=['tournament', 'locks_at']), # A tournament's open fixtures
+            models.Index(fields=['is_locked', 'locks_at']), # Fixtures for the sweeper to lock
+        ]
+
+
+
+# A team's position in its group table for a tournament. 
+# Maintained incrementally whenever a group stage result changes (see utils.update_group_standings), so group tables can be read without recalculating them.
+class GroupStanding(models.Model):
+    tournament = models.ForeignKey(Tournament, related_name="standings", on_delete=models.CASCADE)
+    team = models.ForeignKey(Team, related_name="standings", on_delete=models.CASCADE)
+    group = models.CharField(max_length=1, choices=Team.CHOICES)
+    position = models.PositiveIntegerField(default=0)
+
+    played = models.IntegerField(default=0)
+    won = models.IntegerField(default=0)
+    drawn = models.IntegerField(default=0)
+    lost = models.IntegerField(default=0)
+    goals_for = models.IntegerField(default=0)
+    goals_against = models.IntegerField(default=0)
+    goal_difference = models.IntegerField(default=0)
+    points = models.IntegerField(default=0)
+
+    # Ordering used to determine the positions in the group: points, then goal difference, then goals scored.
+    TIE_BREAK_ORDERING = ['-points', '-goal_difference', '-goals_for', 'team__name']
 
+    def __str__(self):
+        return "Group {} #{}: {}".format(self.group, self.position, self.team)
+
+    class Meta:
+        unique_together = ('tournament', 'team')
+        ordering = ['group', 'position']
+        indexes = [
+            models.Index(fields=['tournament', 'group', 'position']),
+        ]
+
+
+# A change to a fixture's result which still has to be propagated to the Team models and the users' points.
+# Jobs are created by Fixture.save, and processed in order for each fixture (see socapp/tasks.py).
+class ResultJob(models.Model):
+    STATUS_PENDING = 0
+    STATUS_PROCESSED = 1
+    STATUS_FAILED = 2
+
+    STATUS_CHOICES = (
+        (STATUS_PENDING, "Pending"),
+        (STATUS_PROCESSED, "Processed"),
+        (STATUS_FAILED, "Failed")
+    )
+
+    # Number of times a job is attempted before it is marked as failed
+    MAX_ATTEMPTS = 3
+
+    # The fixture fields which are needed to apply a result
+    RESULT_FIELDS = ('team1_goals', 'team2_goals', 'has_extra_time', 'has_penalties', 'can_be_over_90')
+
+    fixture = models.ForeignKey(Fixture, related_name="result_jobs", on_delete=models.CASCADE)
+    # JSON snapshots of the fixture's result before and after the change. The previous result is blank for a new fixture.
+    prev_result = models.TextField(blank=True)
+    result = models.TextField()
+
+    status = models.IntegerField(choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return "{}: {}".format(self.fixture, self.get_status_display())
+
+    # Serializes the result of the fixture passed in
+    @staticmethod
+    def snapshot(fixture):
+        if fixture is None:
+            return ""
+        return json.dumps({field: getattr(fixture, field) for field in ResultJob.RESULT_FIELDS}, sort_keys=True)
+
+    # Returns a copy of the fixture passed in, with its result set from the given snapshot (or None if the snapshot is blank)
+    @staticmethod
+    def fixture_state(fixture, snapshot):
+        if not snapshot:
+            return None
+        state = copy.copy(fixture)
+        for field, value in json.loads(snapshot).items():
+            setattr(state, field, value)
+        state.status = Fixture.MATCH_STATUS_PLAYED if state.has_result() else Fixture.MATCH_STATUS_NOT_PLAYED
+        return state
+
+    def prev_fixture(self, fixture=None):
+        return self.fixture_state(fixture or self.fixture, self.prev_result)
+
+    def saved_fixture(self, fixture=None):
+        return self.fixture_state(fixture or self.fixture, self.result)
+
+    class Meta:
+        ordering = ['id']
+
+
+# An append-only record of a change to a user's points from one fixture. Every scoring pass records the points it gives or takes away,
+# so a user's overall and per-tournament totals are the sums of their entries, and can be rebuilt from them (see socapp/ledger.py).
+class PointsLedgerEntry(models.Model):
+    REASON_RESULT = 0 # Points given for a new result
+    REASON_CORRECTION = 1 # The difference made by a change to a result
+    REASON_REMOVED = 2 # Points taken away when a result is removed
+    REASON_REPAIR = 3 # Adjustment made when repairing totals which didn't match the predictions
+    REASON_OPENING = 4 # Points given before the ledger was kept
+    REASON_RESCORE = 5 # The difference made by rescoring a whole tournament
+
+    REASON_CHOICES = (
+        (REASON_RESULT, "Result"),
+        (REASON_CORRECTION, "Result corrected"),
+        (REASON_REMOVED, "Result removed"),
+        (REASON_REPAIR, "Repair"),
+        (REASON_OPENING, "Opening balance"),
+        (REASON_RESCORE, "Tournament rescored"),
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="points_ledger", on_delete=models.CASCADE)
+    tournament = models.ForeignKey(Tournament, related_name="points_ledger", on_delete=models.CASCADE)
+    # Kept when the fixture is deleted, since the entries for removing its points still count towards the totals
+    fixture = models.ForeignKey(Fixture, related_name="points_ledger", null=True, blank=True, on_delete=models.SET_NULL)
+    delta = models.IntegerField()
+    reason = models.IntegerField(choices=REASON_CHOICES)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{}: {:+d} ({})".format(self.user, self.delta, self.get_reason_display())
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['tournament', 'user']), # Summing users' points for a tournament
+            models.Index(fields=['user', 'tournament']), # Summing a user's points
+        ]
+
+
+# The "results version": a number which goes up whenever anything shown on the read-heavy pages may have changed
+# (a fixture is saved, a scoring pass runs, leaderboard members change...). Cached data and template fragments are keyed
+# by it, so bumping it invalidates them all at once (see socapp/cache.py). There is only ever one row.
+class ResultsVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+    # Bumped when users join or leave the site, which only changes the global board (see cache.global_board_version)
+    board_members_version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "Results version {}".format(self.version)
 
 
 ######################################################
@@ -368,6 +625,9 @@ class Answer(models.Model):
     class Meta:
         # A user should only be able to submit one scoreline prediction per fixture
         unique_together = ('user', 'fixture')
+        indexes = [
+            models.Index(fields=['fixture', 'points_added']), # The answers to be scored (or unscored) when a result changes
+        ]
 
 
 class Leaderboard(models.Model):
@@ -418,22 +678,66 @@ class Leaderboard(models.Model):
         return self.users.all().select_related('profile').order_by("-profile__points")
 
 
+    # The board's stats (see ranking.board_stats), which are cached until the next scoring pass
+    def stats(self):
+        return ranking.board_stats(leaderboard=self)
+
     def total_points(self):
-        return self.get_members().aggregate(tp=Sum('profile__points'))['tp']
+        return self.stats()['total_points']
 
     def num_members(self):
-        return self.get_members().count()
+        return self.stats()['members_count']
 
     def avg_points_per_user(self):
-        num_members = self.num_members()
-        if num_members > 0:
-            return self.total_points() / self.num_members()
+        if self.num_members() > 0:
+            return self.stats()['average_points']
     
     def percent_above_avg_points(self):
-        average_points = self.avg_points_per_user()
-        num_members = self.num_members()
-        if num_members > 0:
-            return self.get_members().filter(profile__points__gte=average_points).count()*100 / num_members
+        if self.num_members() > 0:
+            return self.stats()['percent_above_average']
+
+
+# A user's stored rank on a board: the global board, a tournament's board, or a leaderboard.
+# Snapshots are updated after each scoring pass (see ranking.refresh_rank_snapshots), so pages can read ranks instead of recalculating them.
+# The rank from the previous snapshot is kept, to show how far users have moved.
+class UserRankSnapshot(models.Model):
+    SCOPE_GLOBAL = 0
+    SCOPE_TOURNAMENT = 1
+    SCOPE_LEADERBOARD = 2
+
+    SCOPE_CHOICES = (
+        (SCOPE_GLOBAL, "Global"),
+        (SCOPE_TOURNAMENT, "Tournament"),
+        (SCOPE_LEADERBOARD, "Leaderboard")
+    )
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, related_name="rank_snapshots", on_delete=models.CASCADE)
+    scope = models.IntegerField(choices=SCOPE_CHOICES, default=SCOPE_GLOBAL)
+    tournament = models.ForeignKey(Tournament, null=True, blank=True, related_name="rank_snapshots", on_delete=models.CASCADE)
+    leaderboard = models.ForeignKey(Leaderboard, null=True, blank=True, related_name="rank_snapshots", on_delete=models.CASCADE)
+
+    points = models.IntegerField(default=0)
+    rank = models.PositiveIntegerField()
+    previous_rank = models.PositiveIntegerField(null=True, blank=True) # None if the user wasn't on the board in the previous snapshot
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "{}: #{} ({})".format(self.user, self.rank, self.get_scope_display())
+
+    # Number of places the user has climbed since the previous snapshot (negative if they've dropped)
+    @property
+    def movement(self):
+        if self.previous_rank is None:
+            return 0
+        return self.previous_rank - self.rank
+
+    class Meta:
+        # Rows with a NULL tournament/leaderboard don't clash in the database, so uniqueness of the global board is kept by refresh_rank_snapshots
+        unique_together = ('scope', 'tournament', 'leaderboard', 'user')
+        ordering = ['rank']
+        indexes = [
+            models.Index(fields=['scope', 'tournament', 'leaderboard', 'rank']),
+        ]
 
 
 ###############################
@@ -0,0 +1,114 @@
+from django.db import transaction
+from django.utils import timezone
+
+import datetime
+
+import socapp.utils as utils
+import socapp.cache as results_cache
+
+"""
+Submission of users' predictions (Answers) in bulk.
+A whole stage's predictions are checked against the fixtures (loaded in one query) and written with a single
+bulk insert for the new ones and grouped updates for the changed ones, in one transaction.
+"""
+
+# Predictions can be made/changed until this long before kickoff
+PREDICTION_CUTOFF = datetime.timedelta(minutes=75)
+
+# The outcome of each prediction in a submission
+CREATED = 'created'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+REJECTED_LOCKED = 'locked' # Too close to (or after) kickoff
+REJECTED_INCOMPLETE = 'incomplete' # Goals missing for one or both teams
+REJECTED_UNKNOWN_FIXTURE = 'unknown_fixture'
+
+ACCEPTED = (CREATED, UPDATED, UNCHANGED)
+
+PREDICTION_FIELDS = ('team1_goals', 'team2_goals', 'has_extra_time', 'has_penalties')
+
+def lock_time(match_date):
+    """ Returns when predictions close for a fixture kicking off at match_date (None if it has no date yet) """
+    if match_date is None:
+        return None
+    return match_date - PREDICTION_CUTOFF
+
+def can_edit_prediction(fixture, now=None):
+    """ Returns whether predictions for the fixture can still be made/changed """
+    return fixture.is_open(now)
+
+def lock_due_fixtures(now=None):
+    """
+    Marks the fixtures whose cutoff has passed as locked, in one UPDATE, and returns how many there were.
+    The cached pages are invalidated when any fixture locks, so they stop offering predictions for it.
+    """
+    from socapp.models import Fixture
+    locked = Fixture.objects.filter(is_locked=False).locked(now).update(is_locked=True)
+    if locked:
+        results_cache.bump_results_version()
+    return locked
+
+def prediction_values(prediction):
+    """
+    Returns the Answer field values of a prediction (a dictionary with the PREDICTION_FIELDS), with the
+    extra time/penalties flags defaulting to False. Predicting penalties implies predicting extra time.
+    """
+    values = {field: prediction.get(field) for field in PREDICTION_FIELDS}
+    values['has_extra_time'] = bool(values['has_extra_time'])
+    values['has_penalties'] = bool(values['has_penalties'])
+    if values['has_penalties']:
+        values['has_extra_time'] = True
+    return values
+
+def submit_predictions(user, predictions, now=None, fixtures=None):
+    """
+    Saves a user's predictions. 'predictions' is a list of dictionaries, each with a 'fixture' (a Fixture or its pk)
+    and the PREDICTION_FIELDS. Predictions for fixtures which are locked, or with goals missing, are rejected.
+    If a queryset of fixtures is given, predictions for any other fixture are rejected as unknown.
+    Returns a dictionary of fixture pk -> the status of its prediction (CREATED, UPDATED, UNCHANGED or a REJECTED_* status).
+    Uses a fixed number of queries however many predictions there are: one for the fixtures, one for the user's existing
+    answers, a bulk insert, and one update per distinct set of changed values.
+    """
+    from socapp.models import Fixture, Answer
+    if now is None:
+        now = timezone.now()
+
+    fixture_ids = [getattr(p['fixture'], 'pk', p['fixture']) for p in predictions]
+    if fixtures is None:
+        fixtures = Fixture.objects.all()
+    fixtures = fixtures.in_bulk(fixture_ids)
+
+    statuses = {}
+    accepted = {}
+    for fixture_id, prediction in zip(fixture_ids, predictions):
+        fixture = fixtures.get(fixture_id)
+        values = prediction_values(prediction)
+        if fixture is None:
+            statuses[fixture_id] = REJECTED_UNKNOWN_FIXTURE
+        elif values['team1_goals'] is None or values['team2_goals'] is None:
+            statuses[fixture_id] = REJECTED_INCOMPLETE
+        elif not can_edit_prediction(fixture, now):
+            statuses[fixture_id] = REJECTED_LOCKED
+        else:
+            accepted[fixture_id] = values
+
+    with transaction.atomic():
+        existing = {answer.fixture_id: answer for answer in Answer.objects.filter(user=user, fixture__in=list(accepted))}
+        new_answers, changed_answers = [], []
+        for fixture_id, values in accepted.items():
+            answer = existing.get(fixture_id)
+            if answer is None:
+                new_answers.append(Answer(user=user, fixture_id=fixture_id, **values))
+                statuses[fixture_id] = CREATED
+            elif any(getattr(answer, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(answer, field, value)
+                changed_answers.append(answer)
+                statuses[fixture_id] = UPDATED
+            else:
+                statuses[fixture_id] = UNCHANGED
+
+        Answer.objects.bulk_create(new_answers, batch_size=utils.BULK_BATCH_SIZE)
+        utils.bulk_update(Answer, changed_answers, PREDICTION_FIELDS)
+
+    return statuses
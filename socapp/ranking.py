@@ -0,0 +1,398 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q, F, Count, Value, IntegerField, Subquery
+from django.db.models.functions import Coalesce
+
+from itertools import groupby
+
+import socapp.cache as results_cache
+
+"""
+Ranking of users by their points.
+A user's rank is found by counting the users with more points than them, which is a single 'COUNT(*) ... WHERE points > x'
+on an indexed column, instead of loading and sorting every user in Python.
+Rankings can be global or for a single tournament, and can be restricted to a subset of users (e.g. a user and their friends).
+The ranks on the global, tournament and leaderboard boards are also stored as UserRankSnapshots after each scoring pass,
+so that pages showing ranks (and how far users have moved) only have to read them.
+"""
+
+# Competition ranking ("1224"): users with equal points share a rank, and the next rank skips the tied places.
+COMPETITION = 'competition'
+# Dense ranking ("1223"): users with equal points share a rank, and the next rank follows on directly.
+DENSE = 'dense'
+
+RANKING_METHODS = (COMPETITION, DENSE)
+
+def points_queryset(tournament=None):
+    """
+    Returns the queryset holding users' points, with a 'points' field: the UserProfile table for overall points,
+    or the TournamentPoints table for a single tournament.
+    """
+    from socapp_auth.models import UserProfile, TournamentPoints
+    if tournament is None:
+        return UserProfile.objects.all()
+    return TournamentPoints.objects.filter(tournament=tournament)
+
+def restrict_to_users(points_qs, users, tournament=None):
+    """ Restricts a queryset from points_queryset() to the given users (a queryset or list of User instances/pks) """
+    user_field = 'user' if tournament is None else 'user__user'
+    return points_qs.filter(**{user_field + '__in': users})
+
+def friends_of(profile):
+    """ Returns a queryset of the pks of the profile's user and their friends, to use as the 'users' of a ranking """
+    User = get_user_model()
+    return User.objects.filter(Q(pk__in=profile.friends.values('pk')) | Q(pk=profile.user_id)).values('pk')
+
+def user_points_expression(user_id, tournament=None):
+    """ An expression for the user's current points, read from the database (users without TournamentPoints have 0 points) """
+    user_field = 'user' if tournament is None else 'user__user'
+    points = points_queryset(tournament).filter(**{user_field: user_id}).values('points')[:1]
+    return Coalesce(Subquery(points, output_field=IntegerField()), Value(0))
+
+def rank_for_points(points, tournament=None, users=None, method=COMPETITION):
+    """
+    Returns the rank that a user with the given points (an int, or an expression) has in the ranking:
+    one more than the number of users (or, for dense rankings, distinct points totals) above them.
+    """
+    if method not in RANKING_METHODS:
+        raise ValueError("Unknown ranking method '{}'".format(method))
+
+    points_qs = points_queryset(tournament)
+    if users is not None:
+        points_qs = restrict_to_users(points_qs, users, tournament)
+
+    above = points_qs.filter(points__gt=points)
+    if method == DENSE:
+        return above.aggregate(n=Count('points', distinct=True))['n'] + 1
+    return above.count() + 1
+
+def user_rank(profile, tournament=None, friends=False, method=COMPETITION):
+    """
+    Returns the profile's rank among all users, or among the user and their friends if 'friends' is set.
+    If a tournament is given, users are ranked by their points in that tournament only.
+    The user's points are read in the same query, so the profile instance doesn't need to be up to date.
+    """
+    users = friends_of(profile) if friends else None
+    return rank_for_points(user_points_expression(profile.user_id, tournament), tournament=tournament, users=users, method=method)
+
+######
+# Stored rank snapshots
+
+def snapshot_board(tournament=None, leaderboard=None):
+    """ Returns the UserRankSnapshot fields identifying a board: a leaderboard, a tournament, or (if neither is given) the global board """
+    from socapp.models import UserRankSnapshot
+    if leaderboard is not None:
+        return {'scope': UserRankSnapshot.SCOPE_LEADERBOARD, 'tournament': None, 'leaderboard': leaderboard}
+    if tournament is not None:
+        return {'scope': UserRankSnapshot.SCOPE_TOURNAMENT, 'tournament': tournament, 'leaderboard': None}
+    return {'scope': UserRankSnapshot.SCOPE_GLOBAL, 'tournament': None, 'leaderboard': None}
+
+def competition_ranks(rows):
+    """ Takes (user_id, points) pairs ordered by points, highest first, and yields (user_id, points, rank) with competition ranking """
+    rank = 0
+    prev_points = None
+    for position, (user_id, points) in enumerate(rows, start=1):
+        if points != prev_points:
+            rank, prev_points = position, points
+        yield user_id, points, rank
+
+def write_snapshot(board, rows):
+    """
+    Stores the ranking of (user_id, points) rows, ordered by points, as the board's snapshot. Only the rows of users whose
+    points or rank have changed (keeping the rank they had as their previous rank), who are new to the board, or who have
+    left it are written, with one DELETE and one INSERT however many there are. The other users' rows are left as they are,
+    so the movement shown for each user is that of the last scoring pass which moved them.
+    Returns True if any row was written.
+    """
+    from socapp.models import UserRankSnapshot
+    import socapp.utils as utils
+    stored = UserRankSnapshot.objects.filter(**board)
+    current = {user_id: (pk, points, rank) for pk, user_id, points, rank in stored.values_list('pk', 'user_id', 'points', 'rank')}
+
+    stale, written = [], []
+    for user_id, points, rank in competition_ranks(rows):
+        pk, stored_points, stored_rank = current.pop(user_id, (None, None, None))
+        if pk is not None and (stored_points, stored_rank) == (points, rank):
+            continue
+        if pk is not None:
+            stale.append(pk)
+        written.append(UserRankSnapshot(user_id=user_id, points=points, rank=rank, previous_rank=stored_rank, **board))
+    # Whoever is left in 'current' is no longer on the board
+    stale.extend(pk for pk, _, _ in current.values())
+
+    for chunk in utils.chunked(stale, utils.BULK_BATCH_SIZE):
+        UserRankSnapshot.objects.filter(pk__in=chunk).delete()
+    UserRankSnapshot.objects.bulk_create(written, batch_size=utils.BULK_BATCH_SIZE)
+    return bool(stale or written)
+
+def affected_leaderboards(fixtures):
+    """
+    Returns the pks of the leaderboards with a member who has predicted one of the given fixtures (instances or pks).
+    A change to the fixtures' results can only move the ranks on those leaderboards.
+    """
+    from socapp.models import Answer, Leaderboard
+    predictors = Answer.objects.filter(fixture__in=fixtures).values('user')
+    return list(Leaderboard.users.through.objects.filter(user__in=predictors).values_list('leaderboard_id', flat=True).distinct())
+
+def refresh_fixture_ranks(fixtures, tournaments):
+    """
+    Refreshes the boards which a change to the fixtures' results can move: the global board, the given tournaments' boards
+    (the fixtures' tournaments) and the leaderboards of the users who predicted them.
+    """
+    return refresh_rank_snapshots(tournaments=tournaments, leaderboards=affected_leaderboards(fixtures))
+
+def refresh_rank_snapshots(include_global=True, tournaments=None, leaderboards=None):
+    """
+    Rewrites the stored ranks of the global board, and of the given tournaments and leaderboards (instances or pks).
+    Passing None for tournaments/leaderboards refreshes all of them, and an empty list refreshes none.
+    Each kind of board is read with a single query, ordered by points. Returns the number of boards rewritten.
+    """
+    from socapp.models import Leaderboard, Tournament, UserRankSnapshot
+    from socapp_auth.models import UserProfile, TournamentPoints
+    rewritten = 0
+
+    with transaction.atomic():
+        if include_global:
+            rows = UserProfile.objects.order_by('-points', 'user_id').values_list('user_id', 'points')
+            rewritten += write_snapshot(snapshot_board(), rows)
+
+        if tournaments is None or tournaments:
+            tournament_pts = TournamentPoints.objects.all()
+            if tournaments is not None:
+                tournament_pts = tournament_pts.filter(tournament__in=tournaments)
+            tournament_pts = tournament_pts.order_by('tournament_id', '-points', 'user__user_id') \
+                .values_list('tournament_id', 'user__user_id', 'points')
+            for tournament_id, rows in groupby(tournament_pts, key=lambda row: row[0]):
+                board = snapshot_board(tournament=Tournament(pk=tournament_id))
+                rewritten += write_snapshot(board, ((user_id, points) for _, user_id, points in rows))
+
+        if leaderboards is None or leaderboards:
+            # Leaderboard members are ranked by their overall points
+            members = Leaderboard.users.through.objects.all()
+            if leaderboards is not None:
+                members = members.filter(leaderboard__in=leaderboards)
+            members = members.order_by('leaderboard_id', '-user__profile__points', 'user_id') \
+                .values_list('leaderboard_id', 'user_id', 'user__profile__points')
+            boards_with_members = set()
+            for leaderboard_id, rows in groupby(members, key=lambda row: row[0]):
+                boards_with_members.add(leaderboard_id)
+                board = snapshot_board(leaderboard=Leaderboard(pk=leaderboard_id))
+                rewritten += write_snapshot(board, ((user_id, points or 0) for _, user_id, points in rows))
+
+            # Boards whose last members have left
+            empty = UserRankSnapshot.objects.filter(scope=UserRankSnapshot.SCOPE_LEADERBOARD).exclude(leaderboard__in=boards_with_members)
+            if leaderboards is not None:
+                empty = empty.filter(leaderboard__in=leaderboards)
+            empty.delete()
+
+    results_cache.bump_results_version()
+    return rewritten
+
+def stored_ranks(tournament=None, leaderboard=None, users=None):
+    """ Returns the board's stored snapshots (only for the given users, if any), as a dictionary of user pk -> UserRankSnapshot """
+    from socapp.models import UserRankSnapshot
+    snapshots = UserRankSnapshot.objects.filter(**snapshot_board(tournament, leaderboard))
+    if users is not None:
+        snapshots = snapshots.filter(user__in=users)
+    return {snapshot.user_id: snapshot for snapshot in snapshots}
+
+def stored_rank(user, tournament=None, leaderboard=None):
+    """
+    Returns the user's stored rank on the board. Users who aren't in the snapshot yet (e.g. they've joined since the
+    last scoring pass) are ranked with a live query instead.
+    """
+    from socapp.models import UserRankSnapshot
+    board = snapshot_board(tournament, leaderboard)
+    rank = UserRankSnapshot.objects.filter(user=user, **board).values_list('rank', flat=True).first()
+    if rank is not None:
+        return rank
+    if leaderboard is not None:
+        return rank_for_points(user_points_expression(user.pk), users=leaderboard.users.values('pk'))
+    return rank_for_points(user_points_expression(user.pk, tournament), tournament=tournament)
+
+def biggest_climbers(tournament=None, leaderboard=None):
+    """
+    Returns the users who have climbed the most places on the board since the previous snapshot, and the number of places,
+    e.g. ([<User: bob>], 3). Returns ([], 0) if nobody has moved up.
+    """
+    from socapp.models import UserRankSnapshot
+    snapshots = UserRankSnapshot.objects.filter(previous_rank__gt=F('rank'), **snapshot_board(tournament, leaderboard)) \
+        .annotate(places=F('previous_rank') - F('rank')).order_by('-places').select_related('user')
+
+    climbers, best = [], 0
+    for snapshot in snapshots.iterator():
+        if snapshot.places < best:
+            break
+        climbers.append(snapshot.user)
+        best = snapshot.places
+    return climbers, best
+
+######
+# Keyset pagination of the global board
+
+LEADERBOARD_PAGE_SIZE = 50
+
+def encode_cursor(points, user_id):
+    return "{}.{}".format(points, user_id)
+
+def decode_cursor(cursor):
+    """ Returns the (points, user_id) key encoded in a cursor, or None if it isn't a valid cursor """
+    try:
+        points, user_id = cursor.split('.')
+        return int(points), int(user_id)
+    except (AttributeError, ValueError):
+        return None
+
+def after_key(points, user_id):
+    """ Filter for the users below the given key in the board's order (points descending, then user pk) """
+    return Q(points__lt=points) | Q(points=points, user_id__gt=user_id)
+
+def before_key(points, user_id):
+    """ Filter for the users above the given key in the board's order """
+    return Q(points__gt=points) | Q(points=points, user_id__lt=user_id)
+
+class LeaderboardPage:
+    """
+    A page of the global board: a list of users (with their profiles loaded), each annotated with their 'board_rank'.
+    The previous/next cursors are the keys of the first/last users on the page, to pass back as 'before'/'after'.
+    """
+    def __init__(self, users, has_previous, has_next):
+        self.users = users
+        self.has_previous = has_previous and bool(users)
+        self.has_next = has_next and bool(users)
+        self.previous_cursor = encode_cursor(users[0].profile.points, users[0].pk) if self.has_previous else None
+        self.next_cursor = encode_cursor(users[-1].profile.points, users[-1].pk) if self.has_next else None
+
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+def rank_page(profiles):
+    """
+    Sets the competition rank of each user on a page of profiles, ordered as the board.
+    Only the first profile's position is looked up (with two counts on the points index); the rest follow from the page itself.
+    """
+    from socapp_auth.models import UserProfile
+    if not profiles:
+        return
+    first = profiles[0]
+    rank = UserProfile.objects.filter(points__gt=first.points).count() + 1
+    ties_ahead = UserProfile.objects.filter(points=first.points, user_id__lt=first.user_id).count()
+    start = rank - 1 + ties_ahead # Number of users above the page
+
+    prev_points = first.points
+    for offset, profile in enumerate(profiles):
+        if profile.points != prev_points:
+            rank, prev_points = start + offset + 1, profile.points
+        profile.user.board_rank = rank
+
+def global_board_page(after=None, before=None, around_user=None, page_size=LEADERBOARD_PAGE_SIZE):
+    """
+    Returns a LeaderboardPage of the global board, using keyset (seek) pagination on (points DESC, user pk):
+    each page is read by seeking to its key on the index, so every page costs the same however far down the board it is.
+    Pass the cursor of the previous page's last user as 'after' to get the next page, or of its first user as 'before'
+    to go back. If 'around_user' is given, returns the page with that user in the middle of it.
+    """
+    from socapp_auth.models import UserProfile
+    profiles = UserProfile.objects.select_related('user')
+    forward = profiles.order_by('-points', 'user_id')
+    backward = profiles.order_by('points', '-user_id')
+
+    after, before = decode_cursor(after), decode_cursor(before)
+    around_key = None
+    if around_user is not None:
+        around_key = UserProfile.objects.filter(user=around_user).values_list('points', 'user_id').first()
+
+    if around_key is not None:
+        # Half a page of users above the user, then the user and the users below them
+        half = page_size // 2
+        above = list(backward.filter(before_key(*around_key))[:half + 1])
+        has_previous = len(above) > half
+        above = above[:half][::-1]
+        rest = page_size - len(above)
+        points, user_id = around_key
+        below = list(forward.filter(Q(points__lt=points) | Q(points=points, user_id__gte=user_id))[:rest + 1])
+        has_next = len(below) > rest
+        page = above + below[:rest]
+    elif before is not None:
+        page = list(backward.filter(before_key(*before))[:page_size + 1])
+        has_previous, has_next = len(page) > page_size, True
+        page = page[:page_size][::-1]
+    else:
+        page = forward.filter(after_key(*after)) if after is not None else forward
+        page = list(page[:page_size + 1])
+        has_previous, has_next = after is not None, len(page) > page_size
+        page = page[:page_size]
+
+    rank_page(page)
+    return LeaderboardPage([profile.user for profile in page], has_previous, has_next)
+
+######
+# Board statistics
+
+def board_profiles(leaderboard=None, friends_of_user=None):
+    """ Returns the UserProfiles on a board: a leaderboard's members, a user and their friends, or (by default) every user """
+    from socapp_auth.models import UserProfile
+    profiles = UserProfile.objects.all()
+    if leaderboard is not None:
+        return profiles.filter(user__leaderboard=leaderboard)
+    if friends_of_user is not None:
+        return restrict_to_users(profiles, friends_of(friends_of_user.profile))
+    return profiles
+
+def stats_from_histogram(histogram):
+    """
+    Calculates board stats from (points, number of users) pairs, ordered by points with the highest first.
+    The median is the mean of the two middle users' points if there's an even number of users.
+    """
+    count = sum(n for _, n in histogram)
+    stats = {
+        'members_count': count,
+        'total_points': sum(points * n for points, n in histogram),
+        'average_points': 0, 'percent_above_average': 0,
+        'min_points': None, 'max_points': None, 'median_points': None,
+    }
+    if count == 0:
+        return stats
+
+    average = stats['total_points'] / count
+    stats['average_points'] = average
+    stats['percent_above_average'] = sum(n for points, n in histogram if points >= average) * 100 / count
+    stats['max_points'], stats['min_points'] = histogram[0][0], histogram[-1][0]
+
+    # Points of the users at (0-based) positions (count - 1) // 2 and count // 2, counting from the top
+    middle = []
+    seen = 0
+    for points, n in histogram:
+        for position in ((count - 1) // 2, count // 2):
+            if seen <= position < seen + n:
+                middle.append(points)
+        seen += n
+    stats['median_points'] = sum(middle) / 2
+    return stats
+
+def board_stats(leaderboard=None, friends_of_user=None, version=None):
+    """
+    Returns the stats of a board (see board_profiles): the number of members, their total, average, minimum, maximum and
+    median points, and the percentage of them with at least the average points.
+    The stats are worked out from a single query grouping the members by points, which returns one row per distinct
+    points total rather than per user, and are cached per board until the results version changes (see socapp/cache.py).
+    """
+    if leaderboard is not None:
+        board = 'leaderboard:{}'.format(leaderboard.pk)
+    elif friends_of_user is not None:
+        board = 'friends:{}'.format(friends_of_user.pk)
+    else:
+        board = 'global'
+
+    def calculate_stats():
+        histogram = board_profiles(leaderboard, friends_of_user).order_by().values_list('points') \
+            .annotate(n=Count('pk')).order_by('-points')
+        return stats_from_histogram(list(histogram))
+
+    return results_cache.cached('board_stats:' + board, calculate_stats, version=version)
@@ -0,0 +1,154 @@
+import django
+from django.db import connections, transaction
+from django.db.models import Q
+
+from collections import defaultdict, namedtuple
+import multiprocessing
+
+import socapp.utils as utils
+from socapp.audit import expected_points, AUDIT_CHUNK_SIZE
+
+"""
+Rescoring a whole tournament from scratch, e.g. after the points rules change or bad results are fixed.
+The tournament's predictions are streamed in batches and rescored in memory (optionally split by fixture across a pool of
+worker processes). The differences are then either reported (a dry run) or written with bulk statements in one transaction:
+the predictions' points, the users' tournament points, their overall points and the points ledger. When they are written, the
+rescoring runs in the same transaction, with the users' points rows locked, so no scoring can land in between (see rescore_and_apply).
+"""
+
+# The outcome of rescoring a tournament. answer_changes is a list of (answer pk, points, points_added) for the predictions
+# whose stored points change, and totals a dictionary of user pk -> (stored tournament points, rescored tournament points)
+# for the users whose tournament points change.
+RescoreResult = namedtuple('RescoreResult', ['tournament', 'answers_checked', 'answer_changes', 'totals'])
+
+def rescore_fixtures(fixture_ids, chunk_size=AUDIT_CHUNK_SIZE):
+    """
+    Rescores the predictions of the given fixtures. Returns the number of predictions checked, the (answer pk, points, points_added)
+    of those whose points change, and a dictionary of user pk -> their rescored points from these fixtures.
+    Predictions of fixtures without a result have no points.
+    """
+    from socapp.models import Fixture, Answer
+    fixtures = Fixture.objects.in_bulk(fixture_ids)
+    answers = Answer.objects.filter(fixture__in=fixture_ids) \
+        .values_list('pk', 'user_id', 'fixture_id', 'points', 'points_added', *utils.Prediction._fields) \
+        .order_by('pk').iterator(chunk_size=chunk_size)
+
+    checked = 0
+    changes = []
+    points_by_user = defaultdict(int)
+    scores = {}
+    for answer_id, user_id, fixture_id, points, points_added, *prediction in answers:
+        checked += 1
+        fixture = fixtures[fixture_id]
+        if fixture.has_result():
+            new_points, new_added = expected_points(fixture, utils.Prediction(*prediction), scores), Answer.POINTS_ADDED
+            points_by_user[user_id] += new_points
+        else:
+            new_points, new_added = None, Answer.POINTS_NOT_ADDED
+        if (points, bool(points_added)) != (new_points, bool(new_added)):
+            changes.append((answer_id, new_points, new_added))
+    return checked, changes, dict(points_by_user)
+
+def init_worker():
+    # Workers are started afresh rather than forked, so they don't share this process's database connection,
+    # which may be in the middle of the transaction holding the locks (see rescore_and_apply)
+    django.setup()
+
+def rescore_fixtures_in_worker(args):
+    # Runs in a worker process, with its own database connection
+    fixture_ids, chunk_size = args
+    try:
+        return rescore_fixtures(fixture_ids, chunk_size)
+    finally:
+        connections.close_all()
+
+def rescore_tournament(tournament, workers=1, chunk_size=AUDIT_CHUNK_SIZE):
+    """ Rescores every prediction of the tournament's fixtures, without writing anything. Returns a RescoreResult. """
+    from socapp_auth.models import TournamentPoints
+    fixture_ids = list(tournament.get_fixtures().order_by().values_list('pk', flat=True))
+
+    if workers > 1 and len(fixture_ids) > 1:
+        batches = [fixture_ids[i::workers] for i in range(min(workers, len(fixture_ids)))]
+        with multiprocessing.get_context('spawn').Pool(len(batches), initializer=init_worker) as pool:
+            results = pool.map(rescore_fixtures_in_worker, [(batch, chunk_size) for batch in batches])
+    else:
+        results = [rescore_fixtures(fixture_ids, chunk_size)]
+
+    checked = 0
+    changes = []
+    new_totals = defaultdict(int)
+    for batch_checked, batch_changes, batch_points in results:
+        checked += batch_checked
+        changes.extend(batch_changes)
+        for user_id, points in batch_points.items():
+            new_totals[user_id] += points
+
+    stored_totals = dict(TournamentPoints.objects.filter(tournament=tournament).values_list('user__user_id', 'points'))
+    totals = {}
+    for user_id in set(stored_totals) | set(new_totals):
+        stored, new = stored_totals.get(user_id), new_totals.get(user_id, 0)
+        if (stored or 0) != new:
+            totals[user_id] = (stored, new)
+    return RescoreResult(tournament, checked, changes, totals)
+
+def apply_rescore(result):
+    """
+    Writes a RescoreResult in one transaction: the predictions' points, the users' tournament points (set to their rescored values),
+    their overall points (moved by the same amount) and the points ledger. Then updates the stored ranks.
+    """
+    from socapp.models import Answer, PointsLedgerEntry
+    from socapp_auth.models import UserProfile, TournamentPoints
+    from socapp import ledger
+    import socapp.ranking as ranking
+
+    tournament = result.tournament
+    with transaction.atomic():
+        utils.bulk_update(Answer, [Answer(pk=pk, points=points, points_added=added) for pk, points, added in result.answer_changes],
+                          ['points', 'points_added'])
+
+        deltas = {user_id: new - (stored or 0) for user_id, (stored, new) in result.totals.items()}
+        ledger.record({(user_id, tournament.pk, None): delta for user_id, delta in deltas.items()}, PointsLedgerEntry.REASON_RESCORE)
+        utils.apply_user_points_deltas(deltas, {})
+
+        profile_pks = {}
+        for chunk in utils.chunked(list(result.totals)):
+            profile_pks.update(UserProfile.objects.filter(user_id__in=chunk).values_list('user_id', 'pk'))
+        rows_by_points = defaultdict(list)
+        missing = []
+        for user_id, (stored, new) in result.totals.items():
+            if user_id not in profile_pks:
+                continue
+            if stored is None:
+                missing.append(TournamentPoints(user_id=profile_pks[user_id], tournament=tournament, points=new))
+            else:
+                rows_by_points[new].append(profile_pks[user_id])
+        for points, pks in rows_by_points.items():
+            for chunk in utils.chunked(pks):
+                TournamentPoints.objects.filter(tournament=tournament, user_id__in=chunk).update(points=points)
+        TournamentPoints.objects.bulk_create(missing, batch_size=utils.BULK_BATCH_SIZE)
+
+    ranking.refresh_rank_snapshots()
+
+def lock_points(tournament):
+    """
+    Locks the tournament's TournamentPoints rows, and the UserProfiles of the users who have them or have predicted its fixtures,
+    until the end of the transaction. Scoring which would change them waits for the transaction to finish.
+    """
+    from socapp.models import Answer
+    from socapp_auth.models import UserProfile, TournamentPoints
+    tournament_pts = TournamentPoints.objects.filter(tournament=tournament)
+    predictors = Answer.objects.filter(fixture__tournament=tournament).values('user')
+    profiles = UserProfile.objects.filter(Q(user__in=predictors) | Q(pk__in=tournament_pts.values('user')))
+    list(profiles.select_for_update().order_by('pk').values_list('pk', flat=True))
+    list(tournament_pts.select_for_update().order_by('pk').values_list('pk', flat=True))
+
+def rescore_and_apply(tournament, workers=1, chunk_size=AUDIT_CHUNK_SIZE):
+    """
+    Rescores the tournament and writes the result in one transaction, with the users' points locked from before the
+    predictions are read until the changes are written. Returns the RescoreResult, once it has been written.
+    """
+    with transaction.atomic():
+        lock_points(tournament)
+        result = rescore_tournament(tournament, workers=workers, chunk_size=chunk_size)
+        apply_rescore(result)
+    return result
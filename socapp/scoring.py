@@ -0,0 +1,133 @@
+from array import array
+from collections import namedtuple
+
+"""
+The points system. Each tournament can have its own ScoringRules (the default rules are used otherwise).
+For each set of rules, the points for every prediction against every result with up to MAX_GOALS goals per team are worked out
+once, into a lookup table, so scoring a prediction is an index into an array rather than a series of comparisons.
+Scorelines outside the table (more than MAX_GOALS goals) are scored directly.
+"""
+
+# The most goals per team covered by the lookup tables. Predictions are capped at 10 goals by the answer forms and the API.
+MAX_GOALS = 10
+GOALS = MAX_GOALS + 1 # Number of possible goal counts per team (0 to MAX_GOALS)
+
+# The points given by a set of rules (see the ScoringRules model, which has a field for each)
+Rules = namedtuple('Rules', [
+    'exact_score', # Predicting the exact score
+    'correct_outcome', # Predicting the winner (or a draw), but not the exact score
+    'goals_bonus', # Also predicting the total number of goals or the goal difference
+    'extra_time_correct', # Predicting extra time in a fixture which went to extra time
+    'extra_time_wrong', # Predicting extra time in a fixture which didn't
+    'penalties_correct', # Predicting penalties in a fixture which went to penalties
+    'penalties_wrong', # Predicting penalties in a fixture which didn't
+])
+
+DEFAULT_RULES = Rules(exact_score=5, correct_outcome=2, goals_bonus=1, extra_time_correct=2, extra_time_wrong=-1,
+                      penalties_correct=2, penalties_wrong=-1)
+
+def score_points(rules, team1_goals, team2_goals, actual_team1_goals, actual_team2_goals):
+    """ Returns the points for predicting the given score, when the actual score is as given (not counting extra time/penalties) """
+    if team1_goals == actual_team1_goals and team2_goals == actual_team2_goals:
+        return rules.exact_score
+
+    points = 0
+    goal_difference = team1_goals - team2_goals
+    actual_goal_difference = actual_team1_goals - actual_team2_goals
+    # Check the result is correct
+    if ((goal_difference > 0 and actual_goal_difference > 0) or
+        (goal_difference < 0 and actual_goal_difference < 0) or
+        (goal_difference == actual_goal_difference)):
+        points += rules.correct_outcome
+    # Check the total goals scored or the goal difference is correct (can't have both, or the prediction would be correct).
+    if team1_goals + team2_goals == actual_team1_goals + actual_team2_goals or goal_difference == actual_goal_difference:
+        points += rules.goals_bonus
+    return points
+
+def flag_points(rules, has_extra_time, has_penalties, actual_has_extra_time, actual_has_penalties):
+    """ Returns the points for the extra time/penalties part of a prediction of a fixture which can go beyond 90 minutes """
+    points = 0
+    if has_extra_time:
+        points += rules.extra_time_correct if actual_has_extra_time else rules.extra_time_wrong
+    if has_penalties:
+        points += rules.penalties_correct if actual_has_penalties else rules.penalties_wrong
+    return points
+
+def prediction_index(team1_goals, team2_goals, has_extra_time, has_penalties):
+    """ Returns the position of a prediction in a result's points table, or None if it's outside the table """
+    if not (0 <= team1_goals <= MAX_GOALS and 0 <= team2_goals <= MAX_GOALS):
+        return None
+    return (((team1_goals * GOALS) + team2_goals) * 2 + bool(has_extra_time)) * 2 + bool(has_penalties)
+
+class PointsTable:
+    """
+    The points for every prediction against every result, for a set of Rules.
+    The score part is one array indexed by (actual score, predicted score). Fixtures which can go beyond 90 minutes add the
+    extra time/penalties points, so each result gets its own table (see result_points) of the points for every prediction.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.scores = array('i', [
+            score_points(rules, team1_goals, team2_goals, actual_team1_goals, actual_team2_goals)
+            for actual_team1_goals in range(GOALS) for actual_team2_goals in range(GOALS)
+            for team1_goals in range(GOALS) for team2_goals in range(GOALS)
+        ])
+        self.results = {}
+
+    def result_points(self, fixture):
+        """
+        Returns an array of the points for every prediction of the fixture's result, indexed by prediction_index,
+        or None if the result is outside the table.
+        """
+        can_be_over_90 = bool(fixture.can_be_over_90)
+        key = (fixture.team1_goals, fixture.team2_goals, can_be_over_90,
+               can_be_over_90 and bool(fixture.has_extra_time), can_be_over_90 and bool(fixture.has_penalties))
+        points = self.results.get(key)
+        if points is None:
+            if prediction_index(fixture.team1_goals, fixture.team2_goals, False, False) is None:
+                return None
+            start = (fixture.team1_goals * GOALS + fixture.team2_goals) * GOALS * GOALS
+            flags = [
+                flag_points(self.rules, has_extra_time, has_penalties, fixture.has_extra_time, fixture.has_penalties) if can_be_over_90 else 0
+                for has_extra_time in (False, True) for has_penalties in (False, True)
+            ]
+            points = self.results[key] = array('i', [
+                score + flag for score in self.scores[start:start + GOALS * GOALS] for flag in flags
+            ])
+        return points
+
+    def points(self, fixture, prediction):
+        """ Returns the points for a prediction (an Answer or utils.Prediction) of the fixture's result """
+        index = prediction_index(prediction.team1_goals, prediction.team2_goals, prediction.has_extra_time, prediction.has_penalties)
+        result_points = self.result_points(fixture)
+        if index is None or result_points is None:
+            return calculate_points_directly(self.rules, fixture, prediction)
+        return result_points[index]
+
+def calculate_points_directly(rules, fixture, prediction):
+    """ Scores a prediction without the lookup table, for scorelines outside it """
+    points = score_points(rules, prediction.team1_goals, prediction.team2_goals, fixture.team1_goals, fixture.team2_goals)
+    if fixture.can_be_over_90:
+        points += flag_points(rules, prediction.has_extra_time, prediction.has_penalties, fixture.has_extra_time, fixture.has_penalties)
+    return points
+
+# Lookup tables, built on first use for each set of rules
+_tables = {}
+
+def points_table(rules=DEFAULT_RULES):
+    table = _tables.get(rules)
+    if table is None:
+        table = _tables[rules] = PointsTable(rules)
+    return table
+
+def fixture_rules(fixture):
+    """ Returns the Rules for the fixture's tournament, or the default rules """
+    if fixture.tournament_id is None:
+        return DEFAULT_RULES
+    scoring_rules = fixture.tournament.scoring_rules
+    return DEFAULT_RULES if scoring_rules is None else scoring_rules.as_rules()
+
+def fixture_table(fixture):
+    """ Returns the PointsTable for the fixture's tournament """
+    return points_table(fixture_rules(fixture))
@@ -1,9 +1,11 @@
 from django.db.models import F
-from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 
-from .models import Team, Fixture
+from .models import Team, Fixture, Leaderboard
 import socapp.utils as utils
+import socapp.ranking as ranking
+from socapp import tasks, predictions
 
 @receiver(post_save, sender=Team)
 def generate_flag_path(sender, instance, created, **kwargs):
@@ -17,12 +19,35 @@ def generate_flag_path(sender, instance, created, **kwargs):
         instance.flag = "img/{}.png".format(team_name)
         instance.save()
 
+# Keep the fixture's prediction cutoff in step with its match date. Also runs for fixtures loaded from JSON (raw saves).
+@receiver(pre_save, sender=Fixture)
+def set_fixture_lock_time(sender, instance, **kwargs):
+    instance.locks_at = predictions.lock_time(instance.match_date)
+    instance.is_locked = not instance.is_open()
+
 @receiver(pre_delete, sender=Fixture)
 def delete_fixture_actions(sender, instance, **kwargs):
-    if instance.has_result():
-        for team in [instance.team1, instance.team2]:
-            utils.remove_team_data(instance, team)
-        utils.update_user_pts(prev_fixture=instance, remove=True)
+    # Apply any queued changes to the result first. If a job fails, the rest stay unapplied, so the result removed is the one
+    # the Team/user data actually reflects (that of the last processed job), rather than the instance's.
+    tasks.process_fixture_jobs(instance)
+    applied = tasks.applied_result(instance)
+    if applied is not None and applied.has_result():
+        utils.update_team_data(applied, None)
+        utils.update_group_standings(applied, None)
+        utils.update_user_pts(prev_fixture=applied, remove=True)
+        ranking.refresh_fixture_ranks([instance.pk], tournaments=[instance.tournament_id])
+
+# Keep the stored ranks of a leaderboard in step with its members
+@receiver(m2m_changed, sender=Leaderboard.users.through)
+def leaderboard_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # The user's leaderboards were changed (e.g. user.leaderboard_set.add(...)). pk_set is None when they were cleared.
+        leaderboards = None if pk_set is None else list(pk_set)
+    else:
+        leaderboards = [instance.pk]
+    ranking.refresh_rank_snapshots(include_global=False, tournaments=[], leaderboards=leaderboards)
 
 # @receiver(pre_save, sender=Fixture, dispatch_uid="update_after_result")
 # def update_data_when_fixture_is_saved(sender, instance, **kwargs):
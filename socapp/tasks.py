@@ -1 +1,139 @@
-""" Soccerates Celery Tasks """
\ No newline at end of file
+"""
+Soccerates background tasks: processing of fixture results.
+Saving a Fixture queues a ResultJob describing the change to its result. Jobs are processed by the
+process_results management command (or straight away, if the RESULT_JOBS_ASYNC setting is off), which applies
+the change to the Team models and the users' points.
+Jobs for the same fixture are always applied in the order they were created, and each job is applied at most once.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+import logging
+
+from .models import Fixture, ResultJob
+import socapp.utils as utils
+import socapp.ranking as ranking
+
+logger = logging.getLogger(__name__)
+
+def results_are_async():
+    return getattr(settings, 'RESULT_JOBS_ASYNC', False)
+
+def enqueue_result_change(prev_fixture, fixture):
+    """
+    Queues a job for the change between prev_fixture (the fixture as previously stored, or None) and the fixture just saved.
+    Returns the job, or None if the save didn't change anything related to the result.
+    """
+    job = create_result_job(prev_fixture, fixture)
+    if job is not None and not results_are_async():
+        process_fixture_jobs(fixture)
+    return job
+
+def create_result_job(prev_fixture, fixture):
+    """ Creates the job for the change between prev_fixture and fixture, without processing it. Returns None if the result hasn't changed. """
+    prev_result = ResultJob.snapshot(prev_fixture) if prev_fixture is not None and prev_fixture.has_result() else ""
+    result = ResultJob.snapshot(fixture)
+    if not prev_result and not fixture.has_result():
+        return None
+    if prev_result == result:
+        return None
+    return ResultJob.objects.create(fixture=fixture, prev_result=prev_result, result=result)
+
+def process_job(job, fixture=None):
+    """
+    Applies a single job. The fixture instance can be passed in to avoid reloading it (its related Team instances are then updated in place).
+    Returns True if the job was applied, and False if it had already been processed or failed.
+    """
+    try:
+        with transaction.atomic():
+            # Claim the job. If another worker has already processed it, there's nothing to do.
+            claimed = ResultJob.objects.filter(pk=job.pk, status=ResultJob.STATUS_PENDING) \
+                .update(status=ResultJob.STATUS_PROCESSED, attempts=F('attempts') + 1, processed_at=timezone.now(), error="")
+            if not claimed:
+                return False
+            if fixture is None:
+                # Load the fixture and its teams afresh, as an earlier job may have changed the Team models since the job was fetched.
+                fixture = Fixture.objects.get(pk=job.fixture_id)
+            utils.apply_result_change(job.prev_fixture(fixture), job.saved_fixture(fixture))
+    except Exception as e:
+        # The transaction has been rolled back, so the job is still pending. Record the attempt, and give up after too many.
+        attempts = job.attempts + 1
+        status = ResultJob.STATUS_FAILED if attempts >= ResultJob.MAX_ATTEMPTS else ResultJob.STATUS_PENDING
+        ResultJob.objects.filter(pk=job.pk).update(status=status, attempts=attempts, error=repr(e))
+        job.status, job.attempts, job.error = status, attempts, repr(e)
+        logger.exception("Result job {} failed (attempt {})".format(job.pk, attempts))
+        return False
+
+    job.status = ResultJob.STATUS_PROCESSED
+    return True
+
+def process_fixture_jobs(fixture, refresh_ranks=True):
+    """
+    Processes any pending jobs for the given fixture, in order. Stops at the first job that fails, and doesn't process any
+    if an earlier job has already failed (so results are never applied out of order).
+    The stored ranks are refreshed once the jobs have been applied, unless refresh_ranks is False (e.g. when the caller is
+    processing several fixtures). Returns the number of jobs applied.
+    """
+    processed = 0
+    jobs = ResultJob.objects.filter(fixture=fixture, status__in=[ResultJob.STATUS_PENDING, ResultJob.STATUS_FAILED]).order_by('id')
+    for job in jobs:
+        if job.status == ResultJob.STATUS_FAILED or not process_job(job, fixture):
+            break
+        processed += 1
+    if processed and refresh_ranks:
+        ranking.refresh_fixture_ranks([fixture.pk], tournaments=[fixture.tournament_id])
+    return processed
+
+def process_pending_jobs(limit=100):
+    """
+    Processes up to 'limit' pending jobs, oldest first, then refreshes the stored ranks. Returns the number of jobs applied.
+    A fixture's jobs are skipped while one of its earlier jobs has failed, so results are never applied out of order.
+    """
+    processed = 0
+    blocked = set(ResultJob.objects.filter(status=ResultJob.STATUS_FAILED).values_list('fixture_id', flat=True))
+    jobs = ResultJob.objects.filter(status=ResultJob.STATUS_PENDING).order_by('id')[:limit]
+
+    applied_fixtures = set()
+    for job in jobs:
+        if job.fixture_id in blocked:
+            continue
+        if process_job(job):
+            applied_fixtures.add(job.fixture_id)
+            processed += 1
+        else:
+            blocked.add(job.fixture_id)
+
+    # Refresh the stored ranks once for the whole batch, rather than after every job
+    if applied_fixtures:
+        tournaments = Fixture.objects.filter(pk__in=applied_fixtures).values_list('tournament_id', flat=True).distinct()
+        ranking.refresh_fixture_ranks(list(applied_fixtures), tournaments=list(tournaments))
+    return processed
+
+def applied_result(fixture):
+    """
+    Returns the fixture as the Team models and users' points currently reflect it: with the result from before its first
+    unprocessed job, or None if that was no result at all. Fixtures whose jobs have all been processed are returned as they are.
+    """
+    return applied_results([fixture]).get(fixture.pk, fixture)
+
+def applied_results(fixtures):
+    """
+    Like applied_result, for several fixtures with one query. Returns a dictionary of fixture pk to the applied fixture (or None),
+    holding only the fixtures which have unprocessed (pending or failed) jobs, since the rest are already applied as they are.
+    """
+    fixtures = {fixture.pk: fixture for fixture in fixtures}
+    applied = {}
+    jobs = ResultJob.objects.filter(fixture_id__in=list(fixtures), status__in=[ResultJob.STATUS_PENDING, ResultJob.STATUS_FAILED]).order_by('id')
+    for job in jobs:
+        if job.fixture_id not in applied:
+            applied[job.fixture_id] = job.prev_fixture(fixtures[job.fixture_id])
+    return applied
+
+def retry_failed_jobs(queryset=None):
+    """ Puts failed jobs back in the queue, with their attempts reset """
+    if queryset is None:
+        queryset = ResultJob.objects.all()
+    return queryset.filter(status=ResultJob.STATUS_FAILED).update(status=ResultJob.STATUS_PENDING, attempts=0)
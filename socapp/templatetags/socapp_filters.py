@@ -1,5 +1,6 @@
 from django import template
 from django.utils import timezone
+from socapp.ranking import stored_rank
 import datetime, re
 
 register = template.Library()
@@ -21,10 +22,10 @@ def disable_input(field):
 
 @register.filter(name="editable")
 def editable(fixture):
-    # Allow a fixture to be edited up to 15 mins before kickoff
-    if fixture.match_date is None: return False
-    cutoff_time = fixture.match_date - datetime.timedelta(minutes=75)
-    return timezone.now() < cutoff_time
+    # Allow a fixture to be edited up to 75 mins before kickoff (see predictions.PREDICTION_CUTOFF).
+    # Uses the predictions_open annotation if the fixtures were loaded with it.
+    is_open = getattr(fixture, 'predictions_open', None)
+    return fixture.is_open() if is_open is None else is_open
 
 # Filter for adding an id to a Form field.
 @register.filter(name="add_id")
@@ -70,30 +71,18 @@ def getDistinctTeams(fixtures):
 # Returns distinct set of teams for the queryset of fixtures passed in
 @register.filter(name="getDistinctTeamsOrderedByPoints")
 def getDistinctTeamsOrderedByPoints(fixtures):
-    teams = []
-    while len(teams) < 4:
-        for fixture in fixtures:
-            if fixture.team1 not in teams:
-                teams.append(fixture.team1)
-            if fixture.team2 not in teams:
-                teams.append(fixture.team2)
+    teams = getDistinctTeams(fixtures)
     return sorted(teams, key=lambda team: (team.points, team.goal_difference, team.group_goals_for), reverse=True)
 
-# Returns the rank of the user in the leaderboard.
+# Looks up a key in a dictionary. Used in templates to get e.g. the standings for a group.
+@register.filter(name="get_item")
+def get_item(dictionary, key):
+    return dictionary.get(key, [])
+
+# Returns the rank of the user in the leaderboard, as stored after the last scoring pass.
 @register.filter(name="get_user_leaderboard_position")
 def get_user_leaderboard_position(leaderboard, user):
-
-    # Sort the leaderboard by users points in descending order.
-    users_in_leaderboard = [(user.profile.points, user) for user in leaderboard.users.all()]
-    sorted_leaderboard = sorted(users_in_leaderboard, key=lambda u: u[0], reverse=True)
-
-    # Get the index (rank) of the user.
-    for index,u in enumerate(sorted_leaderboard):
-        if u[1].username == str(user):
-            return (index + 1)
-
-    # This should never be reached.
-    return "-"
+    return stored_rank(user, leaderboard=leaderboard)
 
 # Returns number of free spaces in the leaderboard.
 @register.filter(name="get_free_spaces")
@@ -0,0 +1,146 @@
+from django.core.management import call_command
+from django.test import TestCase
+from io import StringIO
+from unittest import mock
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+from socapp_auth.models import UserProfile, TournamentPoints
+from socapp import audit, ledger, rescore
+
+"""
+Tests for the audit (and repair) of users' points against their predictions.
+"""
+
+class PointsAuditTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixtures = self.tournament.all_fixtures_by_group("A")
+        self.alice = helpers.generate_user(username="alice")
+        self.bob = helpers.generate_user(username="bob")
+        for fixture in self.fixtures[:2]:
+            helpers.generate_answer(self.alice, fixture, 2, 0)
+            helpers.generate_answer(self.bob, fixture, 0, 0)
+        helpers.play_match(self.fixtures[0], 2, 0)
+        helpers.play_match(self.fixtures[1], 1, 1)
+
+    def test_points_in_sync_after_scoring(self):
+        self.assertEqual(audit.audit_all_users(), [])
+
+    def test_discrepancies_found_and_repaired(self):
+        # bob's total, alice's tournament points and one of alice's predictions are corrupted
+        UserProfile.objects.filter(user=self.bob).update(points=100)
+        TournamentPoints.objects.filter(user__user=self.alice).update(points=0)
+        answer = Answer.objects.get(user=self.alice, fixture=self.fixtures[0])
+        Answer.objects.filter(pk=answer.pk).update(points=None, points_added=False)
+
+        discrepancies = audit.audit_all_users(chunk_size=1)
+        self.assertEqual(sorted((d.kind, d.user_id, d.stored, d.expected) for d in discrepancies), [
+            (audit.ANSWER, self.alice.pk, None, 5),
+            (audit.TOURNAMENT, self.alice.pk, 0, 6),
+            (audit.USER, self.bob.pk, 100, 3),
+        ])
+
+        # Only the users in the range are audited
+        self.assertEqual({d.user_id for d in audit.audit_user_points((self.bob.pk, self.bob.pk))}, {self.bob.pk})
+
+        out = StringIO()
+        call_command('sync_user_points', '--repair', stdout=out)
+        self.assertIn("User {}: total points is 100, but should be 3".format(self.bob.pk), out.getvalue())
+        self.assertEqual(audit.audit_all_users(), [])
+        self.assertEqual(UserProfile.objects.get(user=self.bob).points, 3)
+
+    # alice's overall and tournament points are both wrong, including points in a tournament she hasn't predicted
+    def test_user_and_tournament_totals_repaired_together(self):
+        other_tournament = Tournament.objects.exclude(pk=self.tournament.pk).first()
+        UserProfile.objects.filter(user=self.alice).update(points=50)
+        TournamentPoints.objects.filter(user__user=self.alice).update(points=2)
+        TournamentPoints.objects.create(user=self.alice.profile, tournament=other_tournament, points=4)
+
+        discrepancies = audit.audit_all_users()
+        self.assertEqual(sorted((d.kind, d.tournament_id, d.stored, d.expected) for d in discrepancies), [
+            (audit.TOURNAMENT, self.tournament.pk, 2, 6),
+            (audit.TOURNAMENT, other_tournament.pk, 4, 0),
+            (audit.USER, None, 50, 6),
+        ])
+        audit.repair_points(discrepancies)
+        self.assertEqual(audit.audit_all_users(), [])
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points,
+                         sum(TournamentPoints.objects.filter(user__user=self.alice).values_list('points', flat=True)))
+
+    # The points were changed without going through the ledger, so the repair entries have to bring the ledger back in line
+    def test_repairs_recorded_in_ledger(self):
+        UserProfile.objects.filter(user=self.bob).update(points=100)
+        TournamentPoints.objects.filter(user__user=self.alice).update(points=0)
+        UserProfile.objects.filter(user=self.alice).update(points=0)
+        audit.repair_points(audit.audit_all_users())
+
+        self.assertEqual(ledger.user_totals(), {self.alice.pk: 6, self.bob.pk: 3})
+        self.assertFalse(PointsLedgerEntry.objects.filter(user=self.bob, reason=PointsLedgerEntry.REASON_REPAIR).exists())
+        self.assertEqual(ledger.rebuild_totals(), 0)
+        self.assertEqual(audit.audit_all_users(), [])
+
+    def test_missing_tournament_points_created(self):
+        TournamentPoints.objects.filter(user__user=self.alice).delete()
+        audit.repair_points(audit.audit_all_users())
+        self.assertEqual(TournamentPoints.objects.get(user__user=self.alice, tournament=self.tournament).points, 6)
+
+    def test_user_id_ranges(self):
+        ranges = audit.user_id_ranges(4)
+        self.assertEqual((ranges[0][0], ranges[-1][1]), (self.alice.pk, self.bob.pk))
+        self.assertLessEqual(len(ranges), 2)
+
+
+class RescoreTournamentTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixtures = self.tournament.all_fixtures_by_group("A")
+        self.alice = helpers.generate_user(username="alice")
+        self.bob = helpers.generate_user(username="bob")
+        for fixture in self.fixtures[:3]:
+            helpers.generate_answer(self.alice, fixture, 2, 0)
+            helpers.generate_answer(self.bob, fixture, 0, 0)
+        helpers.play_match(self.fixtures[0], 2, 0)
+        helpers.play_match(self.fixtures[1], 1, 1)
+
+        # Simulate points given under different rules: every scored prediction got 1 point, and an unplayed fixture was scored
+        Answer.objects.filter(points_added=True).update(points=1)
+        Answer.objects.filter(fixture=self.fixtures[2]).update(points=1, points_added=True)
+        UserProfile.objects.update(points=3)
+        TournamentPoints.objects.update(points=3)
+
+    def test_dry_run_changes_nothing(self):
+        out = StringIO()
+        call_command('rescore_tournament', str(self.tournament.pk), '--dry-run', stdout=out)
+        self.assertIn("alice: 3 -> 6 (+3)", out.getvalue())
+        self.assertIn("5 of 6 prediction(s) and 1 user total(s) would change", out.getvalue()) # bob still has 3 points
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 3)
+
+    def test_rescore(self):
+        other = helpers.generate_user(username="other")
+        UserProfile.objects.filter(user=other).update(points=7) # Points from another tournament aren't touched
+
+        call_command('rescore_tournament', str(self.tournament.pk), stdout=StringIO())
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 6)
+        self.assertEqual(TournamentPoints.objects.get(user__user=self.bob).points, 3)
+        self.assertEqual(UserProfile.objects.get(user=other).points, 7)
+        self.assertFalse(Answer.objects.filter(fixture=self.fixtures[2], points_added=True).exists())
+        self.assertEqual(PointsLedgerEntry.objects.get(user=self.alice, reason=PointsLedgerEntry.REASON_RESCORE).delta, 3)
+        self.assertEqual([d for d in audit.audit_all_users() if d.user_id != other.pk], [])
+
+        # Rescoring again changes nothing
+        result = rescore.rescore_tournament(self.tournament)
+        self.assertEqual((result.answer_changes, result.totals), ([], {}))
+
+    # Nothing is reported as changed unless the changes have been written
+    def test_failed_rescore_reports_nothing(self):
+        out = StringIO()
+        with mock.patch('socapp.rescore.apply_rescore', side_effect=RuntimeError("Database went away")):
+            with self.assertRaises(RuntimeError):
+                call_command('rescore_tournament', str(self.tournament.pk), stdout=out)
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 3)
@@ -0,0 +1,104 @@
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+import socapp.cache as results_cache
+
+"""
+Tests for the cache of the read-heavy pages, keyed by the results version.
+"""
+
+class ResultsVersionTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.user = helpers.generate_user()
+        self.fixture = Tournament.objects.first().all_fixtures_by_group("A")[0]
+
+    def test_version_goes_up(self):
+        versions = [results_cache.results_version()]
+        helpers.play_match(self.fixture, 2, 1)
+        versions.append(results_cache.results_version())
+        leaderboard = Leaderboard.objects.create(name="Office")
+        leaderboard.users.add(self.user)
+        versions.append(results_cache.results_version())
+        results_cache.bump_results_version()
+        versions.append(results_cache.results_version())
+        self.assertEqual(versions, sorted(set(versions)))
+
+    def test_cached_values_are_kept_until_the_version_changes(self):
+        calls = []
+        def value():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(results_cache.cached('test_value', value), 1)
+        self.assertEqual(results_cache.cached('test_value', value), 1)
+        results_cache.bump_results_version()
+        self.assertEqual(results_cache.cached('test_value', value), 2)
+
+    def request_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response
+
+    # Until the next result, pages are rendered from the cache with only a handful of queries
+    def test_pages_are_cached_until_the_next_result(self):
+        self.client.force_login(self.user)
+        for url in (reverse('index'), reverse('tournaments'), reverse('global_leaderboard')):
+            first, _ = self.request_queries(url)
+            second, _ = self.request_queries(url)
+            self.assertLess(second, first, url)
+
+        helpers.play_match(self.fixture, 4, 0)
+        _, response = self.request_queries(reverse('tournaments'))
+        self.assertEqual(response.context['group_standings']["A"][0].team, self.fixture.team1)
+
+    def test_leaderboard_page_updates_when_members_change(self):
+        leaderboard = Leaderboard.objects.create(name="Office")
+        leaderboard.users.add(self.user)
+        self.client.force_login(self.user)
+        url = reverse('show_leaderboard', kwargs={'leaderboard': leaderboard.slug})
+        self.request_queries(url)
+
+        other = helpers.generate_user(username="other")
+        leaderboard.users.add(other)
+        _, response = self.request_queries(url)
+        self.assertContains(response, "other")
+
+
+class BoardMembersVersionTests(TestCase):
+    """ Signing up only invalidates the global board's cached data, not the other pages' """
+
+    def setUp(self):
+        self.user = helpers.generate_user()
+
+    def test_signup_only_changes_global_board_version(self):
+        version, board_version = results_cache.results_version(), results_cache.global_board_version()
+        new_user = helpers.generate_user(username="newcomer")
+        self.assertEqual(results_cache.results_version(), version)
+        self.assertNotEqual(results_cache.global_board_version(), board_version)
+
+        board_version = results_cache.global_board_version()
+        new_user.delete()
+        self.assertEqual(results_cache.results_version(), version)
+        self.assertNotEqual(results_cache.global_board_version(), board_version)
+
+    # Deleting a user who is on a leaderboard changes the leaderboard's pages too
+    def test_deleting_leaderboard_member_changes_results_version(self):
+        member = helpers.generate_user(username="member")
+        Leaderboard.objects.create(name="Office").users.add(member)
+        version = results_cache.results_version()
+        member.delete()
+        self.assertNotEqual(results_cache.results_version(), version)
+
+    def test_global_board_shows_new_users(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('global_leaderboard'))
+        helpers.generate_user(username="newcomer")
+        response = self.client.get(reverse('global_leaderboard'))
+        self.assertIn("newcomer", [user.username for user in response.context['members']])
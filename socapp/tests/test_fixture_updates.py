@@ -1,9 +1,13 @@
+from django.db import connection
 from django.db.models import Q, F, When, Case, Value, Sum, IntegerField
-from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
 from django.utils import timezone
 import socapp.tests.test_helpers as helpers
 
 from socapp.models import *
+import socapp.utils as utils
+from socapp import tasks
 
 """ 
 More in depth testing of the application's ability to propagate the result of a Fixture to related Team model fields, and to generate each user's points for the fixture.
@@ -540,4 +544,284 @@ class ResultEnteredTests(TestCase):
         for fixture in queryset:
             if fixture.get_loser() == team:
                 games_lost += 1
-        return games_lost
\ No newline at end of file
+        return games_lost
+
+class BulkScoringTests(TestCase):
+    """
+    The answers for a fixture are scored in bulk when its result is entered, so the number of queries
+    should not depend on the number of users who made a prediction.
+    """
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixture, self.other_fixture = self.tournament.all_fixtures_by_group("A")[:2]
+
+    def add_users_with_answers(self, fixture, num_users, start=0):
+        for i in range(start, start + num_users):
+            user = helpers.generate_user(username="bulk{}".format(i))
+            helpers.generate_answer(user, fixture, team1_goals=i % 3, team2_goals=1)
+
+    def scoring_queries(self, fixture, team1_goals, team2_goals):
+        fixture.team1_goals, fixture.team2_goals = team1_goals, team2_goals
+        with CaptureQueriesContext(connection) as ctx:
+            fixture.save()
+        return len(ctx)
+
+    def test_query_count_is_independent_of_user_count(self):
+        utils.rebuild_group_standings(self.tournament) # So that neither save has to build the group table
+        self.add_users_with_answers(self.fixture, 3)
+        self.add_users_with_answers(self.other_fixture, 30, start=3)
+        # Score both fixtures once first, so that both saves measured have stored ranks on each board to replace
+        self.scoring_queries(self.fixture, 0, 0)
+        self.scoring_queries(self.other_fixture, 0, 0)
+        few_users = self.scoring_queries(self.fixture, 1, 1)
+        many_users = self.scoring_queries(self.other_fixture, 1, 1)
+        self.assertEqual(few_users, many_users)
+
+    def test_points_for_each_mode(self):
+        self.add_users_with_answers(self.fixture, 6)
+        helpers.play_match(self.fixture, 1, 1)
+        for answer in Answer.objects.filter(fixture=self.fixture).select_related('fixture', 'user__profile'):
+            expected = utils.calculate_points(self.fixture, answer)
+            self.assertEqual(answer.points, expected)
+            self.assertEqual(answer.user.profile.points, expected)
+            self.assertEqual(answer.user.profile.get_tournament_points(self.tournament), expected)
+
+        helpers.play_match(self.fixture, 2, 1)
+        for answer in Answer.objects.filter(fixture=self.fixture).select_related('fixture', 'user__profile'):
+            expected = utils.calculate_points(self.fixture, answer)
+            self.assertEqual(answer.points, expected)
+            self.assertEqual(answer.user.profile.points, expected)
+            self.assertEqual(answer.user.profile.get_tournament_points(self.tournament), expected)
+
+        helpers.play_match(self.fixture, None, None)
+        for answer in Answer.objects.filter(fixture=self.fixture).select_related('user__profile'):
+            self.assertIsNone(answer.points)
+            self.assertEqual(answer.points_added, Answer.POINTS_NOT_ADDED)
+            self.assertEqual(answer.user.profile.points, 0)
+            self.assertEqual(answer.user.profile.get_tournament_points(self.tournament), 0)
+
+
+class TournamentScoringRulesTests(TestCase):
+    """ A tournament's predictions are scored with its own scoring rules, if it has any """
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixture = self.tournament.all_fixtures_by_group("A").first()
+        self.user = helpers.generate_user(username="rules")
+        self.exact = helpers.generate_answer(self.user, self.fixture, team1_goals=2, team2_goals=1)
+        self.outcome = helpers.generate_answer(helpers.generate_user(username="rules2"), self.fixture, team1_goals=3, team2_goals=0)
+
+    def test_default_rules(self):
+        helpers.play_match(self.fixture, 2, 1)
+        self.assertEqual(Answer.objects.get(pk=self.exact.pk).points, 5)
+        self.assertEqual(Answer.objects.get(pk=self.outcome.pk).points, 3)
+
+    def test_tournament_rules(self):
+        self.tournament.scoring_rules = ScoringRules.objects.create(name="Generous", exact_score=10, correct_outcome=3, goals_bonus=2)
+        self.tournament.save()
+        helpers.play_match(Fixture.objects.get(pk=self.fixture.pk), 2, 1)
+        self.assertEqual(Answer.objects.get(pk=self.exact.pk).points, 10)
+        self.assertEqual(Answer.objects.get(pk=self.outcome.pk).points, 5)
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.points, 10)
+
+
+class RecordResultTests(TestCase):
+    """ Fixture.objects.record_result should have the same effects as saving the fixture, with fewer queries """
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixture, self.other_fixture = self.tournament.all_fixtures_by_group("A")[:2]
+        self.user = helpers.generate_user(username="recorder")
+        self.answer = helpers.generate_answer(self.user, self.fixture, team1_goals=2, team2_goals=1)
+
+    def assertPoints(self, points):
+        answer = Answer.objects.get(pk=self.answer.pk)
+        self.user.profile.refresh_from_db()
+        self.assertEqual(answer.points, points)
+        self.assertEqual(self.user.profile.points, points or 0)
+        self.assertEqual(self.user.profile.get_tournament_points(self.tournament), points or 0)
+
+    def test_result_transitions(self):
+        team1 = self.fixture.team1
+        job = Fixture.objects.record_result(self.fixture.pk, 2, 1)
+        self.assertEqual(job.prev_result, "")
+        fixture = Fixture.objects.get(pk=self.fixture.pk)
+        self.assertEqual((fixture.team1_goals, fixture.team2_goals, fixture.status), (2, 1, Fixture.MATCH_STATUS_PLAYED))
+        self.assertPoints(5)
+        team1.refresh_from_db()
+        self.assertEqual((team1.games_played, team1.games_won, team1.goals_for), (1, 1, 2))
+
+        Fixture.objects.record_result(self.fixture.pk, 1, 1)
+        self.assertPoints(0)
+        team1.refresh_from_db()
+        self.assertEqual((team1.games_played, team1.games_won, team1.games_drawn, team1.goals_for), (1, 0, 1, 1))
+
+        Fixture.objects.record_result(self.fixture.pk, None, None)
+        self.assertEqual(Fixture.objects.get(pk=self.fixture.pk).status, Fixture.MATCH_STATUS_NOT_PLAYED)
+        self.assertPoints(None)
+        team1.refresh_from_db()
+        self.assertEqual((team1.games_played, team1.goals_for), (0, 0))
+
+    def test_unchanged_result(self):
+        Fixture.objects.record_result(self.fixture.pk, 2, 1)
+        jobs = ResultJob.objects.count()
+        self.assertIsNone(Fixture.objects.record_result(self.fixture.pk, 2, 1))
+        self.assertIsNone(Fixture.objects.record_result(self.other_fixture.pk, None, None))
+        self.assertEqual(ResultJob.objects.count(), jobs)
+        self.assertPoints(5)
+
+    def test_invalid_scores(self):
+        with self.assertRaises(ValidationError):
+            Fixture.objects.record_result(self.fixture.pk, 2, None)
+        with self.assertRaises(ValidationError):
+            Fixture.objects.record_result(self.fixture.pk, -1, 0)
+        with self.assertRaises(Fixture.DoesNotExist):
+            Fixture.objects.record_result(0, 1, 0)
+        self.assertFalse(ResultJob.objects.exists())
+
+    def test_fewer_reads_than_save(self):
+        helpers.generate_answer(self.user, self.other_fixture, team1_goals=2, team2_goals=1)
+        # So that neither has to build the group table or create the user's tournament points
+        warm_up = self.tournament.all_fixtures_by_group("A")[2]
+        helpers.generate_answer(self.user, warm_up, team1_goals=0, team2_goals=0)
+        helpers.play_match(warm_up, 0, 0)
+        with CaptureQueriesContext(connection) as recorded:
+            Fixture.objects.record_result(self.fixture.pk, 2, 1)
+        with CaptureQueriesContext(connection) as saved:
+            helpers.play_match(self.other_fixture, 2, 1)
+        # Reads only: the lock adds a transaction, where the save leaves it to the caller
+        selects = lambda ctx: [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertLess(len(selects(recorded)), len(selects(saved)))
+        self.assertFalse([sql for sql in selects(recorded) if sql.startswith('SELECT (1) AS "a" FROM "socapp_team"')]) # No full_clean
+
+
+class TeamStatDeltaTests(TestCase):
+    """
+    Tests for the deltas applied to the Team model when a fixture's result changes. 
+    Both teams should be updated with a single UPDATE statement, and group-only fields should only change for group stage fixtures.
+    """
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixture = self.tournament.all_fixtures_by_group("A")[0]
+        self.team1, self.team2 = self.fixture.team1, self.fixture.team2
+
+    def test_deltas_for_updated_result(self):
+        prev_fixture = Fixture(team1=self.team1, team2=self.team2, team1_goals=2, team2_goals=1, stage=Fixture.GROUP)
+        saved_fixture = Fixture(team1=self.team1, team2=self.team2, team1_goals=1, team2_goals=1, stage=Fixture.GROUP)
+        self.assertEqual(utils.team_stat_deltas(prev_fixture, saved_fixture, self.team1), {
+            'games_won': -1, 'games_drawn': 1, 'goals_for': -1,
+            'group_won': -1, 'group_drawn': 1, 'group_goals_for': -1,
+        })
+        self.assertEqual(utils.team_stat_deltas(prev_fixture, saved_fixture, self.team2), {
+            'games_lost': -1, 'games_drawn': 1, 'goals_against': -1,
+            'group_lost': -1, 'group_drawn': 1, 'group_goals_against': -1,
+        })
+        self.assertEqual(utils.team_stat_deltas(saved_fixture, saved_fixture, self.team1), {})
+
+    def test_single_update_statement_for_both_teams(self):
+        self.fixture.team1_goals, self.fixture.team2_goals = 3, 0
+        with CaptureQueriesContext(connection) as ctx:
+            self.fixture.save()
+        team_updates = [q for q in ctx.captured_queries if q['sql'].startswith('UPDATE "socapp_team"')]
+        self.assertEqual(len(team_updates), 1)
+
+        # The in-memory instances match the database without being refreshed
+        self.assertEqual(self.team1.goals_for, Team.objects.get(pk=self.team1.pk).goals_for)
+        self.assertEqual(self.team2.games_lost, Team.objects.get(pk=self.team2.pk).games_lost)
+
+    def test_knockout_result_leaves_group_fields_unchanged(self):
+        knockout = Fixture.objects.create(team1=self.team1, team2=self.team2, tournament=self.tournament, 
+                                          match_date=timezone.now(), stage=Fixture.ROUND_OF_16)
+        helpers.play_match(knockout, 2, 0)
+        self.team1.refresh_from_db()
+        self.team2.refresh_from_db()
+        self.assertEqual((self.team1.games_played, self.team1.games_won, self.team1.goals_for), (1, 1, 2))
+        self.assertEqual((self.team2.games_played, self.team2.games_lost, self.team2.goals_against), (1, 1, 2))
+        for team in [self.team1, self.team2]:
+            self.assertEqual((team.group_won, team.group_drawn, team.group_lost), (0, 0, 0))
+            self.assertEqual((team.group_goals_for, team.group_goals_against), (0, 0))
+
+        helpers.play_match(knockout, None, None)
+        self.team1.refresh_from_db()
+        self.assertEqual((self.team1.games_played, self.team1.games_won, self.team1.goals_for), (0, 0, 0))
+
+
+class GroupStandingTests(TestCase):
+    """
+    Tests for the stored group tables, which are updated incrementally as group stage results are entered, updated and removed.
+    """
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    results = [(2, 1), (0, 0), (4, 3), (2, 2), (1, 3), (5, 1)] # Group A results, in date order
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.group_fixtures = list(self.tournament.all_fixtures_by_group("A"))
+
+    def play_group(self, results):
+        for fixture, (team1_goals, team2_goals) in zip(self.group_fixtures, results):
+            helpers.play_match(fixture, team1_goals, team2_goals)
+
+    # Reads the stored table for group A as (team name, played, points, goal difference, goals for) tuples
+    def stored_table(self):
+        return [(s.team.name, s.played, s.points, s.goal_difference, s.goals_for) for s in self.tournament.group_standings()["A"]]
+
+    # Builds the expected table for group A from the Team model
+    def expected_table(self):
+        teams = sorted(Team.objects.filter(group="A"), key=lambda t: (-t.points, -t.goal_difference, -t.group_goals_for, t.name))
+        return [(t.name, t.group_won + t.group_drawn + t.group_lost, t.points, t.goal_difference, t.group_goals_for) for t in teams]
+
+    def test_standings_after_results(self):
+        self.play_group(self.results)
+        self.assertEqual(self.stored_table(), self.expected_table())
+        self.assertEqual([s.position for s in self.tournament.group_standings()["A"]], [1, 2, 3, 4])
+        self.assertEqual(self.stored_table()[0][:3], ("Russia", 3, 6))
+
+    def test_standings_after_updates_and_removals(self):
+        self.play_group(self.results)
+        self.play_group([(0, 2), (3, 0)])
+        self.assertEqual(self.stored_table(), self.expected_table())
+        self.play_group([(None, None)] * 6)
+        self.assertEqual(self.stored_table(), self.expected_table())
+        for standing in self.tournament.group_standings()["A"]:
+            self.assertEqual((standing.played, standing.points, standing.goals_for), (0, 0, 0))
+
+    # A rebuild from the fixtures gives the same tables as the incremental updates
+    def test_rebuild_matches_incremental_updates(self):
+        self.play_group(self.results)
+        incremental = self.stored_table()
+        utils.rebuild_group_standings(self.tournament)
+        self.assertEqual(self.stored_table(), incremental)
+
+    # If the tables have never been built, they are built from the results when first read
+    def test_standings_are_built_on_first_read(self):
+        self.play_group(self.results)
+        GroupStanding.objects.all().delete()
+        self.assertEqual(self.stored_table(), self.expected_table())
+        self.assertEqual(len(self.tournament.group_standings()), 8)
+
+    # Tables built while results are waiting to be processed only count the results applied so far, so the jobs don't count them twice
+    @override_settings(RESULT_JOBS_ASYNC=True)
+    def test_standings_built_with_pending_jobs(self):
+        self.play_group(self.results[:3])
+        tasks.process_pending_jobs()
+        self.play_group([(0, 2), (0, 0), (4, 3), (2, 2)])
+        GroupStanding.objects.all().delete()
+        self.tournament.group_standings()
+        tasks.process_pending_jobs()
+        self.assertEqual(self.stored_table(), self.expected_table())
+        self.assertEqual([s.played for s in self.tournament.group_standings()["A"]], [2, 2, 2, 2])
+
+    def test_standings_read_in_one_query(self):
+        self.play_group(self.results)
+        with self.assertNumQueries(1):
+            tables = self.tournament.group_standings()
+            names = [standing.team.name for group in tables.values() for standing in group]
+        self.assertEqual(len(names), 32)
@@ -0,0 +1,177 @@
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from io import StringIO
+import json
+import os
+import tempfile
+from unittest import mock
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+from socapp import ingest
+import socapp.ranking as ranking
+import socapp.utils as utils
+
+"""
+Tests for live score ingestion: the feed adapters, the debouncing of score updates, and recording the scores as results.
+"""
+
+def event(fixture_id, team1_goals, team2_goals, seconds, has_extra_time=False, has_penalties=False):
+    return ingest.ScoreEvent(fixture_id, team1_goals, team2_goals, has_extra_time, has_penalties, seconds)
+
+class DebouncerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.debouncer = ingest.Debouncer(window=30, max_wait=120)
+
+    def test_rapid_updates_collapse(self):
+        for seconds, goals in [(0, 0), (5, 1), (10, 1), (20, 2)]:
+            self.debouncer.add(event(1, goals, 0, seconds))
+        self.assertEqual(self.debouncer.due(45), [])
+        self.assertEqual(self.debouncer.due(50), [event(1, 2, 0, 20)])
+        self.assertEqual(len(self.debouncer), 0)
+
+    def test_max_wait(self):
+        for seconds in range(0, 150, 20):
+            self.debouncer.add(event(1, seconds // 20, 0, seconds))
+            released = self.debouncer.due(seconds)
+            if released:
+                break
+        self.assertEqual(released, [event(1, 6, 0, 120)])
+
+    # A goal given and then disallowed, after the score before it was released
+    def test_unchanged_score_dropped(self):
+        self.debouncer.add(event(1, 1, 0, 0))
+        self.assertEqual(self.debouncer.due(30), [event(1, 1, 0, 0)])
+        self.debouncer.add(event(1, 2, 0, 40))
+        self.debouncer.add(event(1, 1, 0, 100))
+        self.assertEqual(self.debouncer.due(200), [])
+
+    def test_flush(self):
+        self.debouncer.add(event(2, 0, 1, 10))
+        self.debouncer.add(event(1, 1, 0, 5))
+        self.assertEqual(self.debouncer.flush(), [event(1, 1, 0, 5), event(2, 0, 1, 10)])
+
+
+class FeedTests(SimpleTestCase):
+
+    def test_event_from_dict(self):
+        self.assertEqual(ingest.event_from_dict({'fixture': 3, 'team1_goals': 2, 'team2_goals': 1, 'time': 60}), event(3, 2, 1, 60.0))
+        self.assertEqual(ingest.event_from_dict({'fixture': 3, 'team1_goals': None, 'team2_goals': None}, default_time=5), event(3, None, None, 5.0))
+        for data in [[], {'fixture': 3, 'team1_goals': 2, 'time': 60}, {'fixture': 3, 'team1_goals': '2', 'team2_goals': 1, 'time': 60},
+                     {'fixture': 3, 'team1_goals': 2, 'team2_goals': 1}]:
+            with self.assertRaises(ValueError):
+                ingest.event_from_dict(data)
+
+    def test_file_feed_round_trip(self):
+        events = [event(1, 0, 0, 0), event(1, 1, 0, 600), event(2, 0, 1, 3600, has_extra_time=True)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.jsonl')
+            ingest.write_feed(events, path)
+            with open(path, 'a') as feed:
+                feed.write("not json\n\n")
+            with self.assertLogs('socapp.ingest', 'WARNING'):
+                self.assertEqual(list(ingest.FileFeed(path).events()), events)
+
+            sleeps = []
+            list(ingest.FileFeed(path, speed=60, sleep=sleeps.append).events())
+            self.assertEqual(sleeps, [10, 50])
+
+    # The stub returns the current scores on each poll; only the changes should come through
+    def test_http_feed(self):
+        responses = iter([
+            json.dumps([{'fixture': 1, 'team1_goals': 0, 'team2_goals': 0}, {'fixture': 2, 'team1_goals': 1, 'team2_goals': 0}]),
+            "<html>Service unavailable</html>",
+            json.dumps([{'fixture': 1, 'team1_goals': 1, 'team2_goals': 0}, {'fixture': 2, 'team1_goals': 1, 'team2_goals': 0}]),
+        ])
+        clock = iter([100, 130, 160])
+        feed = ingest.HttpFeed("http://scores.test/live", polls=3, fetch=lambda url: next(responses), sleep=lambda s: None,
+                               clock=lambda: next(clock))
+        with self.assertLogs('socapp.ingest', 'WARNING'):
+            events = [e for e in feed.events() if e is not None]
+        self.assertEqual(events, [event(1, 0, 0, 100), event(2, 1, 0, 100), event(1, 1, 0, 130)])
+
+    def test_simulated_matchday(self):
+        fixtures = [Fixture(pk=1, can_be_over_90=False), Fixture(pk=2, can_be_over_90=True)]
+        events = ingest.simulate_matchday(fixtures, seed=2018)
+        self.assertEqual(events, ingest.simulate_matchday(fixtures, seed=2018))
+        self.assertEqual([e.time for e in events], sorted(e.time for e in events))
+        scores = ingest.final_scores(events)
+        self.assertEqual(set(scores), {1, 2})
+        self.assertFalse(scores[1][2] or scores[1][3]) # Group matches never go to extra time
+
+
+class IngesterTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixtures = list(self.tournament.get_fixtures())
+        self.users = [helpers.generate_user(username="live{}".format(i)) for i in range(3)]
+        for i, user in enumerate(self.users):
+            for fixture in self.fixtures[:12]:
+                helpers.generate_answer(user, fixture, team1_goals=i, team2_goals=1)
+
+    def assertResultsRecorded(self, events):
+        scores = ingest.final_scores(events)
+        for fixture in Fixture.objects.filter(pk__in=scores):
+            self.assertEqual((fixture.team1_goals, fixture.team2_goals, fixture.has_extra_time, fixture.has_penalties), scores[fixture.pk])
+            self.assertEqual(fixture.status, Fixture.MATCH_STATUS_PLAYED)
+        for answer in Answer.objects.filter(fixture__in=self.fixtures[:12]).select_related('fixture'):
+            expected = utils.calculate_points(answer.fixture, answer) if answer.fixture.has_result() else None
+            self.assertEqual(answer.points, expected)
+        for user in self.users:
+            user.profile.refresh_from_db()
+            self.assertEqual(user.profile.points, sum(points or 0 for points in Answer.objects.filter(user=user).values_list('points', flat=True)))
+
+    def test_matchday(self):
+        fixtures = list(self.tournament.get_fixtures().on_day(self.fixtures[0].match_date.date()))
+        events = ingest.simulate_matchday(fixtures, seed=1)
+        stats = ingest.Ingester(ingest.MemoryFeed(events)).run()
+        self.assertEqual(stats.events, len(events))
+        self.assertLess(stats.recorded, len(events))
+        self.assertEqual(stats.rejected, 0)
+        self.assertResultsRecorded(events)
+        self.assertEqual(ResultJob.objects.filter(status=ResultJob.STATUS_PENDING).count(), 0)
+
+    def test_invalid_events_skipped(self):
+        events = [event(self.fixtures[0].pk, 2, 1, 0), event(0, 1, 0, 0), event(self.fixtures[1].pk, 1, None, 0)]
+        with self.assertLogs('socapp.ingest', 'WARNING'):
+            stats = ingest.Ingester(ingest.MemoryFeed(events)).run()
+        self.assertEqual((stats.recorded, stats.rejected), (1, 2))
+        self.assertResultsRecorded(events[:1])
+
+    # A fixture blocked by a failed job doesn't stop the batch's own results being applied
+    def test_blocked_fixture_in_queue(self):
+        blocked = self.fixtures[0]
+        ResultJob.objects.create(fixture=blocked, prev_result="", result=ResultJob.snapshot(blocked), status=ResultJob.STATUS_FAILED)
+        ResultJob.objects.create(fixture=blocked, prev_result="", result=ResultJob.snapshot(blocked))
+        events = [event(fixture.pk, 2, 1, 0) for fixture in self.fixtures[1:4]]
+        stats = ingest.Ingester(ingest.MemoryFeed(events)).run()
+        self.assertEqual(stats.recorded, 3)
+        self.assertEqual(ResultJob.objects.filter(fixture__in=self.fixtures[1:4], status=ResultJob.STATUS_PENDING).count(), 0)
+        self.assertEqual(ResultJob.objects.filter(fixture=blocked, status=ResultJob.STATUS_PENDING).count(), 1)
+        self.assertResultsRecorded(events)
+
+    # Every fixture in the tournament at once, with plenty of repeated updates. The repeats shouldn't add any work,
+    # and the ranks should be refreshed at most once per batch.
+    def test_throughput(self):
+        updates = ingest.simulate_matchday(self.fixtures, seed=7, repeat_rate=0.9, disallowed_rate=0.3)
+        events = sorted(updates * 4, key=lambda e: e.time) # Each update sent several times, as busy feeds do
+        with mock.patch('socapp.ranking.refresh_rank_snapshots', wraps=ranking.refresh_rank_snapshots) as refresh:
+            stats = ingest.Ingester(ingest.MemoryFeed(events), batch_size=20).run()
+        self.assertEqual(stats.events, len(events))
+        self.assertLessEqual(stats.recorded, len(updates))
+        self.assertLessEqual(stats.batches, stats.recorded)
+        self.assertLessEqual(refresh.call_count, stats.batches)
+        self.assertResultsRecorded(events)
+
+    def test_command(self):
+        events = ingest.simulate_matchday(self.fixtures[:4], seed=3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.jsonl')
+            ingest.write_feed(events, path)
+            out = StringIO()
+            call_command('ingest_scores', '--file', path, stdout=out)
+        self.assertIn("Ingested {} event(s)".format(len(events)), out.getvalue())
+        self.assertResultsRecorded(events)
@@ -0,0 +1,69 @@
+from django.core.management import call_command
+from django.test import TestCase
+from io import StringIO
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+from socapp_auth.models import UserProfile, TournamentPoints
+from socapp import ledger
+
+"""
+Tests for the points ledger, from which users' points can be rebuilt.
+"""
+
+class PointsLedgerTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixtures = self.tournament.all_fixtures_by_group("A")
+        self.alice = helpers.generate_user(username="alice")
+        self.bob = helpers.generate_user(username="bob")
+        for fixture in self.fixtures[:2]:
+            helpers.generate_answer(self.alice, fixture, 2, 0)
+            helpers.generate_answer(self.bob, fixture, 0, 0)
+
+    def points(self, user):
+        return UserProfile.objects.get(user=user).points
+
+    def test_entries_recorded_for_each_pass(self):
+        helpers.play_match(self.fixtures[0], 2, 0) # alice 5, bob 0
+        helpers.play_match(self.fixtures[0], 0, 0) # alice 0, bob 5
+        helpers.play_match(self.fixtures[1], 1, 0) # alice 2, bob 0
+
+        entries = PointsLedgerEntry.objects.filter(user=self.alice)
+        self.assertEqual([(e.delta, e.reason) for e in entries], [
+            (5, PointsLedgerEntry.REASON_RESULT),
+            (-5, PointsLedgerEntry.REASON_CORRECTION),
+            (2, PointsLedgerEntry.REASON_RESULT),
+        ])
+        self.assertEqual(ledger.user_totals(), {self.alice.pk: 2, self.bob.pk: 5})
+        self.assertEqual(ledger.tournament_totals(self.tournament)[(self.bob.pk, self.tournament.pk)], 5)
+        self.assertEqual((self.points(self.alice), self.points(self.bob)), (2, 5))
+
+        # Removing a result takes its points away again, and the entries outlive the fixture
+        self.fixtures[0].delete()
+        self.assertEqual(ledger.user_totals(), {self.alice.pk: 2, self.bob.pk: 0})
+        self.assertEqual((self.points(self.alice), self.points(self.bob)), (2, 0))
+
+    def test_rebuild_totals(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        helpers.play_match(self.fixtures[1], 0, 0)
+        UserProfile.objects.update(points=50)
+        TournamentPoints.objects.filter(user__user=self.bob).delete()
+
+        out = StringIO()
+        call_command('rebuild_points', '--tournament', str(self.tournament.pk), stdout=out)
+        self.assertIn("1 tournament total(s) changed", out.getvalue())
+        self.assertEqual((self.points(self.alice), self.points(self.bob)), (5, 5))
+        self.assertEqual(TournamentPoints.objects.get(user__user=self.bob, tournament=self.tournament).points, 5)
+        self.assertEqual(ledger.rebuild_totals(), 0)
+
+    # Points given before the ledger was kept are carried over as opening balances
+    def test_open_balances(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        PointsLedgerEntry.objects.all().delete()
+        self.assertEqual(ledger.open_balances(), 1)
+        self.assertEqual(ledger.open_balances(), 0)
+        self.assertEqual(ledger.rebuild_totals(), 0)
+        self.assertEqual(self.points(self.alice), 5)
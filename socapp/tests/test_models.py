@@ -1,11 +1,14 @@
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.db.models import Q, Count
 from django.test import TestCase
+from unittest import skipUnless
 from django.utils import timezone
+import datetime, pytz
 import socapp.tests.test_helpers as helpers
 
 from socapp.models import *
+import socapp.utils as utils
 from socapp_auth.models import UserProfile, TournamentPoints
 
 
@@ -299,6 +302,29 @@ class FixtureTests(TestCase):
         self.assertEquals(self.fixture.team1.games_drawn, 0)
         self.assertEquals(self.fixture.team2.games_drawn, 0)
 
+
+    # Fixtures are found by a range on match_date, counting days in the given time zone
+    def test_fixtures_on_day(self):
+        kickoff = timezone.make_aware(datetime.datetime(2030, 6, 14, 23, 30), pytz.utc)
+        Fixture.objects.filter(pk=self.fixture.pk).update(match_date=kickoff)
+        self.fixture.refresh_from_db()
+        self.assertEqual(list(Fixture.objects.on_day(datetime.date(2030, 6, 14), 'UTC')), [self.fixture])
+        self.assertFalse(Fixture.objects.on_day(datetime.date(2030, 6, 14), 'Europe/Moscow').exists()) # 02:30 on the 15th there
+        self.assertEqual(list(Fixture.objects.on_day(datetime.date(2030, 6, 15), 'Europe/Moscow')), [self.fixture])
+        self.assertEqual(list(Fixture.objects.between(kickoff, kickoff + datetime.timedelta(minutes=1))), [self.fixture])
+        self.assertFalse(Fixture.objects.between(kickoff - datetime.timedelta(hours=1), kickoff).exists())
+
+        # The tournament's days are counted in its own time zone
+        self.tournament.time_zone = 'Europe/Moscow'
+        self.tournament.save()
+        self.assertEqual(list(self.tournament.todays_fixtures(now=kickoff)), [self.fixture])
+        self.assertIsNone(Fixture.todays_fixtures(tz='America/New_York', now=kickoff + datetime.timedelta(days=1)))
+
+    def test_day_bounds_across_clock_change(self):
+        start, end = utils.day_bounds(datetime.date(2030, 3, 31), 'Europe/London')
+        self.assertEqual(end - start, datetime.timedelta(hours=23))
+
+
 class AnswerTests(TestCase):
     fixtures = ['tournaments.json', 'teams.json', 'games.json']
     
@@ -344,4 +370,35 @@ class AnswerTests(TestCase):
     #     # Assert the list matches expected values
     #     expected = ["Russia", "Saudi Arabia", "Egypt", "Uruguay"]
     #     team_names = list(team_set.values_list('name', flat=True))
-    #     self.assertEquals(team_names, expected)
\ No newline at end of file
+    #     self.assertEquals(team_names, expected)
+
+# Checks that SQLite's query planner uses the indexes declared in the models' Meta for the main queries
+@skipUnless(connection.vendor == 'sqlite', "The query plans are only checked on SQLite")
+class IndexUsageTests(TestCase):
+
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            return " ".join(row[-1] for row in cursor.fetchall())
+
+    def assertUsesIndex(self, queryset, model, fields):
+        index = next(index for index in model._meta.indexes if index.fields == fields)
+        self.assertIn(index.name, self.query_plan(queryset))
+
+    def test_fixture_indexes(self):
+        tournament = Tournament.objects.first()
+        self.assertUsesIndex(tournament.all_fixtures_by_stage(Fixture.GROUP).order_by('match_date'), Fixture, ['tournament', 'stage', 'match_date'])
+        self.assertUsesIndex(Fixture.objects.filter(status=Fixture.MATCH_STATUS_NOT_PLAYED).order_by('match_date'), Fixture, ['status', 'match_date'])
+        self.assertUsesIndex(tournament.open_fixtures(), Fixture, ['tournament', 'locks_at'])
+
+    def test_answer_index(self):
+        fixture = Fixture.objects.first()
+        self.assertUsesIndex(Answer.objects.filter(fixture=fixture, points_added=True), Answer, ['fixture', 'points_added'])
+
+    def test_points_indexes(self):
+        self.assertUsesIndex(UserProfile.objects.filter(points__gt=5), UserProfile, ['-points', 'user'])
+        tournament = Tournament.objects.first()
+        self.assertUsesIndex(TournamentPoints.objects.filter(tournament=tournament, points__gt=5), TournamentPoints, ['tournament', 'points'])
@@ -0,0 +1,192 @@
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+import datetime, json
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+from socapp import predictions
+
+"""
+Tests for submitting users' predictions in bulk.
+"""
+
+class SubmitPredictionsTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.user = helpers.generate_user()
+        self.fixtures = list(Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('match_date'))
+        self.now = self.fixtures[0].match_date - datetime.timedelta(days=1) # Before every fixture's cutoff
+
+    def prediction(self, fixture, team1_goals, team2_goals, **flags):
+        return dict(fixture=fixture, team1_goals=team1_goals, team2_goals=team2_goals, **flags)
+
+    def test_statuses(self):
+        first, second, third = self.fixtures[:3]
+        helpers.generate_answer(self.user, first, 1, 1)
+        helpers.generate_answer(self.user, second, 2, 0)
+        statuses = predictions.submit_predictions(self.user, [
+            self.prediction(first, 1, 1),
+            self.prediction(second, 3, 0),
+            self.prediction(third.pk, 0, 1),
+            self.prediction(self.fixtures[3], None, 2),
+            self.prediction(999999, 1, 0),
+        ], now=self.now)
+
+        self.assertEqual(statuses, {
+            first.pk: predictions.UNCHANGED,
+            second.pk: predictions.UPDATED,
+            third.pk: predictions.CREATED,
+            self.fixtures[3].pk: predictions.REJECTED_INCOMPLETE,
+            999999: predictions.REJECTED_UNKNOWN_FIXTURE,
+        })
+        self.assertEqual(Answer.objects.get(user=self.user, fixture=second).team1_goals, 3)
+        self.assertEqual(Answer.objects.get(user=self.user, fixture=third).team2_goals, 1)
+        self.assertEqual(Answer.objects.filter(user=self.user).count(), 3)
+
+    def test_locked_fixtures_are_rejected(self):
+        late = self.fixtures[0].match_date - datetime.timedelta(minutes=30)
+        statuses = predictions.submit_predictions(self.user, [self.prediction(self.fixtures[0], 1, 0)], now=late)
+        self.assertEqual(statuses[self.fixtures[0].pk], predictions.REJECTED_LOCKED)
+        self.assertFalse(Answer.objects.exists())
+
+    def test_penalties_imply_extra_time(self):
+        predictions.submit_predictions(self.user, [self.prediction(self.fixtures[0], 1, 1, has_penalties=True)], now=self.now)
+        answer = Answer.objects.get()
+        self.assertTrue(answer.has_extra_time and answer.has_penalties)
+
+    # A whole group stage is written with a fixed number of queries, whether the answers are new or changed
+    def test_query_count_for_whole_stage(self):
+        new = [self.prediction(f, i % 4, i % 3) for i, f in enumerate(self.fixtures)]
+        with self.assertNumQueries(5): # Fixtures, existing answers, and the bulk insert inside a savepoint
+            predictions.submit_predictions(self.user, new, now=self.now)
+
+        changed = [self.prediction(f, 5, 5) for f in self.fixtures]
+        with self.assertNumQueries(5): # Fixtures, existing answers, and one update (all changes have the same values) inside a savepoint
+            statuses = predictions.submit_predictions(self.user, changed, now=self.now)
+        self.assertEqual(set(statuses.values()), {predictions.UPDATED})
+        self.assertEqual(Answer.objects.filter(user=self.user, team1_goals=5, team2_goals=5).count(), len(self.fixtures))
+
+    def test_group_stage_form_submission(self):
+        Fixture.objects.update(match_date=timezone.now() + datetime.timedelta(days=7)) # Open every fixture for predictions
+        self.client.force_login(self.user)
+        fixtures = Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('team1__group', 'match_date')
+        data = {'form-TOTAL_FORMS': len(fixtures), 'form-INITIAL_FORMS': 0, 'form-MAX_NUM_FORMS': len(fixtures)}
+        for i, fixture in enumerate(fixtures):
+            data.update({'form-{}-fixture'.format(i): fixture.pk, 'form-{}-team1_goals'.format(i): 1, 'form-{}-team2_goals'.format(i): 0})
+
+        response = self.client.post(reverse('answer_form_selected', kwargs={'stage': 'group_stage'}), data)
+        self.assertRedirects(response, reverse('profile'), fetch_redirect_response=False)
+        self.assertEqual(Answer.objects.filter(user=self.user, team1_goals=1, team2_goals=0).count(), len(fixtures))
+
+
+class PredictionsApiTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.user = helpers.generate_user()
+        Fixture.objects.update(match_date=timezone.now() + datetime.timedelta(days=7))
+        self.fixtures = list(Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('team1__group', 'match_date'))
+        self.url = reverse('api_predictions', kwargs={'stage': 'group_stage'})
+        self.client.force_login(self.user)
+
+    def put(self, data):
+        return self.client.put(self.url, json.dumps(data), content_type='application/json')
+
+    def test_get_stage_predictions(self):
+        helpers.generate_answer(self.user, self.fixtures[0], 3, 1)
+        with self.assertNumQueries(5): # session, user, current tournament, fixtures, answers
+            response = self.client.get(self.url)
+        data = response.json()['fixtures']
+        self.assertEqual([f['fixture'] for f in data], [f.pk for f in self.fixtures])
+        self.assertEqual(data[0]['prediction']['team1_goals'], 3)
+        self.assertIsNone(data[1]['prediction'])
+        self.assertFalse(data[0]['locked'])
+
+    def test_get_undated_fixture(self):
+        Fixture.objects.filter(pk=self.fixtures[0].pk).update(match_date=None)
+        data = self.client.get(self.url).json()['fixtures']
+        undated = next(f for f in data if f['fixture'] == self.fixtures[0].pk)
+        self.assertIsNone(undated['match_date'])
+        self.assertIsNone(undated['locks_at'])
+        self.assertTrue(undated['locked'])
+        self.assertFalse(data[1]['locked'])
+
+    def test_put_predictions(self):
+        final = self.fixtures[-1]
+        knockout = helpers.generate_fixture(final.team1, final.team2, final.match_date, stage=Fixture.FINAL)
+        response = self.put({'predictions': [
+            {'fixture': self.fixtures[0].pk, 'team1_goals': 2, 'team2_goals': 2},
+            {'fixture': self.fixtures[1].pk, 'team1_goals': 1},
+            {'fixture': knockout.pk, 'team1_goals': 1, 'team2_goals': 0}, # Not a group stage fixture
+        ]})
+        self.assertEqual(response.json()['results'], {
+            str(self.fixtures[0].pk): predictions.CREATED,
+            str(self.fixtures[1].pk): predictions.REJECTED_INCOMPLETE,
+            str(knockout.pk): predictions.REJECTED_UNKNOWN_FIXTURE,
+        })
+        self.assertEqual(Answer.objects.get(user=self.user).fixture, self.fixtures[0])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.put({'predictions': [{'fixture': self.fixtures[0].pk, 'team1_goals': 11, 'team2_goals': 0}]}).status_code, 400)
+        self.assertEqual(self.put({'predictions': [{'fixture': "one", 'team1_goals': 1, 'team2_goals': 0}]}).status_code, 400)
+        self.assertEqual(self.put({'fixture': self.fixtures[0].pk}).status_code, 400)
+        self.assertEqual(self.client.put(self.url, "not json", content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.delete(self.url).status_code, 405)
+        self.assertEqual(self.client.get(reverse('api_predictions', kwargs={'stage': 'nonsense'})).status_code, 404)
+        self.assertFalse(Answer.objects.exists())
+
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+
+class FixtureLockTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixture = self.tournament.all_fixtures_by_group("A")[0]
+
+    def test_locks_at_follows_match_date(self):
+        # Set for fixtures loaded from JSON as well as saved ones
+        self.assertEqual(self.fixture.locks_at, self.fixture.match_date - predictions.PREDICTION_CUTOFF)
+        self.assertTrue(self.fixture.is_locked)
+
+        kickoff = timezone.now() + datetime.timedelta(days=1)
+        self.fixture.match_date = kickoff
+        self.fixture.save()
+        self.fixture.refresh_from_db()
+        self.assertEqual(self.fixture.locks_at, kickoff - predictions.PREDICTION_CUTOFF)
+        self.assertFalse(self.fixture.is_locked)
+
+        Fixture.objects.filter(pk=self.fixture.pk).update(match_date=None)
+        self.assertIsNone(Fixture.objects.get(pk=self.fixture.pk).locks_at)
+
+    # Rescheduling in bulk unlocks fixtures moved later, and locks those moved earlier
+    def test_bulk_reschedule_updates_lock(self):
+        self.assertTrue(self.fixture.is_locked)
+        Fixture.objects.filter(pk=self.fixture.pk).update(match_date=timezone.now() + datetime.timedelta(days=1))
+        self.fixture.refresh_from_db()
+        self.assertFalse(self.fixture.is_locked)
+        self.assertTrue(self.fixture.is_open())
+
+        Fixture.objects.filter(pk=self.fixture.pk).update(match_date=timezone.now() - datetime.timedelta(days=1))
+        self.fixture.refresh_from_db()
+        self.assertTrue(self.fixture.is_locked)
+
+    def test_open_fixtures_and_sweeper(self):
+        now = timezone.now()
+        Fixture.objects.update(match_date=now + datetime.timedelta(hours=3))
+        Fixture.objects.filter(pk=self.fixture.pk).update(match_date=now + datetime.timedelta(hours=1))
+        Fixture.objects.update(is_locked=False)
+
+        total = Fixture.objects.count()
+        self.assertEqual(self.tournament.open_fixtures().count(), total - 1)
+        self.assertEqual([f.pk for f in Fixture.objects.locked()], [self.fixture.pk])
+        self.assertFalse(Fixture.objects.with_open_flag().get(pk=self.fixture.pk).predictions_open)
+
+        self.assertEqual(predictions.lock_due_fixtures(), 1)
+        self.assertEqual(predictions.lock_due_fixtures(), 0)
+        self.assertEqual(predictions.lock_due_fixtures(now + datetime.timedelta(hours=2)), total - 1)
+        self.assertFalse(Fixture.objects.filter(is_locked=False).exists())
@@ -0,0 +1,291 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from unittest import mock
+import datetime
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+from socapp_auth.models import UserProfile
+import socapp.ranking as ranking
+import socapp.cache as results_cache
+import socapp.utils as utils
+
+"""
+Tests for the stored rank snapshots, which are rewritten after each scoring pass.
+"""
+
+class RankSnapshotTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.fixtures = self.tournament.all_fixtures_by_group("A")
+        self.alice = helpers.generate_user(username="alice")
+        self.bob = helpers.generate_user(username="bob")
+        self.carol = helpers.generate_user(username="carol")
+        self.leaderboard = Leaderboard.objects.create(name="Office")
+        self.leaderboard.users.add(self.alice, self.carol)
+
+        # alice predicts a home win in both games, bob an away win and carol a draw
+        for fixture in self.fixtures[:2]:
+            helpers.generate_answer(self.alice, fixture, 2, 0)
+            helpers.generate_answer(self.bob, fixture, 0, 2)
+            helpers.generate_answer(self.carol, fixture, 1, 1)
+
+    def snapshot(self, user, **board):
+        return UserRankSnapshot.objects.get(user=user, **ranking.snapshot_board(**board))
+
+    def test_snapshots_written_after_result(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+
+        self.assertEqual(self.snapshot(self.alice).rank, 1)
+        self.assertEqual(self.snapshot(self.bob).rank, 2)
+        self.assertEqual(self.snapshot(self.carol).rank, 2)
+        self.assertEqual(self.snapshot(self.alice, tournament=self.tournament).points, 5)
+        self.assertEqual(self.snapshot(self.carol, leaderboard=self.leaderboard).rank, 2)
+        self.assertFalse(UserRankSnapshot.objects.filter(user=self.bob, leaderboard=self.leaderboard).exists())
+
+        # The stored ranks agree with the live ranking
+        for user in (self.alice, self.bob, self.carol):
+            self.assertEqual(ranking.stored_rank(user), user.profile.get_ranking())
+
+    def test_previous_rank_and_climbers(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        helpers.play_match(self.fixtures[1], 0, 3)
+        helpers.play_match(self.fixtures[0], 0, 1)
+
+        # bob has gone from second to first, carol from third to second, and alice from first to second
+        bob = self.snapshot(self.bob)
+        self.assertEqual((bob.previous_rank, bob.rank, bob.movement), (2, 1, 1))
+        self.assertEqual(self.snapshot(self.carol).movement, 1)
+        self.assertEqual(self.snapshot(self.alice).movement, -1)
+        climbers, places = ranking.biggest_climbers()
+        self.assertEqual((sorted(u.username for u in climbers), places), (["bob", "carol"], 1))
+
+    def test_unchanged_boards_are_not_rewritten(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        self.assertEqual(ranking.refresh_rank_snapshots(), 0)
+
+    # Only the rows of users whose points or rank have changed are rewritten
+    def test_only_changed_ranks_are_written(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        alice = self.snapshot(self.alice)
+        helpers.play_match(self.fixtures[1], 5, 5)
+
+        # alice stays top on 5 points, carol (4 points) stays second and bob (1 point) drops to third
+        self.assertEqual(self.snapshot(self.alice).pk, alice.pk)
+        self.assertEqual(self.snapshot(self.alice).updated, alice.updated)
+        self.assertEqual([(s.user, s.points, s.rank, s.previous_rank) for s in UserRankSnapshot.objects.filter(**ranking.snapshot_board())],
+                         [(self.alice, 5, 1, None), (self.carol, 4, 2, 2), (self.bob, 1, 3, 2)])
+
+    # Leaderboards where nobody predicted the fixture are left alone
+    def test_only_affected_leaderboards_are_refreshed(self):
+        dave = helpers.generate_user(username="dave")
+        neighbours = Leaderboard.objects.create(name="Neighbours")
+        neighbours.users.add(dave, self.bob)
+        self.assertEqual(sorted(ranking.affected_leaderboards([self.fixtures[0]])), sorted([self.leaderboard.pk, neighbours.pk]))
+        neighbours.users.remove(self.bob)
+        with mock.patch('socapp.ranking.write_snapshot', wraps=ranking.write_snapshot) as write_snapshot:
+            helpers.play_match(self.fixtures[0], 2, 0)
+        boards = [call[0][0] for call in write_snapshot.call_args_list]
+        self.assertIn(ranking.snapshot_board(leaderboard=self.leaderboard), boards)
+        self.assertNotIn(ranking.snapshot_board(leaderboard=neighbours), boards)
+
+    def test_leaderboard_membership_changes(self):
+        helpers.play_match(self.fixtures[0], 1, 1)
+        self.assertEqual(ranking.stored_rank(self.alice, leaderboard=self.leaderboard), 2)
+
+        # carol has 5 points, alice and bob one each
+        self.leaderboard.users.add(self.bob)
+        self.assertEqual(self.snapshot(self.bob, leaderboard=self.leaderboard).rank, 2)
+        self.leaderboard.users.remove(self.carol)
+        self.assertEqual(ranking.stored_rank(self.alice, leaderboard=self.leaderboard), 1)
+        self.assertEqual(ranking.stored_rank(self.bob, leaderboard=self.leaderboard), 1)
+        self.bob.leaderboard_set.clear()
+        self.assertEqual(list(ranking.stored_ranks(leaderboard=self.leaderboard)), [self.alice.pk])
+
+    # Users who joined after the last scoring pass are ranked live
+    def test_stored_rank_falls_back_for_new_users(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        dave = helpers.generate_user(username="dave")
+        self.assertFalse(UserRankSnapshot.objects.filter(user=dave).exists())
+        self.assertEqual(ranking.stored_rank(dave), 4)
+        self.assertEqual(ranking.stored_rank(dave, tournament=self.tournament), 4)
+
+    def test_leaderboard_pages_show_movement(self):
+        helpers.play_match(self.fixtures[0], 2, 0)
+        helpers.play_match(self.fixtures[0], 1, 1)
+        self.client.force_login(self.carol)
+        response = self.client.get(reverse('global_leaderboard'))
+        self.assertEqual(response.context['best_users'], [self.carol])
+        self.assertContains(response, "Biggest climber(s)")
+        response = self.client.get(reverse('show_leaderboard', kwargs={'leaderboard': self.leaderboard.slug}))
+        self.assertEqual(response.context['ranks'][self.carol.pk].rank, 1)
+        self.assertEqual(self.client.get(reverse('friends_leaderboard')).status_code, 200)
+
+
+class GlobalBoardPaginationTests(TestCase):
+    PAGE_SIZE = 4
+
+    def setUp(self):
+        # 11 users, with several ties on points
+        points = [9, 7, 7, 7, 5, 4, 4, 2, 0, 0, 0]
+        self.users = []
+        for i, pts in enumerate(points):
+            user = helpers.generate_user(username="user{}".format(i))
+            UserProfile.objects.filter(user=user).update(points=pts)
+            self.users.append(user)
+        self.expected = [u.username for u in get_user_model().objects.order_by('-profile__points', 'pk')]
+
+    def page(self, **kwargs):
+        return ranking.global_board_page(page_size=self.PAGE_SIZE, **kwargs)
+
+    def test_walk_forwards_and_backwards(self):
+        pages = [self.page()]
+        while pages[-1].has_next:
+            pages.append(self.page(after=pages[-1].next_cursor))
+        self.assertEqual([u.username for page in pages for u in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [4, 4, 3])
+        self.assertFalse(pages[0].has_previous)
+
+        # Going back from the last page gives the same pages
+        back = self.page(before=pages[-1].previous_cursor)
+        self.assertEqual([u.username for u in back], [u.username for u in pages[1]])
+        self.assertEqual([u.username for u in self.page(before=back.previous_cursor)], [u.username for u in pages[0]])
+
+    # The ranks shown on each page are the users' competition ranks, including ties across page boundaries
+    def test_page_ranks(self):
+        page = self.page()
+        while True:
+            for user in page:
+                self.assertEqual(user.board_rank, user.profile.get_ranking())
+            if not page.has_next:
+                break
+            page = self.page(after=page.next_cursor)
+
+    def test_around_user(self):
+        target = self.users[7]
+        page = self.page(around_user=target)
+        usernames = [u.username for u in page]
+        self.assertEqual(usernames.index(target.username), self.PAGE_SIZE // 2)
+        self.assertEqual(usernames, self.expected[5:9])
+        self.assertTrue(page.has_previous and page.has_next)
+
+        # Near the end of the board, the page is shorter rather than shifted
+        last = self.page(around_user=self.users[-1])
+        self.assertEqual([u.username for u in last], self.expected[-3:])
+        self.assertFalse(last.has_next)
+
+    def test_invalid_cursor_gives_first_page(self):
+        self.assertEqual([u.username for u in self.page(after="nonsense")], self.expected[:self.PAGE_SIZE])
+
+    # Later pages take the same number of queries as the first one
+    def test_page_queries_are_constant(self):
+        first = self.page()
+        with self.assertNumQueries(3):
+            self.page(after=first.next_cursor)
+        with self.assertNumQueries(3):
+            self.page()
+
+    def test_global_leaderboard_view(self):
+        self.client.force_login(self.users[7])
+        response = self.client.get(reverse('global_leaderboard'), {'around': 'me'})
+        self.assertIn(self.users[7], response.context['members'])
+        self.assertLessEqual(len(response.context['members']), ranking.LEADERBOARD_PAGE_SIZE)
+        self.assertContains(response, "My position")
+
+
+class BoardStatsTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.users = []
+        for i, pts in enumerate([10, 6, 6, 3, 0]):
+            user = helpers.generate_user(username="user{}".format(i))
+            UserProfile.objects.filter(user=user).update(points=pts)
+            self.users.append(user)
+        self.leaderboard = Leaderboard.objects.create(name="Office")
+        self.leaderboard.users.add(*self.users[1:4])
+        results_cache.bump_results_version() # The points were changed without a scoring pass
+
+    def test_global_stats(self):
+        stats = ranking.board_stats()
+        self.assertEqual(stats['members_count'], 5)
+        self.assertEqual(stats['total_points'], 25)
+        self.assertEqual(stats['average_points'], 5)
+        self.assertEqual(stats['percent_above_average'], 60)
+        self.assertEqual((stats['min_points'], stats['max_points'], stats['median_points']), (0, 10, 6))
+
+    def test_leaderboard_and_friends_stats(self):
+        self.assertEqual(self.leaderboard.total_points(), 15)
+        self.assertEqual(self.leaderboard.avg_points_per_user(), 5)
+        self.assertAlmostEqual(self.leaderboard.percent_above_avg_points(), 200 / 3)
+
+        self.users[4].profile.friends.add(self.users[0], self.users[3])
+        stats = ranking.board_stats(friends_of_user=self.users[4])
+        self.assertEqual((stats['members_count'], stats['median_points']), (3, 3))
+
+        empty = Leaderboard.objects.create(name="Empty")
+        self.assertIsNone(empty.avg_points_per_user())
+        self.assertEqual(ranking.board_stats(leaderboard=empty)['median_points'], None)
+
+    # An even number of members has the mean of the middle two as the median
+    def test_median_of_even_board(self):
+        self.assertEqual(ranking.stats_from_histogram([(6, 1), (5, 2), (1, 1)])['median_points'], 5)
+        self.assertEqual(ranking.stats_from_histogram([(8, 1), (4, 1)])['median_points'], 6)
+
+    def test_stats_are_one_query_then_cached_until_scoring(self):
+        version = results_cache.results_version()
+        with self.assertNumQueries(1):
+            ranking.board_stats(leaderboard=self.leaderboard, version=version)
+        with self.assertNumQueries(0):
+            ranking.board_stats(leaderboard=self.leaderboard, version=version)
+
+        fixture = Tournament.objects.first().all_fixtures_by_group("A")[0]
+        helpers.generate_answer(self.users[4], fixture, 2, 1)
+        helpers.play_match(fixture, 2, 1)
+        self.assertEqual(ranking.board_stats()['total_points'], 30)
+
+
+class DailyPerformanceTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.users = [helpers.generate_user(username=name) for name in ("alice", "bob", "carol", "dave")]
+        self.leaderboard = Leaderboard.objects.create(name="Office")
+        self.leaderboard.users.add(*self.users[1:])
+
+        # Two of today's fixtures, and one from yesterday
+        now = timezone.now()
+        self.today, self.yesterday = timezone.localdate(now), timezone.localdate(now - datetime.timedelta(days=1))
+        fixtures = list(Tournament.objects.first().all_fixtures_by_group("A")[:3])
+        for fixture, day in zip(fixtures, (self.today, self.today, self.yesterday)):
+            Fixture.objects.filter(pk=fixture.pk).update(match_date=utils.day_bounds(day)[0] + datetime.timedelta(hours=12))
+
+        # alice gets 5 + 5 today, bob and carol 2 + 0, and dave nothing (his exact score was yesterday)
+        scores = {"alice": [(2, 0), (1, 1)], "bob": [(1, 0), (0, 3)], "carol": [(3, 0), (0, 4)], "dave": [(0, 5), (0, 4), (1, 2)]}
+        for user in self.users:
+            for fixture, (t1, t2) in zip(fixtures, scores[user.username]):
+                helpers.generate_answer(user, fixture, t1, t2)
+        for fixture, (t1, t2) in zip(fixtures, [(2, 0), (1, 1), (1, 2)]):
+            helpers.play_match(Fixture.objects.get(pk=fixture.pk), t1, t2)
+
+    def test_global_and_leaderboard(self):
+        with self.assertNumQueries(2):
+            stats = utils.user_daily_performance(day=self.today)
+        self.assertEqual(([u.username for u in stats['best_users']], stats['best_points']), (["alice"], 10))
+        self.assertEqual(([u.username for u in stats['worst_users']], stats['worst_points']), (["dave"], 0))
+
+        stats = utils.user_daily_performance(self.leaderboard, day=self.today)
+        self.assertEqual(([u.username for u in stats['best_users']], stats['best_points']), (["bob", "carol"], 2))
+        self.assertEqual(utils.user_daily_performance(self.leaderboard, day=self.yesterday)['best_users'], [self.users[3]])
+
+    def test_no_results_on_day(self):
+        self.assertIsNone(utils.user_daily_performance(day=self.today + datetime.timedelta(days=1)))
+
+    def test_shown_on_leaderboard_page(self):
+        self.client.force_login(self.users[1])
+        response = self.client.get(reverse('show_leaderboard', kwargs={'leaderboard': self.leaderboard.slug}))
+        self.assertContains(response, "Today's best")
@@ -0,0 +1,148 @@
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from io import StringIO
+from unittest import mock
+import socapp.tests.test_helpers as helpers
+
+from socapp.models import *
+from socapp import tasks
+
+"""
+Tests for the queue of result jobs, which applies fixture results to the Team models and user points in the background.
+"""
+
+@override_settings(RESULT_JOBS_ASYNC=True)
+class ResultJobQueueTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def setUp(self):
+        self.user = helpers.generate_user()
+        self.tournament = Tournament.objects.first()
+        self.fixture = self.tournament.all_fixtures_by_group("A")[0] # Russia vs Saudi Arabia
+        helpers.generate_answer(self.user, self.fixture, 2, 1)
+
+    def refresh(self):
+        self.user.refresh_from_db()
+        self.fixture.team1.refresh_from_db()
+
+    def test_save_only_queues_the_result(self):
+        helpers.play_match(self.fixture, 2, 1)
+        self.refresh()
+        job = ResultJob.objects.get()
+        self.assertEqual(job.status, ResultJob.STATUS_PENDING)
+        self.assertEqual(self.fixture.team1.games_played, 0)
+        self.assertEqual(self.user.profile.points, 0)
+
+        self.assertEqual(tasks.process_pending_jobs(), 1)
+        self.refresh()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ResultJob.STATUS_PROCESSED)
+        self.assertIsNotNone(job.processed_at)
+        self.assertEqual(self.fixture.team1.games_played, 1)
+        self.assertEqual(self.fixture.team1.games_won, 1)
+        self.assertEqual(self.user.profile.points, 5)
+
+    def test_saves_which_dont_change_the_result_are_not_queued(self):
+        self.fixture.save()
+        self.assertFalse(ResultJob.objects.exists())
+        helpers.play_match(self.fixture, 2, 1)
+        self.fixture.save()
+        self.assertEqual(ResultJob.objects.count(), 1)
+
+    def test_jobs_are_only_applied_once(self):
+        helpers.play_match(self.fixture, 2, 1)
+        job = ResultJob.objects.get()
+        self.assertTrue(tasks.process_job(job))
+        self.assertFalse(tasks.process_job(job))
+        self.assertEqual(tasks.process_pending_jobs(), 0)
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_played, 1)
+        self.assertEqual(self.user.profile.points, 5)
+
+    # Several changes to the same fixture are applied in the order they were made
+    def test_jobs_are_applied_in_order(self):
+        helpers.play_match(self.fixture, 1, 1)
+        helpers.play_match(self.fixture, 2, 1)
+        helpers.play_match(self.fixture, None, None)
+        helpers.play_match(self.fixture, 3, 0)
+        self.assertEqual(tasks.process_pending_jobs(), 4)
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_played, 1)
+        self.assertEqual(self.fixture.team1.goals_for, 3)
+        self.assertEqual(self.fixture.team1.goals_against, 0)
+        self.assertEqual(self.user.profile.points, 3)
+        self.assertEqual(self.user.profile.get_tournament_points(self.tournament), 3)
+
+    def test_failed_jobs_are_retried_then_block_the_fixture(self):
+        helpers.play_match(self.fixture, 1, 1)
+        helpers.play_match(self.fixture, 2, 1)
+        first, second = ResultJob.objects.all()
+
+        with mock.patch('socapp.utils.apply_result_change', side_effect=RuntimeError("Database went away")), \
+                self.assertLogs('socapp.tasks', level='ERROR'):
+            for attempt in range(1, ResultJob.MAX_ATTEMPTS + 1):
+                self.assertEqual(tasks.process_pending_jobs(), 0)
+                first.refresh_from_db()
+                self.assertEqual(first.attempts, attempt)
+
+        self.assertEqual(first.status, ResultJob.STATUS_FAILED)
+        self.assertIn("Database went away", first.error)
+
+        # The second job must not be applied before the first one
+        self.assertEqual(tasks.process_pending_jobs(), 0)
+        second.refresh_from_db()
+        self.assertEqual(second.status, ResultJob.STATUS_PENDING)
+
+        # Nothing from the failed attempts should have been written
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_played, 0)
+        self.assertEqual(self.user.profile.points, 0)
+
+        self.assertEqual(tasks.retry_failed_jobs(), 1)
+        self.assertEqual(tasks.process_pending_jobs(), 2)
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_won, 1)
+        self.assertEqual(self.user.profile.points, 5)
+
+    def test_process_results_command(self):
+        helpers.play_match(self.fixture, 2, 1)
+        out = StringIO()
+        call_command('process_results', once=True, stdout=out)
+        self.assertIn("Processed 1 job(s)", out.getvalue())
+        self.assertIn("0 job(s) pending, 0 failed", out.getvalue())
+        self.refresh()
+        self.assertEqual(self.user.profile.points, 5)
+
+    # Deleting a fixture applies its queued result before removing it again
+    def test_deleting_fixture_with_pending_job(self):
+        helpers.play_match(self.fixture, 2, 1)
+        self.fixture.delete()
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_played, 0)
+        self.assertEqual(self.user.profile.points, 0)
+
+    # Only the results which were applied are taken away again when a fixture with failed jobs is deleted
+    def test_deleting_fixture_with_failed_job(self):
+        helpers.play_match(self.fixture, 2, 1)
+        self.assertEqual(tasks.process_pending_jobs(), 1)
+        helpers.play_match(self.fixture, 3, 1)
+        with mock.patch('socapp.utils.apply_result_change', side_effect=RuntimeError("Database went away")), \
+                self.assertLogs('socapp.tasks', level='ERROR'):
+            for _ in range(ResultJob.MAX_ATTEMPTS - 1):
+                tasks.process_pending_jobs()
+            self.fixture.delete()
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_played, 0)
+        self.assertEqual(self.fixture.team1.goals_for, 0)
+        self.assertEqual(self.user.profile.points, 0)
+
+    # A fixture whose only job failed never had its result applied, so there's nothing to take away
+    def test_deleting_fixture_with_no_applied_result(self):
+        helpers.play_match(self.fixture, 2, 1)
+        with mock.patch('socapp.utils.apply_result_change', side_effect=RuntimeError("Database went away")), \
+                self.assertLogs('socapp.tasks', level='ERROR'):
+            self.fixture.delete()
+        self.refresh()
+        self.assertEqual(self.fixture.team1.games_played, 0)
+        self.assertEqual(self.fixture.team1.goals_for, 0)
+        self.assertEqual(self.user.profile.points, 0)
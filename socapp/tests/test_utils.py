@@ -0,0 +1,121 @@
+from django.test import SimpleTestCase
+from unittest import mock
+import random
+
+from socapp.models import Fixture, Answer
+from socapp import scoring
+import socapp.utils as utils
+
+"""
+Tests for the helpers in socapp.utils which don't need the database.
+"""
+
+class CalculatePointsBatchTests(SimpleTestCase):
+    """
+    The batch scorer must give exactly the same points as calculate_points for every prediction.
+    Fixtures and predictions are generated randomly (with a fixed seed), including knockout fixtures which can go to extra time/penalties.
+    """
+    MAX_GOALS = 10
+    NUM_FIXTURES = 200
+    PREDICTIONS_PER_FIXTURE = 50
+
+    def setUp(self):
+        self.random = random.Random(2018)
+
+    def random_fixture(self):
+        can_be_over_90 = self.random.random() < 0.5
+        has_extra_time = can_be_over_90 and self.random.random() < 0.5
+        return Fixture(
+            team1_goals=self.random.randint(0, self.MAX_GOALS),
+            team2_goals=self.random.randint(0, self.MAX_GOALS),
+            can_be_over_90=can_be_over_90,
+            has_extra_time=has_extra_time,
+            has_penalties=has_extra_time and self.random.random() < 0.5,
+        )
+
+    def random_answer(self):
+        return Answer(
+            team1_goals=self.random.randint(0, self.MAX_GOALS),
+            team2_goals=self.random.randint(0, self.MAX_GOALS),
+            has_extra_time=self.random.random() < 0.5,
+            has_penalties=self.random.random() < 0.5,
+        )
+
+    def test_batch_matches_scalar(self):
+        for _ in range(self.NUM_FIXTURES):
+            fixture = self.random_fixture()
+            answers = [self.random_answer() for _ in range(self.PREDICTIONS_PER_FIXTURE)]
+            batch_points = utils.calculate_points_batch(fixture, *utils.prediction_arrays(answers))
+            self.assertEqual(list(batch_points), [utils.calculate_points(fixture, a) for a in answers])
+
+    # Every possible scoreline/flag combination, against every possible result of a knockout fixture
+    def test_batch_matches_scalar_exhaustively(self):
+        goals = range(0, 5)
+        predictions = [(t1, t2, et, pens) for t1 in goals for t2 in goals for et in (False, True) for pens in (False, True)]
+        team1_goals, team2_goals, has_extra_time, has_penalties = zip(*predictions)
+        for t1 in goals:
+            for t2 in goals:
+                for fixture_et, fixture_pens in [(False, False), (True, False), (True, True)]:
+                    fixture = Fixture(team1_goals=t1, team2_goals=t2, can_be_over_90=True,
+                                      has_extra_time=fixture_et, has_penalties=fixture_pens)
+                    expected = [utils.calculate_points(fixture, utils.Prediction(*p)) for p in predictions]
+                    batch_points = utils.calculate_points_batch(fixture, team1_goals, team2_goals, has_extra_time, has_penalties)
+                    self.assertEqual(list(batch_points), expected)
+
+    # The extra time/penalties flags are optional (group stage predictions don't have them)
+    def test_batch_without_flags(self):
+        fixture = Fixture(team1_goals=2, team2_goals=1)
+        self.assertEqual(list(utils.calculate_points_batch(fixture, [2, 1, 0, 3], [1, 0, 0, 1])), [5, 3, 0, 2])
+
+    # Repeated predictions are only scored once
+    def test_each_distinct_prediction_scored_once(self):
+        fixture = Fixture(team1_goals=2, team2_goals=1)
+        with mock.patch('socapp.scoring.PointsTable.points', autospec=True, side_effect=scoring.PointsTable.points) as points:
+            batch_points = utils.calculate_points_batch(fixture, [2, 1, 2, 1, 2, 0] * 100, [1, 0, 1, 0, 1, 0] * 100)
+        self.assertEqual(list(batch_points), [5, 3, 5, 3, 5, 0] * 100)
+        self.assertEqual(points.call_count, 3)
+
+    def test_empty_batch(self):
+        fixture = Fixture(team1_goals=2, team2_goals=1)
+        self.assertEqual(len(utils.calculate_points_batch(fixture, [], [])), 0)
+
+class PointsTableTests(SimpleTestCase):
+    """ The compiled lookup tables must give the same points as scoring each prediction directly """
+
+    RESULT_FLAGS = [(False, False, False), (True, False, False), (True, True, False), (True, True, True)] # can_be_over_90, ET, pens
+    CUSTOM_RULES = scoring.Rules(exact_score=10, correct_outcome=3, goals_bonus=2, extra_time_correct=4, extra_time_wrong=-2,
+                                 penalties_correct=5, penalties_wrong=0)
+
+    def assertTableMatchesRules(self, rules):
+        table = scoring.points_table(rules)
+        goals = range(scoring.GOALS)
+        predictions = [utils.Prediction(t1, t2, et, pens) for t1 in goals for t2 in goals for et in (False, True) for pens in (False, True)]
+        for t1 in goals:
+            for t2 in goals:
+                for can_be_over_90, fixture_et, fixture_pens in self.RESULT_FLAGS:
+                    fixture = Fixture(team1_goals=t1, team2_goals=t2, can_be_over_90=can_be_over_90,
+                                      has_extra_time=fixture_et, has_penalties=fixture_pens)
+                    self.assertEqual([table.points(fixture, p) for p in predictions],
+                                     [scoring.calculate_points_directly(rules, fixture, p) for p in predictions])
+
+    def test_default_rules(self):
+        self.assertTableMatchesRules(scoring.DEFAULT_RULES)
+
+    def test_custom_rules(self):
+        self.assertTableMatchesRules(self.CUSTOM_RULES)
+        fixture = Fixture(team1_goals=2, team2_goals=1, can_be_over_90=True, has_extra_time=True, has_penalties=False)
+        table = scoring.points_table(self.CUSTOM_RULES)
+        self.assertEqual(table.points(fixture, utils.Prediction(2, 1, True, True)), 14)
+        self.assertEqual(table.points(fixture, utils.Prediction(1, 0, False, False)), 5)
+
+    # Scorelines beyond MAX_GOALS aren't in the table, so are scored directly
+    def test_scores_outside_table(self):
+        fixture = Fixture(team1_goals=12, team2_goals=1)
+        self.assertEqual(utils.calculate_points(fixture, utils.Prediction(12, 1, False, False)), 5)
+        self.assertEqual(utils.calculate_points(fixture, utils.Prediction(2, 1, False, False)), 2)
+        self.assertEqual(list(utils.calculate_points_batch(Fixture(team1_goals=2, team2_goals=0), [11, 2], [0, 0])), [2, 5])
+
+    # Fixtures without a tournament use the default rules
+    def test_fixture_rules(self):
+        self.assertEqual(scoring.fixture_rules(Fixture(team1_goals=1, team2_goals=0)), scoring.DEFAULT_RULES)
+        self.assertIs(scoring.points_table(), scoring.points_table(scoring.DEFAULT_RULES))
@@ -1,6 +1,113 @@
 from django.test import TestCase
+from django.urls import reverse
 import socapp.tests.test_helpers as helpers
 
 from socapp.models import *
+from socapp import views
 
 
+class AnswerFormTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    # Session, user, current tournament, group fixtures, the user's answers for them (no matter how many fixtures or answers there are),
+    # and the profile for the navbar
+    GROUP_STAGE_QUERIES = 6
+
+    def setUp(self):
+        self.user = helpers.generate_user()
+        self.client.force_login(self.user)
+        self.url = reverse('answer_form_selected', kwargs={'stage': 'group_stage'})
+        self.group_fixtures = list(Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('team1__group', 'match_date'))
+
+    def test_initial_data_for_answered_fixtures(self):
+        helpers.generate_answer(self.user, self.group_fixtures[0], 3, 1)
+        helpers.generate_answer(self.user, self.group_fixtures[5], 0, 0)
+        with self.assertNumQueries(1):
+            initial = views.get_initial_data(self.group_fixtures, self.user)
+        self.assertEqual(len(initial), len(self.group_fixtures))
+        self.assertEqual(initial[0], {'fixture': self.group_fixtures[0].id, 'team1_goals': 3, 'team2_goals': 1})
+        self.assertEqual(initial[5]['team2_goals'], 0)
+        self.assertEqual(initial[1], {'fixture': self.group_fixtures[1].id})
+
+        initial = views.get_initial_data(self.group_fixtures[:1], self.user, knockout=True)
+        self.assertEqual(initial[0]['has_extra_time'], False)
+
+    # The number of queries doesn't grow with the number of fixtures the user has answered
+    def test_group_stage_form_query_count(self):
+        with self.assertNumQueries(self.GROUP_STAGE_QUERIES):
+            self.client.get(self.url)
+
+        for fixture in self.group_fixtures:
+            helpers.generate_answer(self.user, fixture, 1, 0)
+        with self.assertNumQueries(self.GROUP_STAGE_QUERIES):
+            self.client.get(self.url)
+
+    # Only the current tournament's fixtures are offered, by the form and the predictions API
+    def test_only_current_tournament_fixtures(self):
+        league = Tournament.objects.get(name="UEFA Champions League 2018")
+        team1, team2 = self.group_fixtures[0].team1, self.group_fixtures[0].team2
+        league_fixture = Fixture.objects.create(team1=team1, team2=team2, tournament=league, match_date=league.start_date)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['management_form'].initial['TOTAL_FORMS'], 1)
+        self.assertContains(response, team1.name)
+        self.assertNotContains(response, self.group_fixtures[-1].team1.name) # A group H team, from the World Cup only
+        api_response = self.client.get(reverse('api_predictions', kwargs={'stage': 'group_stage'}))
+        self.assertEqual([f['fixture'] for f in api_response.json()['fixtures']], [league_fixture.pk])
+
+        # Fixtures from other tournaments can't be predicted through the API either
+        response = self.client.put(reverse('api_predictions', kwargs={'stage': 'group_stage'}), content_type='application/json',
+                                   data='{"predictions": [{"fixture": %d, "team1_goals": 1, "team2_goals": 0}]}' % self.group_fixtures[0].pk)
+        self.assertEqual(response.json()['results'], {str(self.group_fixtures[0].pk): 'unknown_fixture'})
+
+class IndexDashboardTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+    INDEX_QUERIES = 9 # version, tournaments, session, user, profile, stored and live rank, user count, points per fixture
+
+    def setUp(self):
+        self.tournament = Tournament.objects.first()
+        self.group_a = list(self.tournament.all_fixtures_by_group("A"))
+
+    def test_dashboard_partitions_fixtures(self):
+        helpers.play_match(self.group_a[0], 2, 1)
+        context = self.client.get(reverse('index')).context
+        self.assertEqual(context['tournament'], self.tournament)
+        self.assertEqual([f.pk for f in context['group_fixtures']["A"]], [f.pk for f in self.group_a])
+        self.assertEqual(list(context['group_fixtures']), Team.group_names)
+        self.assertEqual([f.pk for f in context['past_fixtures']], [self.group_a[0].pk])
+        self.assertEqual(len(context['upcoming_fixtures']), 5)
+        self.assertTrue(context['group_fixtures_exist'])
+        self.assertEqual(context['ro16_fixtures'], [])
+
+    # The number of queries doesn't depend on how many fixtures the tournament has
+    def test_index_query_count_is_fixed(self):
+        self.client.force_login(helpers.generate_user())
+        self.client.get(reverse('index'))
+        with self.assertNumQueries(self.INDEX_QUERIES):
+            self.client.get(reverse('index'))
+
+        final = self.group_a[0]
+        helpers.generate_fixture(final.team1, final.team2, final.match_date, stage=Fixture.FINAL)
+        with self.assertNumQueries(self.INDEX_QUERIES + 2): # The fixtures and group tables are loaded again once a fixture is added
+            self.client.get(reverse('index'))
+
+
+class GroupFixturesTests(TestCase):
+    fixtures = ['tournaments.json', 'teams.json', 'games.json']
+
+    def test_group_fixtures_dictionary_is_one_query(self):
+        tournament = Tournament.objects.first()
+        with self.assertNumQueries(1):
+            groups = views.group_fixtures_dictionary(tournament)
+        self.assertEqual(list(groups), Team.group_names)
+        self.assertEqual([f.pk for f in groups["B"]], [f.pk for f in tournament.all_fixtures_by_group("B")])
+
+        # Fixtures from another tournament aren't mixed in
+        other = Tournament.objects.exclude(pk=tournament.pk).first()
+        self.assertFalse(any(views.group_fixtures_dictionary(other).values()))
+        self.assertEqual(sum(len(f) for f in views.group_fixtures_dictionary().values()), Fixture.objects.count())
+
+    def test_tournaments_page(self):
+        response = self.client.get(reverse('tournaments'))
+        self.assertTrue(response.context['group_fixtures_exist'])
+        self.assertEqual(len(response.context['fixtures']["A"]), 6)
@@ -32,4 +32,9 @@ urlpatterns += [
     path('ajax/leaderboards/get_page', views.paginate_leaderboards, name='paginate_leaderboard'),
     path('ajax/leaderboards/search', views.search_leaderboards, name='search_leaderboard'),
     path('ajax/<slug:username>/get_predictions', views.user_profile, name='user_predictions')
-]
\ No newline at end of file
+]
+
+# API URLS
+urlpatterns += [
+    path('api/predictions/<slug:stage>/', views.api_predictions, name='api_predictions'),
+]
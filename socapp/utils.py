@@ -1,18 +1,45 @@
 from django.db.models.functions import Rank
 from django.db.models.expressions import Window
-from django.db.models import F, Sum
+from django.db.models import F, Sum, Case, When, Value, IntegerField
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.utils import timezone
 
 import logging
 import datetime
-from itertools import groupby
+import pytz
+from array import array
+from collections import defaultdict, namedtuple
+from itertools import groupby, repeat
 
 logger = logging.getLogger(__name__)
 """
 Utility methods for common/complex tasks
 """
 
+# Keeps the number of parameters in a single 'IN (...)' clause below SQLite's variable limit
+BULK_BATCH_SIZE = 500
+
+def chunked(items, size=BULK_BATCH_SIZE):
+    """ Splits a list into consecutive lists of (at most) the given size """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def bulk_update(model, objs, fields, batch_size=BULK_BATCH_SIZE):
+    """
+    Writes the given fields of each model instance back to the database, without calling save() on each one.
+    Instances sharing the same values for the fields are written with a single 'UPDATE ... WHERE pk IN (...)',
+    so the number of statements depends on the number of distinct values rather than the number of instances.
+    (QuerySet.bulk_update is not available in this version of Django)
+    """
+    pks_by_values = defaultdict(list)
+    for obj in objs:
+        pks_by_values[tuple(getattr(obj, field) for field in fields)].append(obj.pk)
+
+    for values, pks in pks_by_values.items():
+        for chunk in chunked(pks, batch_size):
+            model._default_manager.filter(pk__in=chunk).update(**dict(zip(fields, values)))
+
 def group_users_by_points(users_queryset=None):
     """ 
     Orders a queryset of users into groups based on the points each user has accumulated.
@@ -36,273 +63,275 @@ def group_users_by_points(users_queryset=None):
 
     return users_grouped_by_points
 
-# Daily movement stats for a leaderboard. If no leaderboard is provided, assumes global leaderboard
-def user_daily_performance(leaderboard=None):
+######
+# Days and time zones
+
+# Returns the tzinfo for a time zone given as a name or a tzinfo, or the current time zone if it's None
+def get_tz(tz=None):
+    if tz is None:
+        return timezone.get_current_timezone()
+    if isinstance(tz, str):
+        return pytz.timezone(tz)
+    return tz
+
+# Returns the current date in the given time zone
+def local_today(tz=None, now=None):
+    return timezone.localtime(now or timezone.now(), get_tz(tz)).date()
+
+# Returns the (aware) datetimes at which the given day starts and the next day starts, in the given time zone.
+# Each is worked out separately, so days on which the clocks change are the right length.
+def day_bounds(day, tz=None):
+    tz = get_tz(tz)
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min), tz, is_dst=False)
+    end = timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min), tz, is_dst=False)
+    return start, end
+
+
+# Daily movement stats for a leaderboard. If no leaderboard is provided, assumes global leaderboard.
+# The day is today by default, counted in the given time zone (the current time zone by default).
+# Returns the users who gained the most and fewest points from that day's results, and those points, or None if no predictions for
+# that day's results have been scored. Takes two queries: one for each user's points that day, and one to fetch the best/worst users.
+def user_daily_performance(leaderboard=None, day=None, tz=None):
     from socapp.models import Fixture, Answer
-    user_set = leaderboard.users.all() if leaderboard is not None else get_user_model().objects.all()
-    fixtures = Fixture.todays_fixtures().filter(status=Fixture.MATCH_STATUS_PLAYED)
-    if fixtures.exists():
-        daily_points = Answer.objects.select_related('fixture', 'user').filter(user__in=user_set, fixture__in=fixtures) \
-            .values_list('user').annotate(pts=Sum('points'))
-        
-        # If there are no predictions for any of these games, return None
-        if len(daily_points) == 0:
-            return None
-        else:
-            best_users = []
-            worst_users = []
-            max_pts = min_pts = 0
-            for user, points in daily_points:
-                if len(best_users) == 0:
-                    best_users.append(get_user_model().objects.get(pk=user))
-                    worst_users.append(get_user_model().objects.get(pk=user))
-                    max_pts = min_pts = points
-                elif points > max_pts:
-                    best_users = [get_user_model().objects.get(pk=user)]
-                    max_pts = points
-                elif points == max_pts:
-                    best_users.append(get_user_model().objects.get(pk=user))
-                elif points < min_pts:
-                    worst_users = [get_user_model().objects.get(pk=user)]
-                    min_pts = points
-                elif points == min_pts:
-                    worst_users.append(get_user_model().objects.get(pk=user))
-            
-            return {
-                'best_users': best_users, 
-                'worst_users': worst_users, 
-                'best_points': max_pts, 
-                'worst_points': min_pts
-            }
-    return None
+    if day is None:
+        day = local_today(tz)
+    start, end = day_bounds(day, tz)
+
+    answers = Answer.objects.filter(points_added=True, fixture__status=Fixture.MATCH_STATUS_PLAYED,
+                                    fixture__match_date__gte=start, fixture__match_date__lt=end)
+    if leaderboard is not None:
+        answers = answers.filter(user__leaderboard=leaderboard)
+    daily_points = list(answers.order_by().values_list('user').annotate(pts=Sum('points')))
+
+    # If there are no predictions for any of these games, return None
+    if not daily_points:
+        return None
+
+    max_pts = max(points for _, points in daily_points)
+    min_pts = min(points for _, points in daily_points)
+    best_ids = [user for user, points in daily_points if points == max_pts]
+    worst_ids = [user for user, points in daily_points if points == min_pts]
+    users = get_user_model().objects.in_bulk(set(best_ids + worst_ids))
+    by_username = lambda ids: sorted((users[pk] for pk in ids), key=lambda u: u.username)
+
+    return {
+        'best_users': by_username(best_ids),
+        'worst_users': by_username(worst_ids),
+        'best_points': max_pts,
+        'worst_points': min_pts
+    }
     
 
 ######
-# Methods for updating the two associated Team model instances whenever a Fixture is updated with a result
-
-# Adds the result data to the team model's fields, either directly (goals for, goals against) or by inference (games won/drawn/lost)
-def add_team_data(fixture, team):
-    from socapp.models import Fixture
-    team.games_played = F('games_played') + 1
+# Applying a change to a fixture's result
 
-    if fixture.get_winner() == team:
-        team.games_won = F('games_won') + 1
-        if fixture.stage == Fixture.GROUP:
-            team.group_won = F('group_won') + 1
-        else:
-            team.group_won = F('group_won')
-    else:
-        team.games_won = F('games_won')
-        team.group_won = F('group_won')
-
-    if fixture.get_loser() == team:
-        team.games_lost = F('games_lost') + 1
-        if fixture.stage == Fixture.GROUP:
-            team.group_lost = F('group_lost') + 1
-        else:
-            team.group_lost = F('group_lost')
-    else:
-        team.games_lost = F('games_lost')
-        team.group_lost = F('group_lost')
-
-    if fixture.is_draw():
-        team.games_drawn = F('games_drawn') + 1
-        if fixture.stage == Fixture.GROUP:
-            team.group_drawn = F('group_drawn') + 1
-        else:
-            team.group_drawn = F('group_drawn')
-    else:
-        team.games_drawn = F('games_drawn')
-        team.group_drawn = F('group_drawn')
-    
-    # Add for group won
-    if fixture.team1 == team:
-        team.goals_for = F('goals_for') + fixture.team1_goals
-        team.goals_against = F('goals_against') + fixture.team2_goals
-        if fixture.stage == Fixture.GROUP:
-            team.group_goals_for = F('group_goals_for') + fixture.team1_goals
-            team.group_goals_against = F('group_goals_against') + fixture.team2_goals
-        else:
-            team.group_goals_for = F('group_goals_for')
-            team.group_goals_against = F('group_goals_against')
+def apply_result_change(prev_fixture, saved_fixture):
+    """
+    Propagates a change to a fixture's result to the Team models of the two teams involved, and to the users' points.
+    prev_fixture is the fixture as it was before the change (None if the fixture has just been created), 
+    and saved_fixture is the fixture as it is after the change.
+    """
+    update_team_data(prev_fixture, saved_fixture)
+    update_group_standings(prev_fixture, saved_fixture)
+    if prev_fixture is None or not prev_fixture.has_result():
+        if saved_fixture.has_result():
+            # Simply add the points, since previously there was no result.
+            update_user_pts(saved_fixture=saved_fixture, add=True)
+    elif not saved_fixture.has_result():
+        # Previously there was a result, now there's none: so remove the user data for the previous result
+        update_user_pts(prev_fixture=prev_fixture, remove=True)
     else:
-        team.goals_for = F('goals_for') + fixture.team2_goals
-        team.goals_against = F('goals_against') + fixture.team1_goals
-        if fixture.stage == Fixture.GROUP:
-            team.group_goals_for = F('group_goals_for') + fixture.team2_goals
-            team.group_goals_against = F('group_goals_against') + fixture.team1_goals
-        else:
-            team.group_goals_for = F('group_goals_for')
-            team.group_goals_against = F('group_goals_against')
-    
-    team.save()
-    team.refresh_from_db()
+        # Result already exists, so this save represents an update.
+        update_user_pts(prev_fixture=prev_fixture, saved_fixture=saved_fixture, update=True)
 
-# Removes the result data from the team model's fields, either directly (goals for, goals against) or by inference (games won/drawn/lost)
-def remove_team_data(fixture, team):
-    from socapp.models import Fixture
-
-    team.games_played = F('games_played') - 1
+######
+# Methods for updating the two associated Team model instances whenever a Fixture is updated with a result
 
-    if fixture.get_winner() == team:
-        team.games_won = F('games_won') - 1
-        if fixture.stage == Fixture.GROUP:
-            team.group_won = F('group_won') - 1
-        else:
-            team.group_won = F('group_won')
-    else:
-        team.games_won = F('games_won')
-        team.group_won = F('group_won')
+# The Team fields which are derived from fixture results. The group_* fields only count group stage fixtures.
+TEAM_STAT_FIELDS = (
+    'games_played', 'games_won', 'games_drawn', 'games_lost', 'goals_for', 'goals_against',
+    'group_won', 'group_drawn', 'group_lost', 'group_goals_for', 'group_goals_against'
+)
 
-    if fixture.get_loser() == team:
-        team.games_lost = F('games_lost') - 1
-        if fixture.stage == Fixture.GROUP:
-            team.group_lost = F('group_lost') - 1
-        else:
-            team.group_lost = F('group_lost')
-    else:
-        team.games_lost = F('games_lost')
-        team.group_lost = F('group_lost')
-    
-    if fixture.is_draw():
-        team.games_drawn = F('games_drawn') - 1
-        if fixture.stage == Fixture.GROUP:
-            team.group_drawn = F('group_drawn') - 1
-        else:
-            team.group_drawn = F('group_drawn')
-    else:
-        team.games_drawn = F('games_drawn')
-        team.group_drawn = F('group_drawn')
-
-    if fixture.team1 == team:
-        team.goals_for = F('goals_for') - fixture.team1_goals
-        team.goals_against = F('goals_against') - fixture.team2_goals
-        if fixture.stage == Fixture.GROUP:
-            team.group_goals_for = F('group_goals_for') - fixture.team1_goals
-            team.group_goals_against = F('group_goals_against') - fixture.team2_goals
-        else:
-            team.group_goals_for = F('group_goals_for')
-            team.group_goals_against = F('group_goals_against')
-
-    elif fixture.team2 == team:
-        team.goals_for = F('goals_for') - fixture.team2_goals
-        team.goals_against = F('goals_against') - fixture.team1_goals
-        if fixture.stage == Fixture.GROUP:
-            team.group_goals_for = F('group_goals_for') - fixture.team2_goals
-            team.group_goals_against = F('group_goals_against') - fixture.team1_goals
-        else:
-            team.group_goals_for = F('group_goals_for')
-            team.group_goals_against = F('group_goals_against')
-    
-    team.save()
-    team.refresh_from_db()
-
-# Compares the previously saved fixture with the newly saved fixture in order to update the relevant fields in the Team model
-def update_team_data(previous_fixture, updated_fixture, team):
-    update_result_fields(previous_fixture, updated_fixture, team)
-    update_goals_fields(previous_fixture, updated_fixture, team)
-    team.save()
-    team.refresh_from_db()
-
-# Updates the games_won, games_drawn, games_lost fields in the Team model passed in
-def update_result_fields(previous_fixture, updated_fixture, team):
+def team_result_stats(fixture, team):
+    """
+    Returns what the fixture's result contributes to the team's stats, as a dictionary of Team field -> value. 
+    The goals for/against are taken directly from the result, and the games won/drawn/lost are inferred from it.
+    Returns an empty dictionary if the fixture has no result.
+    """
     from socapp.models import Fixture
+    if fixture is None or not fixture.has_result():
+        return {}
 
-    if previous_fixture.is_draw() and not updated_fixture.is_draw():
-        team.games_drawn = F('games_drawn') - 1
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_drawn = F('group_drawn') - 1
-        else:
-            team.group_drawn = F('group_drawn')
-
-    elif not previous_fixture.is_draw() and updated_fixture.is_draw():
-        team.games_drawn = F('games_drawn') + 1
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_drawn = F('group_drawn') + 1
-        else:
-            team.group_drawn = F('group_drawn')
+    if fixture.team1_id == team.pk:
+        goals_for, goals_against = fixture.team1_goals, fixture.team2_goals
     else:
-        team.games_drawn = F('games_drawn')
-        team.group_drawn = F('group_drawn')
+        goals_for, goals_against = fixture.team2_goals, fixture.team1_goals
+    won, drawn, lost = int(goals_for > goals_against), int(goals_for == goals_against), int(goals_for < goals_against)
+
+    stats = {
+        'games_played': 1,
+        'games_won': won,
+        'games_drawn': drawn,
+        'games_lost': lost,
+        'goals_for': goals_for,
+        'goals_against': goals_against,
+    }
+    if fixture.stage == Fixture.GROUP:
+        stats.update({
+            'group_won': won,
+            'group_drawn': drawn,
+            'group_lost': lost,
+            'group_goals_for': goals_for,
+            'group_goals_against': goals_against,
+        })
+    return stats
+
+def team_stat_deltas(prev_fixture, saved_fixture, team):
+    """
+    Compares the fixture before and after a change to its result (either can be None, or have no result), 
+    and returns the changes to the team's stats as a dictionary of Team field -> delta. Unchanged fields are left out.
+    """
+    prev_stats = team_result_stats(prev_fixture, team)
+    saved_stats = team_result_stats(saved_fixture, team)
+    deltas = {}
+    for field in TEAM_STAT_FIELDS:
+        delta = saved_stats.get(field, 0) - prev_stats.get(field, 0)
+        if delta != 0:
+            deltas[field] = delta
+    return deltas
+
+def update_team_data(prev_fixture, saved_fixture):
+    """
+    Applies a change to a fixture's result to the Team models of both teams in the fixture.
+    Only the changed fields are written, in a single 'UPDATE ... CASE' statement covering both teams.
+    The Team instances attached to saved_fixture (or prev_fixture, when the fixture is being deleted) are updated in place, 
+    so they don't need to be refreshed from the database.
+    """
+    from socapp.models import Team
+    fixture = saved_fixture if saved_fixture is not None else prev_fixture
+    teams = [fixture.team1, fixture.team2]
+    team_deltas = [(team, team_stat_deltas(prev_fixture, saved_fixture, team)) for team in teams]
 
-    if previous_fixture.get_winner() == team and not updated_fixture.get_winner() == team:
-        team.games_won = F('games_won') - 1
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_won = F('group_won') - 1
-        else:
-            team.group_won = F('group_won')
-    elif not previous_fixture.get_winner() == team and updated_fixture.get_winner() == team:
-        team.games_won = F('games_won') + 1
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_won = F('group_won') + 1
-        else:
-            team.group_won = F('group_won')
-    else:
-        team.games_won = F('games_won')
-        team.group_won = F('group_won')
+    changed_fields = [field for field in TEAM_STAT_FIELDS if any(field in deltas for _, deltas in team_deltas)]
+    if not changed_fields:
+        return
 
-    if previous_fixture.get_loser() == team and not updated_fixture.get_loser() == team:
-        team.games_lost = F('games_lost') - 1
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_lost = F('group_lost') - 1
-        else:
-            team.group_lost = F('group_lost')
-    elif not previous_fixture.get_loser() == team and updated_fixture.get_loser() == team:
-        team.games_lost = F('games_lost') + 1
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_lost = F('group_lost') + 1
-        else:
-            team.group_lost = F('group_lost')
-    else:
-        team.games_lost = F('games_lost')
-        team.group_lost = F('group_lost')
+    updates = {}
+    for field in changed_fields:
+        whens = [When(pk=team.pk, then=F(field) + deltas[field]) for team, deltas in team_deltas if field in deltas]
+        updates[field] = Case(*whens, default=F(field), output_field=IntegerField())
+    Team.objects.filter(pk__in=[team.pk for team in teams]).update(**updates)
 
-# Updates the goals_for, goals_against fields in the Team model passed in
-def update_goals_fields(previous_fixture, updated_fixture, team):
-    from socapp.models import Fixture
+    for team, deltas in team_deltas:
+        for field, delta in deltas.items():
+            setattr(team, field, getattr(team, field) + delta)
 
-    if team == previous_fixture.team1:
-        gf_diff = previous_fixture.team1_goals - updated_fixture.team1_goals
-        ga_diff = previous_fixture.team2_goals - updated_fixture.team2_goals
-    elif team == previous_fixture.team2:
-        gf_diff = previous_fixture.team2_goals - updated_fixture.team2_goals
-        ga_diff = previous_fixture.team1_goals - updated_fixture.team1_goals
-
-    # For the goals_for and goals_against fields, if the difference is less than 0, that means the team has scored/conceded more goals in the updated result.
-    # Increment by the absolute value of the difference.
-    # If the difference is more than 0, then the team has less goals in the updated result.
-    # In this case, take the extra goals from the initial fixture away from the updated fixture.
-    if gf_diff < 0:
-        team.goals_for = F('goals_for') + abs(gf_diff)
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_goals_for = F('group_goals_for') + abs(gf_diff)
-        else:
-            team.group_goals_for = F('group_goals_for')        
-    elif gf_diff > 0:
-        team.goals_for = F('goals_for') - gf_diff
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_goals_for = F('group_goals_for') - gf_diff
-        else:
-            team.group_goals_for = F('group_goals_for') 
-    else:
-        team.goals_for = F('goals_for')
-        team.group_goals_for = F('group_goals_for')
-    
-    if ga_diff < 0:
-        team.goals_against = F('goals_against') + abs(ga_diff)
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_goals_against = F('group_goals_against') + abs(ga_diff)
-        else:
-            team.group_goals_against = F('group_goals_against')  
-    elif ga_diff > 0:
-        team.goals_against = F('goals_against') - ga_diff
-        if previous_fixture.stage == Fixture.GROUP:
-            team.group_goals_against = F('group_goals_against') - ga_diff
-        else:
-            team.group_goals_against = F('group_goals_against')  
-    else:
-        team.goals_against = F('goals_against')
-        team.group_goals_against = F('group_goals_against') 
+######
+# Methods for maintaining the GroupStanding tables whenever a group stage Fixture is updated with a result
+
+# Maps the GroupStanding fields onto the group-only Team fields they are derived from
+STANDING_FIELDS = {
+    'won': 'group_won',
+    'drawn': 'group_drawn',
+    'lost': 'group_lost',
+    'goals_for': 'group_goals_for',
+    'goals_against': 'group_goals_against',
+}
+
+def standing_stats(team_stats):
+    """ Converts a dictionary of (group) Team fields into a dictionary of GroupStanding fields, including the derived fields """
+    stats = {field: team_stats.get(team_field, 0) for field, team_field in STANDING_FIELDS.items()}
+    stats['played'] = stats['won'] + stats['drawn'] + stats['lost']
+    stats['points'] = (3 * stats['won']) + stats['drawn']
+    stats['goal_difference'] = stats['goals_for'] - stats['goals_against']
+    return stats
+
+def update_group_standings(prev_fixture, saved_fixture):
+    """
+    Applies a change to a group stage fixture's result to the GroupStanding rows of both teams, then re-ranks their group.
+    If the group has no standings yet, they are first built from the other fixtures.
+    """
+    from socapp.models import Fixture, GroupStanding
+    fixture = saved_fixture if saved_fixture is not None else prev_fixture
+    if fixture.stage != Fixture.GROUP:
+        return
+
+    team_deltas = []
+    for team in [fixture.team1, fixture.team2]:
+        deltas = {f: d for f, d in standing_stats(team_stat_deltas(prev_fixture, saved_fixture, team)).items() if d != 0}
+        team_deltas.append((team, deltas))
+    changed_fields = {field for _, deltas in team_deltas for field in deltas}
+    if not changed_fields:
+        return
+
+    group = fixture.team1.group
+    standings = GroupStanding.objects.filter(tournament_id=fixture.tournament_id, group=group)
+    if not standings.filter(team__in=[fixture.team1, fixture.team2]).exists():
+        # Build the missing rows (or all of the tournament's tables, the first time round) without this fixture's result, which is applied below.
+        tournament_has_tables = GroupStanding.objects.filter(tournament_id=fixture.tournament_id).exists()
+        rebuild_group_standings(fixture.tournament, group=group if tournament_has_tables else None, exclude_fixture=fixture)
+
+    updates = {}
+    for field in changed_fields:
+        whens = [When(team_id=team.pk, then=F(field) + deltas[field]) for team, deltas in team_deltas if field in deltas]
+        updates[field] = Case(*whens, default=F(field), output_field=IntegerField())
+    standings.filter(team__in=[fixture.team1, fixture.team2]).update(**updates)
+    rank_group_standings(fixture.tournament_id, group)
+
+def rank_group_standings(tournament_id, group):
+    """ Recalculates the positions in the given group from the standings' tie-break keys, writing only the positions which changed """
+    from socapp.models import GroupStanding
+    standings = GroupStanding.objects.filter(tournament_id=tournament_id, group=group)
+    ranked = standings.order_by(*GroupStanding.TIE_BREAK_ORDERING).values_list('pk', 'position')
+    changed = [(pk, i) for i, (pk, position) in enumerate(ranked, start=1) if position != i]
+    if changed:
+        whens = [When(pk=pk, then=Value(position)) for pk, position in changed]
+        standings.filter(pk__in=[pk for pk, _ in changed]) \
+            .update(position=Case(*whens, default=F('position'), output_field=IntegerField()))
+
+def rebuild_group_standings(tournament, group=None, exclude_fixture=None):
+    """
+    Builds the GroupStanding rows for the tournament (or just one of its groups) from scratch, from the group stage fixtures' results.
+    Any existing rows for the group(s) are replaced. The excluded fixture's result is left out.
+    Fixtures with result jobs still to be processed count with the result which has been applied so far (see tasks.applied_results),
+    since processing the jobs will apply the rest to the standings.
+    """
+    from socapp.models import Fixture, GroupStanding
+    from socapp import tasks
+    fixtures = Fixture.objects.filter(tournament=tournament, stage=Fixture.GROUP)
+    if group is not None:
+        fixtures = fixtures.filter(team1__group=group)
+    if exclude_fixture is not None:
+        fixtures = fixtures.exclude(pk=exclude_fixture.pk)
+    fixtures = list(fixtures)
+    applied = tasks.applied_results(fixtures)
+
+    team_stats = {}
+    for fixture in fixtures:
+        applied_fixture = applied.get(fixture.pk, fixture)
+        for team in [fixture.team1, fixture.team2]:
+            stats = team_stats.setdefault(team, defaultdict(int))
+            for field, value in team_result_stats(applied_fixture, team).items():
+                stats[field] += value
+    # The excluded fixture's teams still need a row, even if it's their only fixture
+    if exclude_fixture is not None:
+        for team in [exclude_fixture.team1, exclude_fixture.team2]:
+            team_stats.setdefault(team, defaultdict(int))
+
+    existing = GroupStanding.objects.filter(tournament=tournament)
+    if group is not None:
+        existing = existing.filter(group=group)
+    existing.delete()
+
+    standings = [GroupStanding(tournament=tournament, team=team, group=team.group, **standing_stats(stats)) 
+                 for team, stats in team_stats.items()]
+    # Rank each group in memory using the same tie-break keys as rank_group_standings
+    standings.sort(key=lambda s: (s.group, -s.points, -s.goal_difference, -s.goals_for, s.team.name))
+    for _, group_standings in groupby(standings, key=lambda s: s.group):
+        for position, standing in enumerate(group_standings, start=1):
+            standing.position = position
+    GroupStanding.objects.bulk_create(standings)
 
 ###############################
 ### USER POINTS CALCULATION
@@ -313,8 +342,12 @@ def update_user_pts(saved_fixture=None, prev_fixture=None, add=False, update=Fal
     """
     Calculates all users' points for the given fixture, or all played fixtures. 
     The method is capable of adding, updating and removing points based on the params passed in.
+    The answers for the fixture(s) are fetched in a single query and scored in memory. The points given or taken away are
+    recorded in the points ledger, and the Answer, UserProfile and TournamentPoints changes are written with a handful of
+    bulk statements, all in one transaction.
     """
-    from .models import Answer, Fixture
+    from .models import Answer, Fixture, PointsLedgerEntry
+    from socapp import ledger
 
     # Set the fixture based on what (if any) fixtures were passed in. Default to all fixtures already played.
     if add and saved_fixture is not None:
@@ -324,173 +357,160 @@ def update_user_pts(saved_fixture=None, prev_fixture=None, add=False, update=Fal
     else:
         fixtures = Fixture.all_completed_fixtures() # preferably never use this
 
-    # For the given fixture(s), add points for each user with answers relating to that fixture.
-    for user in get_user_model().objects.all():
-        for fixture in fixtures:
-            # Get user's answer for each completed fixture. If no answer exists then continue to the next fixture.
-            try:
-                ans = Answer.objects.select_related('fixture','user') \
-                        .get(fixture=fixture, user=user)
-            except Answer.DoesNotExist:
-                continue
+    if not (add or update or remove):
+        return
 
-            # Get the points to be given to this answer
-            total_points = calculate_points(fixture, ans)
+    fixtures_by_pk = {fixture.pk: fixture for fixture in fixtures}
+    answers = Answer.objects.filter(fixture__in=list(fixtures_by_pk))
+
+    changed_answers = []
+    user_deltas = defaultdict(int) # user pk -> points to add to the user's total
+    tournament_deltas = defaultdict(int) # (user pk, tournament pk) -> points to add to the user's tournament total
+    ledger_deltas = defaultdict(int) # (user pk, tournament pk, fixture pk) -> points to record in the ledger
+
+    answers_by_fixture = defaultdict(list)
+    for ans in answers:
+        answers_by_fixture[ans.fixture_id].append(ans)
+
+    for fixture_pk, fixture_answers in answers_by_fixture.items():
+        fixture = fixtures_by_pk[fixture_pk]
+        # Get the points to be given to each answer
+        predictions = prediction_arrays(fixture_answers)
+        all_points = calculate_points_batch(fixture, *predictions)
+        if update and saved_fixture is not None:
+            all_new_points = calculate_points_batch(saved_fixture, *predictions)
+
+        for i, ans in enumerate(fixture_answers):
+            total_points = all_points[i]
 
             # Determine the operation to perform in order to update user points, and act accordingly.
             if add:
-                # If the fixture is added, add the points given for the answer
-                add_user_points(user, ans, total_points, fixture.tournament)
+                # If the fixture is added, add the points given for the answer (unless they've already been added)
+                if ans.points_added:
+                    continue
+                pts = total_points
+                ans.points = total_points
+                ans.points_added = Answer.POINTS_ADDED
             elif update:
                 # If the fixture is updated, get the difference between the updated-points, and the original (total_points)
-                if saved_fixture is not None:
-                    new_points = calculate_points(saved_fixture, ans)
-                    pointsdelta = new_points - total_points
-                    update_user_points(user, ans, pointsdelta, fixture.tournament)
-            elif remove:
+                if saved_fixture is None:
+                    continue
+                pts = all_new_points[i] - total_points
+                if ans.points is not None:
+                    ans.points += pts
+            else:
                 # If the fixture is removed, remove the points given for the answer
-                rm_user_points(user, ans, total_points, fixture.tournament)
-
-def add_user_points(user, answer, pts, tournament):
+                if not ans.points_added:
+                    continue
+                pts = -total_points
+                ans.points = None
+                ans.points_added = Answer.POINTS_NOT_ADDED
+
+            changed_answers.append(ans)
+            user_deltas[ans.user_id] += pts
+            tournament_deltas[(ans.user_id, fixture.tournament_id)] += pts
+            ledger_deltas[(ans.user_id, fixture.tournament_id, fixture.pk)] += pts
+
+    reason = PointsLedgerEntry.REASON_RESULT if add else PointsLedgerEntry.REASON_CORRECTION if update else PointsLedgerEntry.REASON_REMOVED
+    with transaction.atomic():
+        bulk_update(Answer, changed_answers, ['points', 'points_added'])
+        ledger.record(ledger_deltas, reason)
+        apply_user_points_deltas(user_deltas, tournament_deltas)
+
+def apply_user_points_deltas(user_deltas, tournament_deltas):
     """
-    Adds points for the provided user, if the points_added flag is set to POINTS_NOT_ADDED
+    Adds the given deltas to the users' total points and their per-tournament points.
+    Users sharing the same delta are updated together, so the number of statements depends on the 
+    number of distinct deltas rather than the number of users.
+    Users who don't have a TournamentPoints row for the tournament yet get one, with their total for it from the points ledger
+    (so the ledger entries for the deltas must have been recorded first).
     """
-    from socapp_auth.models import TournamentPoints
-    # Add points to user's total. The if condition should always be evaluate to true.
-    if not answer.points_added:
-        user.profile.points = F('points') + pts
-        user.save()
-        user.refresh_from_db()
-
-        if TournamentPoints.objects.filter(user=user.profile, tournament=tournament).exists():
-            t_pts = TournamentPoints.objects.filter(user=user.profile, tournament=tournament)
-            t_pts.update(points = F('points') + pts)
+    from socapp_auth.models import UserProfile, TournamentPoints
+    from socapp import ledger
+
+    users_by_delta = defaultdict(list)
+    for user_pk, pts in user_deltas.items():
+        if pts != 0:
+            users_by_delta[pts].append(user_pk)
+    for pts, user_pks in users_by_delta.items():
+        for chunk in chunked(user_pks):
+            UserProfile.objects.filter(user_id__in=chunk).update(points=F('points') + pts)
+
+    if not tournament_deltas:
+        return
+
+    # TournamentPoints references the UserProfile, so map user pks onto their profile pks.
+    profile_pks = {}
+    for chunk in chunked(list({user_pk for user_pk, _ in tournament_deltas})):
+        profile_pks.update(UserProfile.objects.filter(user_id__in=chunk).values_list('user_id', 'pk'))
+
+    existing = set()
+    tournament_pks = {tournament_pk for _, tournament_pk in tournament_deltas}
+    for chunk in chunked(list(profile_pks.values())):
+        existing.update(TournamentPoints.objects.filter(user_id__in=chunk, tournament_id__in=tournament_pks) \
+            .values_list('user_id', 'tournament_id'))
+
+    missing = [(user_pk, tournament_pk) for user_pk, tournament_pk in tournament_deltas
+               if user_pk in profile_pks and (profile_pks[user_pk], tournament_pk) not in existing]
+    ledger_totals = {}
+    for chunk in chunked(list({user_pk for user_pk, _ in missing})):
+        ledger_totals.update(ledger.tournament_totals(users=chunk))
+
+    to_create = []
+    rows_by_delta = defaultdict(list)
+    for (user_pk, tournament_pk), pts in tournament_deltas.items():
+        profile_pk = profile_pks.get(user_pk)
+        if profile_pk is None:
+            continue
+        if (profile_pk, tournament_pk) in existing:
+            if pts != 0:
+                rows_by_delta[(tournament_pk, pts)].append(profile_pk)
         else:
-            t_pts = TournamentPoints.objects.create(user=user.profile, tournament=tournament, points=pts)
+            to_create.append(TournamentPoints(user_id=profile_pk, tournament_id=tournament_pk, points=ledger_totals.get((user_pk, tournament_pk), 0)))
 
-        answer.points = pts
-        answer.points_added = answer.POINTS_ADDED
-        answer.save()
-        answer.refresh_from_db()
-
-
-def update_user_points(user, ans, pts, tournament):
-    """ Updates the points already given out to a user based on an altered scoreline.
-
-        user -> the user who provided the answer
-        pts -> the difference between the points for the updated fixture, vs the points from the original fixture     
-    """
-    from socapp_auth.models import TournamentPoints
-    user.profile.points = F('points') + pts
-    user.save()
-    user.refresh_from_db()
-
-    if TournamentPoints.objects.filter(user=user.profile, tournament=tournament).exists():
-        t_pts = TournamentPoints.objects.filter(user=user.profile, tournament=tournament)
-        t_pts.update(points = F('points') + pts)
-
-    ans.points = F('points') + pts
-    ans.save()
-    ans.refresh_from_db()
-
-def rm_user_points(user, answer, pts, tournament):
-    """ Removes a user's points for a given answer, and resets the points_added flag to False """
-    from socapp_auth.models import TournamentPoints
-    if answer.points_added:
-        user.profile.points = F('points') - pts
-        user.save()
-        user.refresh_from_db()
-
-        if TournamentPoints.objects.filter(user=user.profile, tournament=tournament).exists():
-            t_pts = TournamentPoints.objects.filter(user=user.profile, tournament=tournament)
-            t_pts.update(points = F('points') - pts)
-
-        answer.points_added = answer.POINTS_NOT_ADDED
-        answer.points = None
-        answer.save()
-        answer.refresh_from_db()
+    for (tournament_pk, pts), pks in rows_by_delta.items():
+        for chunk in chunked(pks):
+            TournamentPoints.objects.filter(tournament_id=tournament_pk, user_id__in=chunk).update(points=F('points') + pts)
+    TournamentPoints.objects.bulk_create(to_create, batch_size=BULK_BATCH_SIZE)
 
 def calculate_points(fixture, answer):
     """
-    Takes a Fixture and its associated Answer, and calculates the points to be given for the user who added the Answer
+    Takes a Fixture and its associated Answer, and calculates the points to be given for the user who added the Answer,
+    using the scoring rules of the fixture's tournament (see socapp/scoring.py)
     """
+    from socapp import scoring
+    return scoring.fixture_table(fixture).points(fixture, answer)
 
-    # List of points available.
-    ANSWER_RESULT = 5
-    ANSWER_OUTCOME = 2
-    ANSWER_BONUS = 1
-
-    # Get actual and predicted goals scored for each team in the fixture
-    user_team1_goals = answer.team1_goals
-    user_team2_goals = answer.team2_goals
-    actual_team1_goals = fixture.team1_goals
-    actual_team2_goals = fixture.team2_goals
+# Lightweight stand-in for an Answer, used when scoring raw predictions rather than model instances
+Prediction = namedtuple('Prediction', ['team1_goals', 'team2_goals', 'has_extra_time', 'has_penalties'])
 
-    # Set total points to zero. This value will be returned by the function after calculation below.
-    total_points = 0
-
-    # First check if result is correct, i.e. prediction of goals scored for each time match.
-    team1_accuracy = user_team1_goals - actual_team1_goals
-    team2_accuracy = user_team2_goals - actual_team2_goals
-
-    if (team1_accuracy == team2_accuracy == 0):
-        total_points += ANSWER_RESULT
-
-    # If not, then check for other conditions to get points. 
-    else:
-        # Get actual/predicted total goals, and actual/predicted goal difference.
-        user_total_goals = user_team1_goals + user_team2_goals
-        actual_total_goals = actual_team1_goals + actual_team2_goals
-        user_goal_difference = user_team1_goals - user_team2_goals
-        actual_goal_difference = actual_team1_goals - actual_team2_goals
-
-        # Check the result is correct
-        if ((user_goal_difference > 0 and actual_goal_difference > 0) or
-            (user_goal_difference < 0 and actual_goal_difference < 0) or
-            (user_goal_difference == actual_goal_difference)): 
-            total_points += ANSWER_OUTCOME
-
-        # Check the total goals scored or the goal difference is correct (can't have both, or the prediction would be correct).
-        if ((user_total_goals == actual_total_goals) or (user_goal_difference == actual_goal_difference)):
-            total_points += ANSWER_BONUS
-
-    # Calculate additional points for fixtures which can go to extra time/penalties.
-    if (fixture.can_be_over_90):
-        if (answer.has_extra_time):
-            if (fixture.has_extra_time):
-                total_points += ANSWER_OUTCOME
-            else:
-                total_points -= ANSWER_BONUS
-
-        if (answer.has_penalties):
-            if (fixture.has_penalties):
-                total_points += ANSWER_OUTCOME
-            else:
-                total_points -= ANSWER_BONUS
-
-    return total_points
-
-
-def sync_user_points():
+def calculate_points_batch(fixture, team1_goals, team2_goals, has_extra_time=None, has_penalties=None):
     """
-    This function (or something similar) can be run AFTER a fixture is played, in order to ensure there are no anomalies in the user points. 
-    It looks at all matches that've been played, and calculates the user's points for each, comparing them to the actual points in the database.
-    These fields should sync, and if not, an error should be logged.
-    Preferably execute this function periodically (ie - 20 mins after each match finishes) with Celery or Cron.
+    Batch variant of calculate_points. Takes a Fixture and parallel sequences (lists, arrays, etc) of the predicted goals 
+    for each team, and optionally the predicted extra time/penalties flags, and returns an array of the points for each prediction.
+    Most users make one of a few dozen predictions, so the answers are grouped by prediction and each distinct prediction is
+    scored once (from the tournament's points table, see socapp/scoring.py), then the points are mapped back onto the answers.
     """
-    from .models import Answer, Fixture
-
-    fixtures = Fixture.all_completed_fixtures()
-    users = get_user_model().objects.all()
-    for user in users:
-        answers = Answer.objects.filter(user=user, fixture__in=fixtures)
-        answers_points_field_total = answers.aggregate(total=Sum('points'))['total']
-        total_points = 0
-        for answer in answers:
-            total_points += calculate_points(answer.fixture, answer)
-        if not total_points == user.profile.points == answers_points_field_total:
-            logger.warning("User {} has {} points, but should have {} points".format(user, user.profile.points, total_points))
-        assert total_points == user.profile.points
+    if has_extra_time is None:
+        has_extra_time = repeat(False)
+    if has_penalties is None:
+        has_penalties = repeat(False)
+
+    from socapp import scoring
+    table = scoring.fixture_table(fixture)
+    predictions = list(zip(team1_goals, team2_goals, has_extra_time, has_penalties))
+    points_by_prediction = {p: table.points(fixture, Prediction(*p)) for p in set(predictions)}
+    return array('i', map(points_by_prediction.__getitem__, predictions))
+
+def prediction_arrays(answers):
+    """ Splits a list of Answers into the parallel arrays of predictions expected by calculate_points_batch """
+    return (
+        array('i', [a.team1_goals for a in answers]),
+        array('i', [a.team2_goals for a in answers]),
+        array('b', [a.has_extra_time for a in answers]),
+        array('b', [a.has_penalties for a in answers]),
+    )
+
 
 def stage_is_finished(tournament, stage):
     """ Given a stage (ie, group, last 16, quarter final, etc), determines whether it has been finished or not """
@@ -15,11 +15,15 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.forms import formset_factory
 from .forms import UserProfileForm, AnswerForm, LeaderboardForm, PrivateAccessForm
 
-from .models import Fixture, Answer, Team, Leaderboard, Tournament
+from .models import Fixture, Answer, Team, Leaderboard, Tournament, GroupStanding
 from socapp_auth.models import UserProfile
 from . import utils
+from . import cache as results_cache
+from . import predictions
+from . import dashboard
+from .ranking import biggest_climbers, stored_ranks, global_board_page, board_stats, decode_cursor
 
-import datetime, re
+import datetime, json, re
 
 def test(request):
     #return render(request, "test.html", context)
@@ -27,46 +31,16 @@ def test(request):
 
 def index(request):
     user = request.user
-    # Get current/previous tournaments
-    upcoming_tournaments = Tournament.objects.filter(start_date__gt=timezone.now()).order_by('start_date')
-    past_tournaments = Tournament.objects.exclude(start_date__gt=timezone.now())
+    # The fixture lists and tables are cached (as data here, and as fragments in the template) until the results version changes
+    version = results_cache.results_version()
 
-    group_fixtures = group_fixtures_dictionary()
-    group_fixtures_exist = any(group_fixtures.values())
-
-    ### Convert below to tournament specific ###
-    ro16_fixtures = Fixture.all_fixtures_by_stage(Fixture.ROUND_OF_16).order_by('match_date')
-    qf_fixtures = Fixture.all_fixtures_by_stage(Fixture.QUARTER_FINALS).order_by('match_date')
-    sf_fixtures = Fixture.all_fixtures_by_stage(Fixture.SEMI_FINALS).order_by('match_date')
-    tpp_fixture = Fixture.all_fixtures_by_stage(Fixture.TPP).order_by('match_date')
-    final_fixture = Fixture.all_fixtures_by_stage(Fixture.FINAL).order_by('match_date')
-
-    upcoming_fixtures = Fixture.objects.filter(status=Fixture.MATCH_STATUS_NOT_PLAYED).order_by('match_date')[:5]
-    
-    past_fixtures = Fixture.objects.filter(status=Fixture.MATCH_STATUS_PLAYED).order_by('-match_date')[:5]
-
-    if upcoming_fixtures.exists():
-        is_international = upcoming_fixtures[0].tournament.is_international
-    elif past_fixtures.exists():
-        is_international = past_fixtures[0].tournament.is_international
-
-    context = {
-        'group_fixtures_exist': group_fixtures_exist,
-        'group_fixtures': group_fixtures,
-        'ro16_fixtures' : ro16_fixtures,
-        'qf_fixtures' : qf_fixtures,
-        'sf_fixtures': sf_fixtures,
-        'tpp_fixture' : tpp_fixture,
-        'final_fixture' : final_fixture,
-        'upcoming_fixtures' : upcoming_fixtures,
-        'past_fixtures': past_fixtures,
-        'is_international': is_international,
-        'upcoming_tournaments': upcoming_tournaments,
-        'past_tournaments': past_tournaments
-    }
+    # The current tournament's fixtures, split up by group/round, along with the next and last few matches
+    context = dashboard.index_dashboard(version)
+    context['results_version'] = version
+    context['group_fixtures'] = context.pop('groups')
 
     try:
-        ranking = request.user.profile.get_ranking()
+        ranking = request.user.profile.get_stored_ranking()
         usercount = get_user_model().objects.count()
         points_percentage = request.user.profile.points_per_fixture()
 
@@ -82,13 +56,21 @@ def index(request):
 
 # Display the groups (which should update with the results), along w/ their fixtures. On a separate tab, show post-group matches
 def tournaments(request):
-    
-    group_fixtures = group_fixtures_dictionary()
-    group_fixtures_exist = any(group_fixtures.values())
+    version = results_cache.results_version()
+    tournament = dashboard.get_current_tournament()
+
+    if tournament is not None:
+        group_fixtures = results_cache.cached('group_fixtures_{}'.format(tournament.pk), lambda: group_fixtures_dictionary(tournament), version)
+        group_standings = results_cache.cached('group_standings_{}'.format(tournament.pk), tournament.group_standings, version)
+    else:
+        group_fixtures, group_standings = dashboard.partition_by_group([]), {}
 
     context = {
+        'results_version': version,
+        'tournament': tournament,
         'fixtures': group_fixtures,
-        'group_fixtures_exist': group_fixtures_exist
+        'group_standings': group_standings,
+        'group_fixtures_exist': any(group_fixtures.values())
     }
     return render(request, "world_cup.html", context)
 
@@ -129,7 +111,7 @@ def user_profile(request, username=None):
     else:
         group_answers_subset = paginated_data(group_answers, num_per_page=12, page=1)
     
-    ranking = user.profile.get_ranking()
+    ranking = user.profile.get_stored_ranking()
     franking = user.profile.get_ranking(friends=True)
     usercount = get_user_model().objects.count()
     points_percentage = user.profile.points_per_fixture()
@@ -242,24 +224,35 @@ def answer_form_selected(request, stage):
         'stage': stage, 
     }
 
+    # Only the current tournament's fixtures are predicted
+    tournament = dashboard.get_current_tournament()
+
     # Forms for the group stage.
     if stage_is_group:
-        group_fixtures = Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('team1__group', 'match_date')
+        group_fixtures = list(stage_fixtures(stage, tournament).with_open_flag())
+        fixtures_by_group = dashboard.partition_by_group(group_fixtures)
         AnswerFormSet = formset_factory(AnswerForm, extra=len(group_fixtures), max_num=len(group_fixtures))
         initial_data = get_initial_data(group_fixtures, request.user)    
+        form_fixtures = group_fixtures
     # Forms for the knockout stage.
     else:
-        knockout_fixtures = get_form_fixtures(stage)
+        knockout_fixtures = stage_fixtures(stage, tournament).with_open_flag()
         context_dict['knockout_fixtures'] = knockout_fixtures
         AnswerFormSet = formset_factory(AnswerForm, extra=len(knockout_fixtures), max_num=len(knockout_fixtures))
         initial_data = get_initial_data(knockout_fixtures, request.user, True) # Boolean argument adds ET/Penalties to initial data.
+        form_fixtures = knockout_fixtures
 
    
     # If POST, check formset is valid, and if so process the formset and redirect to profile page on completion.
     if request.method == 'POST':
-        answer_formset = AnswerFormSet(request.POST, initial=[data for data in initial_data])
+        # The forms' fixtures are looked up in the fixtures already loaded for the page, rather than queried for one by one
+        fixtures_by_pk = {fixture.pk: fixture for fixture in form_fixtures}
+        answer_formset = AnswerFormSet(request.POST, initial=[data for data in initial_data], form_kwargs={'fixtures_by_pk': fixtures_by_pk})
         if answer_formset.is_valid():
-            process_formset(answer_formset, request.user)
+            statuses = process_formset(answer_formset, request.user)
+            locked = sum(1 for status in statuses.values() if status == predictions.REJECTED_LOCKED)
+            if locked:
+                messages.warning(request, "{} prediction(s) could not be saved, as the match has already started".format(locked))
             return HttpResponseRedirect(reverse('profile'))
         else:
             # Print problems to the terminal.
@@ -269,15 +262,15 @@ def answer_form_selected(request, stage):
             # Not a POST, so all forms will be blank unless the user has already submitted an answer.
             # If answers exist, populate the form with the existing answers.
 
-            # Get number of fixtures per group. Move to tournament model?
-            group_fixture_count = group_fixtures.count() / len(Team.group_names)
+            # Get number of fixtures per group.
+            group_fixture_count = max(len(fixtures) for fixtures in fixtures_by_group.values())
 
             if len(group_fixtures) > 0:
                 is_international = group_fixtures[0].tournament.is_international
             else:
                 is_international = False # Dummy value for now
                  
-            zipped_groups = [fixture.team1.group for fixture in group_fixtures]
+            zipped_groups = [group for group, fixtures in fixtures_by_group.items() for _ in fixtures]
             formset = AnswerFormSet(initial=[data for data in initial_data])
             management_form = formset.management_form
             context_dict['fixtures_and_forms'] = zip(group_fixtures, formset, zipped_groups)
@@ -299,44 +292,21 @@ def answer_form_selected(request, stage):
 
     return render(request, 'answer_form_selected.html', context_dict)
 
-# Processes a submitted formset of answers
+# Processes a submitted formset of answers. All the new/changed answers are saved together (see predictions.submit_predictions).
+# Returns a dictionary of fixture pk -> status of the answer for it.
 def process_formset(answer_formset, user):
+    # Only process/save the forms which differ from their initial data. Formsets have a has_changed method for detecting this.
+    submitted = [answer_form.cleaned_data for answer_form in answer_formset if answer_form.has_changed()]
+    return predictions.submit_predictions(user, submitted)
 
-    for answer_form in answer_formset:
-        # Only process/save the form if the form differs from its initial data. Formsets have a has_changed method for detecting this.
-        if answer_form.has_changed():
-            fixt = answer_form.cleaned_data.get('fixture')
-
-            # Check if the answer can be edited.
-            if not can_edit_answer(fixt):
-                continue
-
-            # Check to see if the user has already provided an answer for this fixture. If not, create the Answer. Otherwise update.
-            if not Answer.objects.filter(user=user, fixture=fixt).exists():
-
-                answer = Answer.objects.create(
-                    user=user, 
-                    fixture=fixt,
-                    team1_goals=answer_form.cleaned_data.get('team1_goals'),
-                    team2_goals=answer_form.cleaned_data.get('team2_goals'),
-                    has_extra_time=answer_form.cleaned_data.get('has_extra_time'),
-                    has_penalties=answer_form.cleaned_data.get('has_penalties')
-                )
-
-                if answer.has_penalties:
-                    answer.has_extra_time = True
-                    answer.save()
-
-            else:                    
-                answer = Answer.objects.filter(user=user,fixture=fixt)
-                answer.update(team1_goals=answer_form.cleaned_data.get('team1_goals'),
-                            team2_goals=answer_form.cleaned_data.get('team2_goals'),
-                            has_extra_time=answer_form.cleaned_data.get('has_extra_time'),
-                            has_penalties=answer_form.cleaned_data.get('has_penalties'))
-
-                if answer[0].has_penalties:
-                    answer.update(has_extra_time=True)
 
+# Gets the tournament's fixtures for the given stage slug (as used in the answer form URLs), or None if the stage doesn't exist
+def stage_fixtures(stage, tournament):
+    if stage == "group_stage":
+        fixtures = Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('team1__group', 'match_date')
+    else:
+        fixtures = get_form_fixtures(stage)
+    return None if fixtures is None else fixtures.filter(tournament=tournament)
 
 # Gets the fixtures to display on the form, based on the stage passed in.
 def get_form_fixtures(stage=None):
@@ -354,13 +324,15 @@ def get_form_fixtures(stage=None):
 # Determines initial data for an AnswerForm based on the fixtures and user passed in.
 # Returns list comprised of dictionaries with the initial data.
 def get_initial_data(fixtures, user, knockout=False):
+    # Load all of the user's answers for these fixtures in one query, mapped by fixture id
+    answers = {answer.fixture_id: answer for answer in Answer.objects.filter(user=user, fixture__in=[f.id for f in fixtures])}
+
     initial_list = []
     for fixture in fixtures:
         this_initial = {}
         this_initial['fixture'] = fixture.id
-        try:
-            ans = Answer.objects.get(fixture=fixture, user=user) # Check if user has an answer for this fixture
-
+        ans = answers.get(fixture.id) # Check if user has an answer for this fixture
+        if ans is not None:
             this_initial['team1_goals'] = ans.team1_goals
             this_initial['team2_goals'] = ans.team2_goals
 
@@ -368,17 +340,13 @@ def get_initial_data(fixtures, user, knockout=False):
                 this_initial['has_extra_time'] = ans.has_extra_time
                 this_initial['has_penalties'] = ans.has_penalties
 
-        except Answer.DoesNotExist:
-            continue
-        finally:
-            initial_list.append(this_initial)
+        initial_list.append(this_initial)
     return initial_list
 
 # Determines whether a fixture can edited (it can be edited up to 15 mins before its kickoff)
 # This returns true or false based on the fixture passed in.
 def can_edit_answer(fixture):
-    cutoff_time = fixture.match_date - datetime.timedelta(minutes=75)
-    return timezone.now() < cutoff_time
+    return predictions.can_edit_prediction(fixture)
 
     
 ###############################################
@@ -389,7 +357,7 @@ def can_edit_answer(fixture):
 def leaderboards(request):
     user = request.user
     # User's ranking for position on global leaderboard.
-    ranking = user.profile.get_ranking()
+    ranking = user.profile.get_stored_ranking()
     franking = user.profile.get_ranking(friends=True)
 
     user_leaderboard_set = set(user.leaderboard_set.values_list('name',flat=True))
@@ -491,7 +459,8 @@ def show_leaderboard(request, leaderboard):
 
     try:
         # Get leaderboard with given slug.
-        leaderboard = Leaderboard.objects.prefetch_related('users', 'users__profile').get(slug=leaderboard)
+        leaderboard = Leaderboard.objects.get(slug=leaderboard)
+        is_member = leaderboard.users.filter(pk=request.user.pk).exists()
 
         # If there are errors, do not reinitialise the form.
         access_form = PrivateAccessForm(request.POST or None)
@@ -509,23 +478,26 @@ def show_leaderboard(request, leaderboard):
                     return HttpResponseRedirect(reverse('show_leaderboard', kwargs={'leaderboard':leaderboard.slug}))
      
 
-        if leaderboard.is_private and not request.user in leaderboard.users.all():
+        if leaderboard.is_private and not is_member:
             return render(request, 'private_leaderboard_login.html', context_dict)
 
-        # Get stats for the given leaderboard
-        stats = leaderboard_stats(leaderboard)
+        # Get stats for the given leaderboard. The members table is a cached template fragment, so the members are only loaded if it isn't cached.
+        version = results_cache.results_version()
+        stats = leaderboard_stats(leaderboard, version=version)
 
         # Add entities to the context dictionary, unpacking the stats into the dictionary.
         context_dict = {
             'access_form': access_form,
             'leaderboard':leaderboard, 
+            'is_member': is_member,
+            'results_version': version,
             **stats
         }
 
-        # daily_user_stats = utils.user_daily_performance(leaderboard)
-        # if daily_user_stats is not None:
-        #    context_dict['best_users'] = daily_user_stats['best_users']
-        #    context_dict['best_points'] = daily_user_stats['best_points']
+        # Stored ranks, and the biggest climbers since the last scoring pass
+        movement = results_cache.cached('leaderboard_movement:{}'.format(leaderboard.pk), lambda: rank_movement_stats(leaderboard), version)
+        context_dict.update(movement)
+        context_dict['daily_performance'] = daily_performance(leaderboard, version)
 
     except Leaderboard.DoesNotExist:
         # We get here if we couldn't find the specified game
@@ -537,21 +509,31 @@ def show_leaderboard(request, leaderboard):
 # Global leaderboard for all users in the system
 @login_required
 def global_leaderboard(request):
-    stats = leaderboard_stats()
+    version = results_cache.global_board_version() # Also changes when users sign up, unlike the other pages' version
+    stats = leaderboard_stats(version=version)
     global_leaderboard = True # Allows us to conditionally render/unrender parts of the template
-    
-    # Pagination stuff goes here
+
+    # Only one page of the board is shown. Pages are fetched by seeking from the first/last user of the current page,
+    # or ?around=me jumps to the page around the user.
+    after, before = decode_cursor(request.GET.get('after')), decode_cursor(request.GET.get('before'))
+    around_user = request.user if request.GET.get('around') == 'me' else None
+
+    def board_page():
+        page = global_board_page(after=request.GET.get('after'), before=request.GET.get('before'), around_user=around_user)
+        return {'board_page': page, 'members': page.users, 'ranks': stored_ranks(users=page.users)}
+    page_key = 'global_board_page:{}:{}:{}'.format(after, before, around_user.pk if around_user else None)
+    best_users, best_movement = results_cache.cached('global_climbers', biggest_climbers, version)
 
     context = {
         'global_leaderboard': global_leaderboard,
-        **stats
+        'results_version': version,
+        **stats,
+        **results_cache.cached(page_key, board_page, version),
+        'best_users': best_users,
+        'best_movement': best_movement,
+        'daily_performance': daily_performance(version=version),
     }
 
-    #daily_user_stats = utils.user_daily_performance()
-    #if daily_user_stats is not None:
-    #    context['best_users'] = daily_user_stats['best_users']
-    #    context['best_points'] = daily_user_stats['best_points']
-
     return render(request, "show_leaderboard.html", context)
 
 # Global leaderboard for all users in the system
@@ -564,36 +546,43 @@ def friends_leaderboard(request):
 
     context = {
         'friends_leaderboard': friends_leaderboard,
+        'ranks': {}, # Ranks among friends aren't stored, so the table shows the position in the list
         **stats
     }
 
     return render(request, "show_leaderboard.html", context)
 
+# Returns the stored ranks of the leaderboard's members, along with the users who have climbed the most places since the last scoring pass.
+# If leaderboard is None, we assume global leaderboard
+def rank_movement_stats(leaderboard=None):
+    best_users, best_movement = biggest_climbers(leaderboard=leaderboard)
+    return {
+        'ranks': stored_ranks(leaderboard=leaderboard),
+        'best_users': best_users,
+        'best_movement': best_movement,
+    }
+
+# Returns today's best and worst performers on the leaderboard (see utils.user_daily_performance), cached until the next result.
+# If leaderboard is None, we assume global leaderboard
+def daily_performance(leaderboard=None, version=None):
+    today = utils.local_today()
+    key = 'daily_performance:{}:{}'.format(leaderboard.pk if leaderboard else None, today)
+    # Cached as a dictionary, since None (no results today) isn't distinguishable from a cache miss
+    return results_cache.cached(key, lambda: {'stats': utils.user_daily_performance(leaderboard, today)}, version)['stats']
+
 # Returns stats for the leaderboard passed in. If leaderboard is None, we assume global leaderboard
-def leaderboard_stats(leaderboard=None, user=None):
+def leaderboard_stats(leaderboard=None, user=None, version=None):
     if leaderboard is None:
         members = get_user_model().objects.select_related('profile').order_by('-profile__points')
+        stats = board_stats(version=version)
     elif leaderboard == "Friends":
         members = user.profile.friends.all().select_related('profile').order_by('-profile__points') | get_user_model().objects.filter(username=user)
+        stats = board_stats(friends_of_user=user, version=version)
     else:
         members = leaderboard.get_members()
-    # Get a collection of board statistics.
-    total_points = members.aggregate(tp=Sum('profile__points'))['tp']
-
+        stats = board_stats(leaderboard=leaderboard, version=version)
     # Create the stats dictionary
-    stats_dict = { 'members': members, 'total_points': total_points }
-    if members:
-        membercount = members.count()
-        average_points = total_points / membercount
-        percent_above_average = members.filter(profile__points__gte=average_points).count()*100 / membercount
-    else:
-        average_points = percent_above_average = 0
-    # Update the stats dict and return it
-    stats_dict.update({
-        'average_points': average_points, 
-        'percent_above_average': percent_above_average,
-    })
-    return stats_dict
+    return { 'members': members, **stats }
 
 
 @login_required
@@ -648,6 +637,83 @@ def leave_leaderboard(request, leaderboard):
     return JsonResponse(data)
 
 
+###############################################
+# PREDICTIONS API
+###############################################
+
+# Maximum number of predictions accepted in one PUT (a whole group stage is 48)
+API_MAX_PREDICTIONS = 100
+
+def api_error(message, status):
+    return JsonResponse({'error': message}, status=status)
+
+# JSON API for a user's predictions for a stage (the same stage slugs as the answer forms).
+# GET returns the stage's fixtures, with whether each is locked and the user's prediction (or null).
+# PUT takes {"predictions": [{"fixture": <id>, "team1_goals": <int>, "team2_goals": <int>, "has_extra_time": <bool>, "has_penalties": <bool>}, ...]}
+# with only the fixtures being changed, and returns the status of each prediction (see predictions.submit_predictions).
+def api_predictions(request, stage):
+    if not request.user.is_authenticated:
+        return api_error("Authentication required", 401)
+    fixtures = stage_fixtures(stage, dashboard.get_current_tournament())
+    if fixtures is None:
+        return api_error("Unknown stage '{}'".format(stage), 404)
+
+    if request.method == 'GET':
+        fixtures = list(fixtures.select_related('team1', 'team2'))
+        answers = {answer.fixture_id: answer for answer in Answer.objects.filter(user=request.user, fixture__in=[f.id for f in fixtures])}
+        now = timezone.now()
+        data = []
+        for fixture in fixtures:
+            answer = answers.get(fixture.id)
+            data.append({
+                'fixture': fixture.id,
+                'team1': fixture.team1.name,
+                'team2': fixture.team2.name,
+                # Fixtures may not have a date yet (they're then locked, see Fixture.is_open)
+                'match_date': fixture.match_date.isoformat() if fixture.match_date is not None else None,
+                'locks_at': fixture.locks_at.isoformat() if fixture.locks_at is not None else None,
+                'locked': not predictions.can_edit_prediction(fixture, now),
+                'prediction': None if answer is None else {field: getattr(answer, field) for field in predictions.PREDICTION_FIELDS},
+            })
+        return JsonResponse({'stage': stage, 'fixtures': data})
+
+    if request.method == 'PUT':
+        try:
+            submitted = parse_api_predictions(request.body)
+        except ValueError as e:
+            return api_error(str(e), 400)
+        statuses = predictions.submit_predictions(request.user, submitted, fixtures=fixtures)
+        return JsonResponse({'results': {str(fixture_id): status for fixture_id, status in statuses.items()}})
+
+    return api_error("Method not allowed", 405)
+
+# Reads and validates the body of a PUT to the predictions API. Raises ValueError if it's invalid.
+def parse_api_predictions(body):
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError):
+        raise ValueError("Request body must be JSON")
+    submitted = data.get('predictions') if isinstance(data, dict) else None
+    if not isinstance(submitted, list):
+        raise ValueError("Expected a 'predictions' list")
+    if len(submitted) > API_MAX_PREDICTIONS:
+        raise ValueError("At most {} predictions can be submitted at once".format(API_MAX_PREDICTIONS))
+
+    parsed = []
+    for prediction in submitted:
+        if not isinstance(prediction, dict) or type(prediction.get('fixture')) is not int:
+            raise ValueError("Each prediction needs an integer 'fixture'")
+        for field in ('team1_goals', 'team2_goals'):
+            goals = prediction.get(field)
+            if goals is not None and (type(goals) is not int or not 0 <= goals <= 10):
+                raise ValueError("'{}' must be a number of goals from 0 to 10".format(field))
+        for field in ('has_extra_time', 'has_penalties'):
+            if not isinstance(prediction.get(field, False), bool):
+                raise ValueError("'{}' must be true or false".format(field))
+        parsed.append({field: prediction.get(field) for field in ('fixture',) + predictions.PREDICTION_FIELDS})
+    return parsed
+
+
 ###############################################
 # FORUMS VIEWS
 ###############################################
@@ -662,11 +728,10 @@ def forums(request):
 ### HELPER METHODS
 #################################
 
-# Returns a dictionary whose keys are the groups and whose values are a queryset of the fixtures in that group. 
-def group_fixtures_dictionary():
-    fixtures = {}
-    f = Fixture.objects.filter(stage=Fixture.GROUP).order_by('team1__group', 'match_date')
-    for group in Team.group_names:
-        fixtures[group] = f.filter(team1__group=group)
-
-    return fixtures
\ No newline at end of file
+# Returns a dictionary whose keys are the groups and whose values are lists of the group's fixtures, in date order.
+# Only the given tournament's fixtures are included, or every tournament's if it's None. Evaluates a single query.
+def group_fixtures_dictionary(tournament=None):
+    fixtures = Fixture.all_fixtures_by_stage(Fixture.GROUP).order_by('team1__group', 'match_date')
+    if tournament is not None:
+        fixtures = fixtures.filter(tournament=tournament)
+    return dashboard.partition_by_group(fixtures)
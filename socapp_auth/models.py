@@ -4,7 +4,7 @@ from django.db import models
 from django.db.models import Avg, Q
 from socapp.models import Answer, Tournament, Fixture
 
-from socapp.utils import group_users_by_points
+import socapp.ranking as ranking
 
 class UserProfile(models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="profile")
@@ -41,26 +41,14 @@ class UserProfile(models.Model):
             user_pts = 0
         return user_pts
 
-    # Returns user's rank in the system compared to all other users, or only their friends is the friends kwarg is set
-    # Extend for tournament?
-    def get_ranking(self, friends=False):
-        if friends:
-            friend_pks = self.friends.all().values_list('pk', flat=True)
-            qs = get_user_model().objects.filter(Q(pk__in=friend_pks) | Q(pk=self.user.pk))
-            ranked_users = group_users_by_points(qs)
-        else:
-            ranked_users = group_users_by_points() # Groups users into sublists: each sublist has users with the same number of points.
-
-        # something else for ranking leaderboards?
+    # Returns user's rank in the system compared to all other users, or only their friends is the friends kwarg is set.
+    # If a tournament is given, the rank is by points in that tournament. Ties share a rank; pass method=ranking.DENSE to not skip places after them.
+    def get_ranking(self, friends=False, tournament=None, method=ranking.COMPETITION):
+        return ranking.user_rank(self, tournament=tournament, friends=friends, method=method)
 
-        # Iterates over the ranked sublists, finds which one the user is in, and returns the ranking
-        ranking = 1
-        for grouping in ranked_users:
-            if self.user in grouping:
-                return ranking
-            else:
-                ranking += len(grouping) # Increment the ranking by however many users were in the previous sublist
-        return None
+    # Returns the user's rank as stored after the last scoring pass (globally, or in the given tournament). Cheaper than get_ranking.
+    def get_stored_ranking(self, tournament=None):
+        return ranking.stored_rank(self.user, tournament=tournament)
 
     # Gets the provided user's average points per fixture, globally or for the tournament passed in
     def points_per_fixture(self, tournament=None):
@@ -77,6 +65,12 @@ class UserProfile(models.Model):
     def __str__(self):
         return self.user.username
 
+    class Meta:
+        indexes = [
+            # Matches the order of the global board, for ranking users and seeking to a page of the board
+            models.Index(fields=['-points', 'user']),
+        ]
+
 # Stores the number of points users gained in each tournament
 class TournamentPoints(models.Model):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name="tournament_pts")
@@ -84,4 +78,7 @@ class TournamentPoints(models.Model):
     points = models.IntegerField(default=0) # How many points the user got in the given tournament
 
     class Meta:
-        unique_together = ['user', 'tournament']
\ No newline at end of file
+        unique_together = ['user', 'tournament']
+        indexes = [
+            models.Index(fields=['tournament', 'points']), # For ranking users within a tournament
+        ]
\ No newline at end of file
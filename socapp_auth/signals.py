@@ -1,8 +1,9 @@
 from django.conf import settings
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, m2m_changed
 from django.dispatch import receiver
 
 from .models import UserProfile
+import socapp.cache as results_cache
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_or_save_user_profile(sender, instance, created, **kwargs):
@@ -10,10 +11,26 @@ def create_or_save_user_profile(sender, instance, created, **kwargs):
     if created:
         # The instance arg is the User instance that triggered the signal
         UserProfile.objects.create(user=instance)
+        results_cache.bump_board_members_version() # The new user is a member of the global board, and nothing else yet
     else:
         instance.profile.save()
 
 @receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
 def delete_userprofile(sender, instance, **kwargs):
     if getattr(instance, "profile", None) is not None:
-        UserProfile.objects.get(user_id=instance.pk).delete()
\ No newline at end of file
+        # Users with points, leaderboards or friends appear on the other pages' cached data (e.g. leaderboards, daily performance),
+        # which deleting their memberships doesn't invalidate (m2m_changed isn't sent for cascades)
+        profile = instance.profile
+        affects_results = profile.points != 0 or instance.leaderboard_set.exists() or profile.friends.exists() or \
+            UserProfile.friends.through.objects.filter(user=instance).exists()
+        UserProfile.objects.get(user_id=instance.pk).delete()
+        if affects_results:
+            results_cache.bump_results_version()
+        else:
+            results_cache.bump_board_members_version()
+
+# Friends boards are made up of a user and their friends, so their cached stats go out of date when friends are added/removed
+@receiver(m2m_changed, sender=UserProfile.friends.through)
+def friends_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        results_cache.bump_results_version()
@@ -178,3 +178,36 @@ class UserProfileTests(TestCase):
         self.assertEqual(user3.profile.get_ranking(friends=True), 2)
         self.add_friends(user3, [self.user])
         self.assertEqual(user3.profile.get_ranking(friends=True), 3)
+
+    # Tests dense rankings, rankings within a tournament, and that each ranking is a single query
+    def test_get_ranking_methods_and_tournaments(self):
+        import socapp.ranking as ranking
+        user2, user3 = helpers.generate_user(username="test2"), helpers.generate_user(username="test3")
+        self.enter_predictions(user2, 1, 1)
+        self.enter_predictions(user3, 0, 2)
+        helpers.play_match(self.wc_fixtures[0], 1, 1)
+        helpers.play_match(self.cl_fixtures[0], 2, 0)
+        user4 = helpers.generate_user(username="test4") # Has no points for either tournament
+
+        # user1 and user2 share first place, user3 gets a bonus point for each game and user4 has no points
+        self.assertEquals(user3.profile.get_ranking(), 3)
+        self.assertEquals(user3.profile.get_ranking(method=ranking.DENSE), 2)
+        self.assertEquals(user4.profile.get_ranking(), 4)
+        self.assertEquals(user4.profile.get_ranking(method=ranking.DENSE), 3)
+
+        # Only the World Cup result counts for the World Cup ranking
+        self.assertEquals(self.user.profile.get_ranking(tournament=self.world_cup), 1)
+        self.assertEquals(user3.profile.get_ranking(tournament=self.world_cup), 3)
+        self.assertEquals(user4.profile.get_ranking(tournament=self.world_cup), 4)
+        self.assertEquals(user4.profile.get_ranking(tournament=self.world_cup, method=ranking.DENSE), 3)
+
+        self.add_friends(user3, [user2])
+        self.assertEquals(user3.profile.get_ranking(tournament=self.world_cup, friends=True), 2)
+
+        with self.assertNumQueries(1):
+            user3.profile.get_ranking(tournament=self.champ_lg, friends=True)
+        with self.assertNumQueries(1):
+            user3.profile.get_ranking()
+
+        with self.assertRaises(ValueError):
+            self.user.profile.get_ranking(method="olympic")
@@ -73,6 +73,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'django.template.context_processors.media',
+                'socapp.context_processors.results_version',
             ],
         },
     },
@@ -149,4 +150,18 @@ STATICFILES_DIRS =  [STATIC_DIR, ]
 MEDIA_URL = '/media/'
 MEDIA_ROOT = MEDIA_DIR
 
-INTERNAL_IPS = ["127.0.0.1"]
\ No newline at end of file
+INTERNAL_IPS = ["127.0.0.1"]
+
+# When True, saving a fixture's result only queues a job, which is applied by the 'process_results' management command.
+# When False, the job is applied before Fixture.save returns.
+RESULT_JOBS_ASYNC = False
+
+# Cache for the data and template fragments of the read-heavy pages, which are keyed by the results version (see socapp/cache.py).
+# Local memory needs no external services; to share the cache between processes, use e.g.
+# 'django.core.cache.backends.filebased.FileBasedCache' with a directory as the LOCATION.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'soccerates',
+    }
+}